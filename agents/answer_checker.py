@@ -0,0 +1,486 @@
+"""
+=======
+answer checker
+=======
+@date: 2024-4-24
+@description:
+A deterministic, local answer-equivalence checker which runs in front of the LLM judge.
+
+`check_equivalence(true, prediction)` returns True or False only when the decision is certain, and None otherwise, in
+which case the pair has to be judged by the LLM. The checker:
+1. Strips the LaTeX wrappers of the dataset (`\\noindent`, `\\\\`, `$`, `\\left`, `\\right`, trailing dots, ...).
+2. Compares multiple-choice labels (`B`, `$B$`, `B) 6x^3 ...`) and yes/no answers.
+3. Parses numbers, fractions, radicals, powers, factorials, `\\pi`, `e`, logarithms and trigonometric functions into an
+    expression tree, and decides numeric equivalence with the tolerance of the evaluation prompt (two decimal places).
+4. Tests expressions with variables (e.g. `y=-5x-3` against `y = -5x - 3`) at random points. A mismatch of symbolic
+    answers is never decided locally.
+
+Only pairs of the same kind are decided: a numeric prediction for a multiple-choice question, for instance, is left to
+the LLM which can map the value to the choice.
+"""
+
+import math
+import random
+import re
+from typing import Any
+
+__all__ = ["check_equivalence", "normalize_answer", "parse_expression"]
+
+# Absolute slack added to every numeric comparison to absorb floating-point noise.
+_EPSILON = 1e-9
+
+_FUNCTIONS = {
+    "sqrt": math.sqrt,
+    "ln": math.log,
+    "log": math.log10,
+    "exp": math.exp,
+    "sin": math.sin,
+    "cos": math.cos,
+    "tan": math.tan,
+    "cot": lambda x: 1 / math.tan(x),
+    "sec": lambda x: 1 / math.cos(x),
+    "csc": lambda x: 1 / math.sin(x),
+    "arcsin": math.asin,
+    "arccos": math.acos,
+    "arctan": math.atan,
+}
+_CONSTANTS = {"pi": math.pi, "e": math.e}
+_GREEK = ["alpha", "beta", "gamma", "delta", "theta", "lambda", "mu", "sigma", "phi", "omega"]
+
+_CHOICE = re.compile(r"^\(?([A-F])\)?(?:[.):]|\s|$)")
+_UNIT = re.compile(r"^([-+]?\d[\d.]*)\s*([A-Za-z]{2,})\.?$")
+
+
+class _ParseError(ValueError):
+    pass
+
+
+def normalize_answer(answer: Any) -> str:
+    """
+    Remove the LaTeX layout and the decorations which do not change the value of an answer.
+
+    Parameters
+    ----------
+    answer: Any
+        The answer. Numbers are converted to strings.
+
+    Returns
+    -------
+    str
+        The normalized answer.
+    """
+
+    text = str(answer)
+    text = text.replace("\\noindent", " ").replace("\\\\", " ")
+    text = re.sub(r"\\(?:left|right|displaystyle|[,!;:]|quad|qquad)", " ", text)
+    text = re.sub(r"\\(?:text|mathrm|mathbf|textbf)\{([^{}]*)\}", r"\1", text)
+    text = text.replace("\\$", " ").replace("$", " ")
+    text = re.sub(r"\\boxed\{(.*)\}", r"\1", text)
+    text = re.sub(r"\s+", " ", text).strip()
+    text = re.sub(r"^(?:the answer is|answer:)\s*", "", text, flags=re.IGNORECASE)
+    return text.rstrip(". ").strip()
+
+
+def _latex_to_plain(text: str) -> str:
+    """
+    Rewrite the LaTeX constructs understood by the parser into a plain infix expression.
+    """
+
+    text = re.sub(r"\\[dt]?frac\s*(\d)\s*(\d)", r"{\1}/{\2}", text)
+    text = re.sub(r"\\[dt]?frac", r"\\frac", text)
+    # \frac{a}{b} -> ({a})/({b}), innermost first
+    pattern = re.compile(r"\\frac\s*\{([^{}]*)\}\s*\{([^{}]*)\}")
+    root = re.compile(r"\\sqrt\s*\[([^\[\]]*)\]\s*\{([^{}]*)\}")
+    while True:
+        new = pattern.sub(r"((\1)/(\2))", text)
+        new = root.sub(r"((\2)^(1/(\1)))", new)
+        new = re.sub(r"\\sqrt\s*\{([^{}]*)\}", r"sqrt(\1)", new)
+        if new == text:
+            break
+        text = new
+    if "\\frac" in text:
+        raise _ParseError("Unbalanced fraction.")
+
+    text = re.sub(r"\\sqrt\s*(\d+|[a-zA-Z])", r"sqrt(\1)", text)
+    text = re.sub(r"\\(?:cdot|times)", "*", text)
+    text = text.replace("\\div", "/").replace("**", "^")
+    text = re.sub(r"\\(" + "|".join(list(_FUNCTIONS) + list(_CONSTANTS) + _GREEK) + r")\b", r" \1 ", text)
+    text = text.replace("{", "(").replace("}", ")")
+    text = re.sub(r"\^\s*\\circ", "", text)
+    if "\\" in text or "infty" in text:
+        raise _ParseError(f"Unsupported LaTeX in {text!r}.")
+    return text
+
+
+_TOKEN = re.compile(r"\s*(?:(\d+\.?\d*(?:[eE][-+]?\d+(?![a-zA-Z]))?|\.\d+)|([A-Za-z]+)|(.))")
+_NAMES = sorted([name for name in list(_FUNCTIONS) + list(_CONSTANTS) + _GREEK if len(name) > 1], key=len, reverse=True)
+
+
+def _split_name(name: str) -> list:
+    """
+    Split a run of letters into known names and single-letter symbols, e.g. "xsqrt" -> ["x", "sqrt"].
+    """
+
+    parts = []
+    while name:
+        for known in _NAMES:
+            if name.startswith(known):
+                parts.append(known)
+                name = name[len(known):]
+                break
+        else:
+            parts.append(name[0])
+            name = name[1:]
+    return parts
+
+
+def _tokenize(text: str) -> list:
+    tokens = []
+    for number, name, symbol in _TOKEN.findall(text):
+        if number:
+            tokens.append(("num", float(number)))
+        elif name:
+            tokens.extend(("name", part) for part in _split_name(name))
+        elif symbol.strip():
+            tokens.append(("op", symbol))
+    return tokens
+
+
+class _Parser:
+    """
+    A recursive descent parser producing a tuple-based expression tree.
+
+    expr    := term (('+' | '-') term)*
+    term    := unary (('*' | '/')? unary)*        # juxtaposition is multiplication
+    unary   := ('+' | '-') unary | power
+    power   := postfix ('^' unary)?
+    postfix := atom '!'*
+    atom    := number | constant | variable | function atom | '(' expr ')'
+    """
+
+    def __init__(self, tokens: list) -> None:
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self) -> tuple | None:
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def take(self) -> tuple:
+        token = self.peek()
+        if token is None:
+            raise _ParseError("Unexpected end of the expression.")
+        self.position += 1
+        return token
+
+    def parse(self) -> tuple:
+        if not self.tokens:
+            raise _ParseError("Empty expression.")
+        tree = self.expr()
+        if self.peek() is not None:
+            raise _ParseError(f"Unexpected token {self.peek()}.")
+        return tree
+
+    def expr(self) -> tuple:
+        tree = self.term()
+        while self.peek() in (("op", "+"), ("op", "-")):
+            operator = self.take()[1]
+            tree = (operator, tree, self.term())
+        return tree
+
+    def term(self) -> tuple:
+        tree = self.unary()
+        while True:
+            token = self.peek()
+            if token in (("op", "*"), ("op", "/")):
+                self.take()
+                tree = (token[1], tree, self.unary())
+            elif token is not None and (token[0] in ("num", "name") or token == ("op", "(")):
+                tree = ("*", tree, self.power())
+            else:
+                return tree
+
+    def unary(self) -> tuple:
+        if self.peek() == ("op", "-"):
+            self.take()
+            return ("neg", self.unary())
+        if self.peek() == ("op", "+"):
+            self.take()
+            return self.unary()
+        return self.power()
+
+    def power(self) -> tuple:
+        base = self.postfix()
+        if self.peek() == ("op", "^"):
+            self.take()
+            return ("^", base, self.unary())
+        return base
+
+    def postfix(self) -> tuple:
+        tree = self.atom()
+        while self.peek() == ("op", "!"):
+            self.take()
+            tree = ("!", tree)
+        return tree
+
+    def atom(self) -> tuple:
+        kind, value = self.take()
+        if kind == "num":
+            return ("num", value)
+        if kind == "name":
+            if value in _FUNCTIONS:
+                # sin^2 x is (sin x)^2
+                if self.peek() == ("op", "^"):
+                    self.take()
+                    exponent = self.unary()
+                    return ("^", ("call", value, self.power()), exponent)
+                return ("call", value, self.power())
+            if value in _CONSTANTS:
+                return ("num", _CONSTANTS[value])
+            return ("var", value)
+        if value == "(" or value == "[":
+            tree = self.expr()
+            closing = self.take()
+            if closing not in (("op", ")"), ("op", "]")):
+                raise _ParseError("Unbalanced parenthesis.")
+            return tree
+        raise _ParseError(f"Unexpected token {value!r}.")
+
+
+def parse_expression(text: str) -> tuple:
+    """
+    Parse a (LaTeX or plain) math expression into an expression tree.
+
+    Raises
+    ------
+    ValueError
+        The expression is not supported.
+    """
+
+    return _Parser(_tokenize(_latex_to_plain(text))).parse()
+
+
+def _variables(tree: tuple) -> set:
+    if tree[0] == "var":
+        return {tree[1]}
+    if tree[0] == "num":
+        return set()
+    return set().union(*(_variables(child) for child in tree[1:] if isinstance(child, tuple)))
+
+
+def _evaluate(tree: tuple, values: dict) -> float:
+    kind = tree[0]
+    if kind == "num":
+        return tree[1]
+    if kind == "var":
+        return values[tree[1]]
+    if kind == "neg":
+        return -_evaluate(tree[1], values)
+    if kind == "call":
+        return _FUNCTIONS[tree[1]](_evaluate(tree[2], values))
+    if kind == "!":
+        value = _evaluate(tree[1], values)
+        if value < 0 or value != int(value) or value > 170:
+            raise _ParseError("Unsupported factorial.")
+        return float(math.factorial(int(value)))
+    left, right = _evaluate(tree[1], values), _evaluate(tree[2], values)
+    if kind == "+":
+        return left + right
+    if kind == "-":
+        return left - right
+    if kind == "*":
+        return left * right
+    if kind == "/":
+        return left / right
+    result = left ** right
+    if isinstance(result, complex):
+        raise _ParseError("Complex value.")
+    return result
+
+
+def _decimals(text: str) -> int | None:
+    """
+    The number of decimal places of a plain decimal literal, None if the text is not one.
+    """
+
+    match = re.fullmatch(r"[-+]?\d*\.(\d+)", text.strip())
+    return len(match.group(1)) if match else None
+
+
+def _compare_numbers(true_value: float, true_text: str, predicted_value: float, predicted_text: str) -> bool | None:
+    """
+    Numeric equivalence following the evaluation prompt: exact values match up to floating-point noise, and decimal
+    approximations with at least two decimal places match if they are correctly rounded.
+    """
+
+    difference = abs(true_value - predicted_value)
+    if difference <= _EPSILON * max(1., abs(true_value)):
+        return True
+
+    for text in (true_text, predicted_text):
+        places = _decimals(text)
+        if places is not None and places >= 2 and difference <= 0.5 * 10 ** -places + _EPSILON:
+            return True
+
+    # Clearly different values are decided locally; borderline approximations go to the judge.
+    if difference > max(0.01 * abs(true_value), 0.01):
+        return False
+    return None
+
+
+def _split_top_level(text: str) -> list:
+    """
+    Split a comma separated list, ignoring the commas inside brackets.
+    """
+
+    parts, depth, current = [], 0, ""
+    for char in text:
+        if char in "([{":
+            depth += 1
+        elif char in ")]}":
+            depth -= 1
+        if char == "," and depth == 0:
+            parts.append(current)
+            current = ""
+        else:
+            current += char
+    parts.append(current)
+    return [part.strip() for part in parts]
+
+
+def _strip_unit(text: str) -> str:
+    match = _UNIT.match(text)
+    if match and match.group(2).lower() not in set(_FUNCTIONS) | set(_CONSTANTS) | set(_GREEK):
+        return match.group(1)
+    return text
+
+
+def _compare_expressions(true_text: str, predicted_text: str) -> bool | None:
+    """
+    Compare two single expressions (or equations).
+    """
+
+    true_text, predicted_text = _strip_unit(true_text), _strip_unit(predicted_text)
+
+    true_sides = true_text.split("=")
+    predicted_sides = predicted_text.split("=")
+    if len(true_sides) > 2 or len(predicted_sides) > 2:
+        return None
+    # "x = -1" against "-1": compare the right-hand sides.
+    if len(true_sides) == 2 and len(predicted_sides) == 1 and re.fullmatch(r"\s*[a-zA-Z]\s*", true_sides[0]):
+        true_sides = true_sides[1:]
+    if len(predicted_sides) == 2 and len(true_sides) == 1 and re.fullmatch(r"\s*[a-zA-Z]\s*", predicted_sides[0]):
+        predicted_sides = predicted_sides[1:]
+    if len(true_sides) != len(predicted_sides):
+        return None
+
+    try:
+        true_trees = [parse_expression(side) for side in true_sides]
+        predicted_trees = [parse_expression(side) for side in predicted_sides]
+    except (_ParseError, RecursionError):
+        return None
+
+    if len(true_trees) == 2:
+        true_trees = [("-", true_trees[0], true_trees[1])]
+        predicted_trees = [("-", predicted_trees[0], predicted_trees[1])]
+        equation = True
+    else:
+        equation = False
+    true_tree, predicted_tree = true_trees[0], predicted_trees[0]
+
+    variables = _variables(true_tree)
+    if variables != _variables(predicted_tree):
+        return None
+
+    if not variables and not equation:
+        try:
+            true_value = _evaluate(true_tree, {})
+            predicted_value = _evaluate(predicted_tree, {})
+        except (ArithmeticError, ValueError, _ParseError):
+            return None
+        if not (math.isfinite(true_value) and math.isfinite(predicted_value)):
+            return None
+        return _compare_numbers(true_value, true_sides[0], predicted_value, predicted_sides[0])
+
+    # Identity testing at random points; an equation may be scaled by a constant factor.
+    generator = random.Random(0)
+    ratio = None
+    for _ in range(6):
+        values = {name: generator.uniform(0.5, 2.) for name in variables}
+        try:
+            true_value = _evaluate(true_tree, values)
+            predicted_value = _evaluate(predicted_tree, values)
+        except (ArithmeticError, ValueError, _ParseError):
+            return None
+        if equation:
+            if abs(true_value) < _EPSILON and abs(predicted_value) < _EPSILON:
+                continue
+            if abs(true_value) < _EPSILON:
+                return None
+            current = predicted_value / true_value
+            if ratio is None:
+                ratio = current
+            if abs(current - ratio) > 1e-6 * max(1., abs(ratio)):
+                return None
+        elif abs(true_value - predicted_value) > 1e-6 * max(1., abs(true_value)):
+            return None
+    return True
+
+
+def check_equivalence(true: Any, prediction: Any) -> bool | None:
+    """
+    Decide locally whether a prediction is equivalent to the ground truth.
+
+    Parameters
+    ----------
+    true: Any
+        The ground-truth answer as stored in the dataset.
+    prediction: Any
+        The predicted answer. Dicts, lists and None are never decided locally.
+
+    Returns
+    -------
+    bool | None
+        True or False when the decision is certain, None when the pair has to be judged by the LLM.
+    """
+
+    if prediction is None or isinstance(prediction, (dict, list, bool)):
+        return None
+
+    true_text = normalize_answer(true)
+    predicted_text = normalize_answer(prediction)
+    if not true_text or not predicted_text:
+        return None
+
+    if re.sub(r"\s", "", true_text) == re.sub(r"\s", "", predicted_text):
+        return True
+
+    # Multiple-choice labels
+    if re.fullmatch(r"[A-F]", true_text):
+        match = _CHOICE.match(predicted_text)
+        # "C) 5, 11, 13 and D) 3, 4, 5" names several choices
+        if match and len(re.findall(r"(?:^|\s)\(?[A-F]\)", predicted_text)) <= 1:
+            return match.group(1) == true_text
+        return None
+
+    # Yes / No, but not "No answer provided."
+    if true_text.lower() in ("yes", "no"):
+        word = re.fullmatch(r"(yes|no)(?:[.,;:!].*)?", predicted_text.lower())
+        return word.group(1) == true_text.lower() if word else None
+
+    true_parts = _split_top_level(true_text)
+    predicted_parts = _split_top_level(predicted_text)
+    if len(true_parts) != len(predicted_parts):
+        return None
+    if len(true_parts) == 1:
+        return _compare_expressions(true_text, predicted_text)
+
+    # Lists of answers: only an element-wise match (in any order) is decided.
+    remaining = list(predicted_parts)
+    for part in true_parts:
+        for candidate in remaining:
+            if _compare_expressions(part, candidate) is True:
+                remaining.remove(candidate)
+                break
+        else:
+            return None
+    return True
@@ -0,0 +1,205 @@
+"""
+=======
+cascade judge
+=======
+@date: 2024-4-24
+@description:
+The first stage of a judging cascade: a cheap or fast model judges an answer and reports how sure it is, and the
+`Evalutor` only escalates the uncertain answers to the strong judge.
+
+`CheapJudge.judge(question, true, prediction)` returns the verdict ("0"/"1", None if the answer of the model cannot be
+parsed) and whether it is accepted. A verdict is accepted when:
+1. Its confidence is at least `threshold`. The confidence is the probability of the verdict token when the client
+    returns log-probabilities (an `OpenAIClient` created with `logprobs=True, top_logprobs=5`), and otherwise the
+    confidence the model states in its answer (`{"score": 1, "confidence": 0.9}`).
+2. With `samples > 1`, all the samples agree: a disagreement always escalates, whatever the confidences.
+
+The cheap model can be served by an `OpenAIClient` or by the `Llama3APIClient` endpoint.
+"""
+
+import asyncio
+import hashlib
+import json
+import math
+import re
+
+from agents.ledger import judge_config
+
+__all__ = ["CheapJudge", "CHEAP_EVALUATION"]
+
+_SCORE = re.compile(r'"?score"?\s*[:=]\s*"?([01])')
+_CONFIDENCE = re.compile(r'"?confidence"?\s*[:=]\s*"?([0-9]*\.?[0-9]+)\s*(%?)')
+
+
+class CheapJudge:
+    """
+    A judge which returns a verdict and whether it is confident enough to skip the strong judge.
+    """
+    threshold: float
+    samples: int
+
+    def __init__(self, llm_client, threshold: float = 0.9, samples: int = 1) -> None:
+        """
+        Parameters
+        ----------
+        llm_client: OpenAIClient | Llama3APIClient
+            The client of the cheap model.
+        threshold: float, optional
+            The minimum confidence of an accepted verdict, by default 0.9.
+        samples: int, optional
+            The number of verdicts requested per answer, by default 1. With more samples (at a non-zero temperature),
+            the answers on which the samples disagree are escalated.
+        """
+
+        assert samples >= 1, "The number of samples must be a positive integer."
+
+        self.llm_client = llm_client
+        self.threshold = threshold
+        self.samples = samples
+
+    def config(self) -> str:
+        """
+        The fingerprint of the cheap judge, part of the judge configuration of the verdict ledger.
+        """
+
+        canonical = json.dumps([judge_config(self.llm_client, CHEAP_EVALUATION), self.threshold, self.samples])
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:16]
+
+    def judge(self, question: str, true: str, prediction: str) -> tuple[str | None, bool]:
+        """
+        Judge an answer with the cheap model.
+
+        Returns
+        -------
+        tuple
+            The verdict ("0", "1" or None if no sample could be parsed) and whether it is accepted.
+        """
+
+        messages = self._messages(question, true, prediction)
+        return self._decide([self._parse(self._ask(messages)) for _ in range(self.samples)])
+
+    async def ajudge(self, question: str, true: str, prediction: str) -> tuple[str | None, bool]:
+        """
+        The async version of `judge`, with the samples requested concurrently.
+        """
+
+        messages = self._messages(question, true, prediction)
+        if hasattr(self.llm_client, "arun"):
+            responses = await asyncio.gather(*[self.llm_client.arun(messages) for _ in range(self.samples)],
+                                             return_exceptions=True)
+        else:
+            responses = await asyncio.gather(*[asyncio.to_thread(self.llm_client.run, messages)
+                                               for _ in range(self.samples)], return_exceptions=True)
+        # A failed sample is unparsed: the answer is escalated to the strong judge.
+        return self._decide([self._parse(None if isinstance(response, Exception) else response)
+                             for response in responses])
+
+    def _ask(self, messages: list):
+        """
+        One answer of the cheap model, None if the request failed: the answer is then escalated.
+        """
+
+        try:
+            return self.llm_client.run(messages)
+        except Exception as error:
+            print(f"The cheap judge failed ({type(error).__name__}: {error}), escalating.")
+            return None
+
+    @staticmethod
+    def _messages(question: str, true: str, prediction: str) -> list:
+        values = {"question": question, "true": true, "prediction": prediction}
+        return [{"role": message["role"], "content": message["content"].format(**values)}
+                for message in CHEAP_EVALUATION]
+
+    def _decide(self, samples: list) -> tuple[str | None, bool]:
+        verdicts = [verdict for verdict, _ in samples if verdict is not None]
+        if not verdicts:
+            return None, False
+        verdict = max(set(verdicts), key=verdicts.count)
+        agreed = len(verdicts) == len(samples) and len(set(verdicts)) == 1
+        confident = all(confidence is not None and confidence >= self.threshold for _, confidence in samples)
+        return verdict, agreed and confident
+
+    @staticmethod
+    def _parse(response) -> tuple[str | None, float | None]:
+        """
+        The verdict and the confidence of one answer of the cheap model.
+        """
+
+        if response is None:
+            return None, None
+        if isinstance(response, dict):
+            # Llama3APIClient
+            return CheapJudge.parse_text(response.get("content"))
+
+        choice = response.choices[0]
+        verdict, confidence = CheapJudge.parse_text(choice.message.content)
+        logprobs = getattr(choice, "logprobs", None)
+        if verdict is not None and logprobs is not None and logprobs.content:
+            token_confidence = _token_confidence(logprobs.content, verdict)
+            if token_confidence is not None:
+                confidence = token_confidence
+        return verdict, confidence
+
+    @staticmethod
+    def parse_text(text: str | None) -> tuple[str | None, float | None]:
+        """
+        Extract the score and the stated confidence (in [0, 1]) of an answer like `{"score": 1, "confidence": 0.9}`.
+        """
+
+        if not text:
+            return None, None
+        score = _SCORE.search(text)
+        if score is None:
+            stripped = text.strip()
+            return (stripped, None) if stripped in ("0", "1") else (None, None)
+        confidence = _CONFIDENCE.search(text)
+        value = None
+        if confidence is not None:
+            value = float(confidence.group(1))
+            if confidence.group(2) or value > 1.:
+                value /= 100.
+            value = min(max(value, 0.), 1.)
+        return score.group(1), value
+
+
+def _token_confidence(tokens: list, verdict: str) -> float | None:
+    """
+    The probability of the verdict at the first token which is a score, summed over its spellings in the top
+    log-probabilities (e.g. "1" and " 1").
+    """
+
+    for position, token in enumerate(tokens):
+        if token.token.strip() not in ("0", "1"):
+            continue
+        # Only the value of the "score" field, not a digit of the confidence.
+        before = "".join(t.token for t in tokens[max(0, position - 4):position])
+        if "score" not in before:
+            continue
+        candidates = token.top_logprobs or [token]
+        return sum(math.exp(candidate.logprob) for candidate in candidates if candidate.token.strip() == verdict)
+    return None
+
+
+CHEAP_EVALUATION = [
+    {
+        "role": "system",
+        "content":
+        """
+        Assume the role of a math teacher tasked with evaluating a student response against the provided solution, which may be an exact value, a multiple-choice answer, or a numerical approximation. The question is provided as: {question}, the correct answer is provided as: {true}.
+
+        ## Evaluation Criteria:
+        1. **Mathematical Equivalence**: Equivalent algebraic, symbolic, trigonometric or logarithmic forms are correct.
+        2. **Multiple Choices**: A correct choice label (e.g., A, B, C), or the value of the correct choice, is correct.
+        3. **Numerical Equivalence**: Numbers correct to at least two decimal places, or to the precision of the solution, are correct.
+
+        ## Expected Output Format:
+            Output only a JSON object with the score (1 if the student answer is correct, 0 otherwise) and your confidence in the score between 0 and 1, for example {{"score": 1, "confidence": 0.95}}. Use a low confidence whenever the equivalence is not obvious.
+        """
+    },
+    {"role": "user", "content":
+    """
+    The student answer is {prediction}.
+    """
+    }
+]
@@ -13,6 +13,9 @@ import numpy as np
 from xyz.node.agent import Agent
 from xyz.node.basic.llm_agent import LLMAgent
 from xyz.utils.llm.openai_client import OpenAIClient
+from agents.answer_checker import check_equivalence
+from agents.cascade import CheapJudge
+from agents.ledger import VerdictLedger, judge_config
 import os
 import json
 import re
@@ -24,21 +27,234 @@ OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 
 
 class Evalutor(Agent):
-    def __init__(self):
+    def __init__(self, llm_client: OpenAIClient = None, local_check: bool = True, batch_size: int = 1,
+                 ledger: VerdictLedger = None, cascade: CheapJudge = None, audit: float = 0., **client_args):
+        """
+        Parameters
+        ----------
+        llm_client: OpenAIClient, optional
+            The client of the judge model. By default, gpt-4-turbo-2024-04-09 at temperature 0.
+        local_check: bool, optional
+            Whether to decide the obvious cases with the local answer checker before calling the judge, by default True.
+        batch_size: int, optional
+            The number of items packed into one judge request by `judge_batch`, by default 1 (one request per item).
+            Larger batches send the evaluation criteria once for K items, at some cost in accuracy.
+        ledger: VerdictLedger, optional
+            The ledger of the previous verdicts of the same judge. The items it knows are not sent to the judge, and
+            the new verdicts are recorded. By default None (no ledger).
+        cascade: CheapJudge, optional
+            A cheap judge consulted before the strong one: only the answers it is not confident about (or on which its
+            samples disagree) are escalated to the strong judge. By default None (every answer goes to the strong
+            judge).
+        audit: float, optional
+            The fraction of the accepted cheap verdicts which are also sent to the strong judge, to measure the
+            agreement of the two judges on the answers which are not escalated, by default 0. The strong verdict is
+            kept for the audited answers.
+        client_args: dict, optional
+            Extra arguments of the default client, e.g. `cache`. They are ignored if `llm_client` is given.
+        """
         
         super().__init__()  
 
-        self.openai_agent = OpenAIClient(api_key=OPENAI_API_KEY, model='gpt-4-turbo-2024-04-09', temperature=0., top_p=0.8,
-                                         max_tokens=2096)
+        if llm_client is None:
+            client_args = {"model": 'gpt-4-turbo-2024-04-09', "temperature": 0., "top_p": 0.8, "max_tokens": 2096,
+                           **client_args}
+            llm_client = OpenAIClient(api_key=OPENAI_API_KEY, **client_args)
+        self.openai_agent = llm_client
         self.llm_evaluate_agent = LLMAgent(EVALUATION, self.openai_agent, stream=False)
+        self.llm_batch_evaluate_agent = LLMAgent(BATCH_EVALUATION, self.openai_agent, stream=False)
+        self.local_check = local_check
+        self.batch_size = batch_size
+        self.ledger = ledger
+        self.cascade = cascade
+        self.audit = audit
+        self.judge = judge_config(self.openai_agent, [EVALUATION, BATCH_EVALUATION])
+        if cascade is not None:
+            self.judge += "+" + cascade.config()
+        self._audits = np.random.default_rng(0)
+        # How many verdicts were decided locally, from the ledger and by the judge, and how many batch requests fell
+        # back to single items
+        self.stats = {"local": 0, "ledger": 0, "llm": 0, "batches": 0, "batch_fallbacks": 0}
+        # The cascade: the verdicts accepted from the cheap judge, the answers escalated or audited, and how often the
+        # two judges agreed when both judged an answer
+        self.cascade_stats = {"cheap": 0, "escalated": 0, "audited": 0, "compared": 0, "agreed": 0}
 
 
     def flowing(self, question: str, true: str, prediction: str) -> str:
-        
+
+        result = self._decided(question, true, prediction)
+        if result is not None:
+            return result
+
+        cheap = None
+        if self.cascade is not None:
+            cheap = self._screened(*self.cascade.judge(question, true, prediction))
+            if cheap is not None and not cheap[1]:
+                self._remember(question, true, prediction, cheap[0])
+                return cheap[0]
+
+        self.stats["llm"] += 1
         result = self.llm_evaluate_agent(question=question, true=true, prediction=prediction)
+        self._compare(cheap, result)
+        self._remember(question, true, prediction, result)
+
+        return result
+
+    async def aflowing(self, question: str, true: str, prediction: str) -> str:
+
+        result = self._decided(question, true, prediction)
+        if result is not None:
+            return result
+
+        cheap = None
+        if self.cascade is not None:
+            cheap = self._screened(*await self.cascade.ajudge(question, true, prediction))
+            if cheap is not None and not cheap[1]:
+                self._remember(question, true, prediction, cheap[0])
+                return cheap[0]
+
+        self.stats["llm"] += 1
+        result = await self.llm_evaluate_agent.acall(question=question, true=true, prediction=prediction)
+        self._compare(cheap, result)
+        self._remember(question, true, prediction, result)
 
         return result
 
+    def _decided(self, question: str, true: str, prediction: str) -> str | None:
+        """
+        The verdict of the local checker or of the ledger, None if the item has to be sent to the judge.
+        """
+
+        if self.local_check:
+            verdict = check_equivalence(true, prediction)
+            if verdict is not None:
+                self.stats["local"] += 1
+                return "1" if verdict else "0"
+
+        if self.ledger is not None:
+            verdict = self.ledger.get(self.ledger.fingerprint(question, true, prediction, self.judge))
+            if verdict is not None:
+                self.stats["ledger"] += 1
+                return verdict
+
+        return None
+
+    def _screened(self, verdict: str | None, accepted: bool) -> tuple[str | None, bool]:
+        """
+        Count the verdict of the cheap judge and decide whether the strong judge is needed.
+
+        Returns
+        -------
+        tuple
+            The cheap verdict and whether the answer goes to the strong judge (escalated or audited).
+        """
+
+        if not accepted:
+            self.cascade_stats["escalated"] += 1
+            return verdict, True
+        if self.audit > 0 and self._audits.random() < self.audit:
+            self.cascade_stats["audited"] += 1
+            return verdict, True
+        self.cascade_stats["cheap"] += 1
+        return verdict, False
+
+    def _compare(self, cheap: tuple | None, result: str) -> None:
+        if cheap is None or cheap[0] is None or str(result).strip() not in ("0", "1"):
+            return
+        self.cascade_stats["compared"] += 1
+        self.cascade_stats["agreed"] += cheap[0] == str(result).strip()
+
+    def _remember(self, question: str, true: str, prediction: str, verdict: str) -> None:
+        if self.ledger is not None:
+            self.ledger.set(self.ledger.fingerprint(question, true, prediction, self.judge), verdict, self.judge)
+
+    def judge_batch(self, items: list) -> list:
+        """
+        Judge several items, packing up to `batch_size` of them into one request.
+
+        Parameters
+        ----------
+        items: list
+            The items to judge, each one a dict with the keys "question", "true" and "prediction".
+
+        Returns
+        -------
+        list
+            The verdict of every item, in order.
+        """
+
+        verdicts = [None] * len(items)
+        cheap = {}
+        pending = []
+        for i, item in enumerate(items):
+            verdicts[i] = self._decided(item["question"], item["true"], item["prediction"])
+            if verdicts[i] is None and self.cascade is not None:
+                cheap[i] = self._screened(*self.cascade.judge(item["question"], item["true"], item["prediction"]))
+                if not cheap[i][1]:
+                    verdicts[i] = cheap[i][0]
+                    self._remember(item["question"], item["true"], item["prediction"], verdicts[i])
+            if verdicts[i] is None:
+                pending.append(i)
+
+        if self.batch_size <= 1:
+            for i in pending:
+                self.stats["llm"] += 1
+                verdicts[i] = self.llm_evaluate_agent(**items[i])
+        else:
+            for start in range(0, len(pending), self.batch_size):
+                chunk = pending[start:start + self.batch_size]
+                for i, verdict in zip(chunk, self._judge_chunk([items[i] for i in chunk])):
+                    verdicts[i] = verdict
+
+        for i in pending:
+            self._compare(cheap.get(i), verdicts[i])
+            self._remember(items[i]["question"], items[i]["true"], items[i]["prediction"], verdicts[i])
+        return verdicts
+
+    def _judge_chunk(self, items: list) -> list:
+        """
+        Judge the items in one request, falling back to one request per item if the answer is not a list of exactly
+        len(items) scores.
+        """
+
+        if len(items) == 1:
+            self.stats["llm"] += 1
+            return [self.llm_evaluate_agent(**items[0])]
+
+        blocks = []
+        for number, item in enumerate(items, 1):
+            blocks.append(f"### Item {number}\nQuestion: {item['question']}\nCorrect answer: {item['true']}\n"
+                          f"Student answer: {item['prediction']}")
+        self.stats["batches"] += 1
+        result = self.llm_batch_evaluate_agent(count=len(items), items="\n\n".join(blocks))
+
+        scores = self.parse_scores(result, len(items))
+        if scores is None:
+            self.stats["batch_fallbacks"] += 1
+            self.stats["llm"] += len(items)
+            return [self.llm_evaluate_agent(**item) for item in items]
+
+        self.stats["llm"] += len(items)
+        return scores
+
+    @staticmethod
+    def parse_scores(text: str, count: int) -> list | None:
+        """
+        Extract the list of '0'/'1' scores from the answer of a batch request. None if it is not a JSON array of exactly
+        `count` scores.
+        """
+
+        matches = re.findall(r"\[[^\[\]]*\]", text or "")
+        if not matches:
+            return None
+        try:
+            scores = json.loads(matches[-1])
+        except json.JSONDecodeError:
+            return None
+        if len(scores) != count or any(str(score).strip() not in ("0", "1") for score in scores):
+            return None
+        return [str(score).strip() for score in scores]
+
 
 EVALUATION = [
     {
@@ -69,6 +285,31 @@ EVALUATION = [
     }
 ]
 
+BATCH_EVALUATION = [
+    {
+        "role": "system",
+        "content":
+        """
+        Assume the role of a math teacher tasked with evaluating student responses against the provided solutions, which may include exact values, multiple-choice answers, or numerical approximations. You will receive several numbered items, each one with a question, the correct answer and the student answer. Evaluate every item independently.
+        
+        ## Evaluation Criteria:
+        1. **Mathematical Equivalence**: Evaluate answers based on deep mathematical equivalence, not just numerical accuracy. Verify if different algebraic or symbolic expressions are equivalent, such as \\( \\frac{{\\sqrt{{6}}-\\sqrt{{2}}}}{{2}} \\) being equivalent to \\( \\sqrt{{2 - \\sqrt{{3}}}} \\).
+        2. **Scoring**: Assign a score of 1 for any answer that matches or is equivalent to the provided solution, whether it is an exact value, a choice label (e.g., A, B, C), or a correctly rounded numerical approximation. Assign a score of 0 for incorrect answers.
+        3. **Handling Multiple Choices**: If the solution provided is a choice (e.g., A, B, C, D, E, F) and the student identifies this choice correctly, treat it as correct. If the solution is an exact value and the student provides the corresponding choice that reflects this value correctly according to the problem's context, also treat it as correct.
+        4. **Numerical Equivalence**: Treat numerical answers as equivalent if they are correct to at least two decimal places or more, depending on the precision provided in the solution. For instance, both 0.913 and 0.91 should be accepted if the solution is accurate within two decimal places.
+        5. **Symbolic and Algebraic Identities**: Recognize and accept equivalent algebraic, trigonometric and logarithmic forms as correct.
+
+        ## Expected Output Format:
+            Output only a JSON array with exactly {count} scores, one per item and in the order of the items, for example [1, 0, 1]. Do not include any additional information or feedback in your response.
+        """
+    },
+    {"role": "user", "content": 
+    """
+    {items}
+    """
+    }
+]
+
 # Example of using the mathSolve
 if __name__ == "__main__":
     
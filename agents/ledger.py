@@ -0,0 +1,134 @@
+"""
+=======
+verdict ledger
+=======
+@date: 2024-4-24
+@description:
+A persistent ledger of the verdicts of the LLM judge, so that re-evaluating a prediction file which changed in only a
+few answers only sends the new or changed answers to the judge.
+
+A verdict is keyed by the fingerprint of (question, correct answer, normalized prediction, judge configuration):
+1. The prediction is normalized with `normalize_answer`, so layout-only edits (`$...$`, `\\boxed{}`, trailing dots,
+    whitespace) of a cleaned file reuse the previous verdict.
+2. The key does not contain the problem id or the model which produced the prediction, so two models giving the same
+    answer to the same problem share one verdict, across runs and across files.
+3. The judge configuration (model, sampling arguments and evaluation prompt) is part of the key: changing the judge or
+    its criteria invalidates the ledger instead of mixing verdicts of different judges.
+
+Only clean verdicts ("0" or "1") are recorded; anything else is judged again next time. The ledger is a single SQLite
+file which several processes (e.g. the shards of an evaluation) can share.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from agents.answer_checker import normalize_answer
+
+__all__ = ["VerdictLedger", "judge_config"]
+
+
+def judge_config(client, template: list) -> str:
+    """
+    The fingerprint of a judge: the sampling arguments of its client and its prompt template.
+    """
+
+    # OpenAIClient keeps its sampling arguments in generate_args, Llama3APIClient in default_params.
+    generate_args = getattr(client, "generate_args", None) or getattr(client, "default_params", None) or {}
+    config = {
+        "args": {name: generate_args.get(name) for name in ("model", "temperature", "top_p", "max_tokens")},
+        "template": template,
+    }
+    if getattr(client, "api_url", None) is not None:
+        config["endpoint"] = client.api_url
+    canonical = json.dumps(config, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:16]
+
+
+class VerdictLedger:
+    """
+    An on-disk store of judge verdicts keyed by the fingerprint of the judged item.
+    """
+    path: str
+    hits: int
+    misses: int
+
+    def __init__(self, path: str = ".cache/verdicts.sqlite") -> None:
+        """
+        Parameters
+        ----------
+        path: str, optional
+            The path of the SQLite file, by default ".cache/verdicts.sqlite".
+        """
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS verdicts ("
+            "key TEXT PRIMARY KEY, verdict TEXT NOT NULL, judge TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self._connection.commit()
+
+    @staticmethod
+    def fingerprint(question: str, true: str, prediction: str, judge: str) -> str:
+        """
+        The key of an item judged by the judge with the configuration fingerprint `judge`.
+        """
+
+        item = [str(question).strip(), str(true).strip(), normalize_answer(prediction), judge]
+        canonical = json.dumps(item, ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        """
+        The recorded verdict, or None if the item was never judged.
+        """
+
+        with self._lock:
+            row = self._connection.execute("SELECT verdict FROM verdicts WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def set(self, key: str, verdict: str, judge: str) -> bool:
+        """
+        Record a verdict if it is a clean "0" or "1". Returns whether it was recorded.
+        """
+
+        verdict = str(verdict).strip() if verdict is not None else ""
+        if verdict not in ("0", "1"):
+            return False
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO verdicts (key, verdict, judge, created) VALUES (?, ?, ?, ?)",
+                (key, verdict, judge, time.time())
+            )
+            self._connection.commit()
+        return True
+
+    def stats(self) -> dict:
+        """
+        The hits and misses of this process and the number of recorded verdicts.
+        """
+
+        with self._lock:
+            entries = self._connection.execute("SELECT COUNT(*) FROM verdicts").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
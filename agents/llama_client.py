@@ -1,17 +1,25 @@
 import os
+import sys
 import time
 import traceback
 import json
 from typing import Dict
 
-import requests
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from xyz.utils.llm.circuit_breaker import CircuitOpenError, Failover
+from xyz.utils.llm.rate_limiter import RateLimiter, RateLimitExceeded, estimate_tokens
+from xyz.utils.llm.telemetry import get_telemetry
+from xyz.utils.tracing import annotate
+from xyz.utils.llm.transport import get_pool
 
 class Llama3APIClient:
     """
     The API client that uses a custom API to generate responses to plain text messages.
     """
 
-    def __init__(self, api_url: str, api_token: str, **default_params):
+    def __init__(self, api_url: str, api_token: str, rate_limiter: RateLimiter = None, failover: Failover = None,
+                 **default_params):
         """
         Initializes the API client.
 
@@ -21,9 +29,19 @@ class Llama3APIClient:
             The URL of the API endpoint.
         api_token : str
             The API token for authentication.
+        rate_limiter : RateLimiter, optional
+            The limiter controlling the request rate and the retries, by default None. Without a limiter, a failed
+            request is retried up to 10 times with a fixed delay of 2 seconds.
+        failover : Failover, optional
+            The endpoint URLs (with their circuit breakers) to send the requests to instead of `api_url`, by default
+            None. A request goes to the first endpoint whose breaker is closed, then to the next ones while they fail.
         """
         self.api_url = api_url
         self.api_token = api_token
+        self.rate_limiter = rate_limiter
+        self.failover = failover
+        # Keep-alive connections shared with every client of the same host
+        self.session = get_pool().requests_session(api_url)
         self.default_params = {
             "max_new_tokens": 2048,
             "temperature": 0.7,
@@ -66,29 +84,80 @@ class Llama3APIClient:
             "Content-Type": "application/json"
         }
 
+        start = time.perf_counter()
+        if self.rate_limiter is not None:
+            attempts = []
+
+            def post(*args):
+                attempts.append(1)
+                return self._post(*args)
+
+            try:
+                text = self.rate_limiter.call(post, data, headers,
+                                              estimated_tokens=estimate_tokens(messages,
+                                                                               params.get("max_new_tokens", 1024)))
+            except Exception as error:
+                self._record(start, params, len(attempts), error=type(error).__name__)
+                raise
+            self._record(start, params, len(attempts))
+            return {"content": text}
+
         count = 0
         while count < 10:
             try:
-                response = requests.post(self.api_url, headers=headers, data=json.dumps(data))
-                response.raise_for_status()
-
-                try:
-                    # Attempt to parse the response as JSON
-                    result_dict = response.json()
-                    # Extract text content from JSON
-                    text = result_dict.get('text', '')
-                except json.JSONDecodeError:
-                    # If result is not JSON, use it directly
-                    text = response.text
-
+                text = self._post(data, headers)
+                self._record(start, params, count + 1)
                 return {"content": text}
+            except CircuitOpenError:
+                # Every endpoint is known to be down: fail fast instead of sleeping through the retries.
+                self._record(start, params, count, error="CircuitOpenError")
+                raise
             except Exception as e:
                 count += 1
+                error = e
                 error_message = traceback.format_exc()
                 print(f"Attempt {count}: An error occurred - {error_message}")
                 time.sleep(2)  # Wait for 2 seconds before retrying
 
-        raise Exception("Failed to get a response from the API after several attempts.")
+        self._record(start, params, count, error="Exception")
+        raise RateLimitExceeded("Failed to get a response from the API after several attempts.") from error
+
+    def _record(self, start: float, params: dict, attempts: int, error: str = None) -> None:
+        """
+        Report the call to the telemetry and to the current trace span, if they are enabled. The endpoint does not
+        return the token usage.
+        """
+        latency = time.perf_counter() - start
+        annotate(client_latency=latency, attempts=attempts, retries=max(0, attempts - 1))
+        telemetry = get_telemetry()
+        if telemetry is not None:
+            telemetry.record("llama", model=params.get("model", self.api_url.rsplit("/", 1)[-1]),
+                             latency=latency, attempts=attempts, error=error)
+
+    def _post(self, data: dict, headers: dict) -> str:
+        """
+        Send one request, without any retry, and return the generated text. With a failover, the request goes to the
+        first healthy endpoint.
+        """
+        if self.failover is not None:
+            return self.failover.call(lambda url: self._post_to(url, data, headers))
+        return self._post_to(self.api_url, data, headers)
+
+    def _post_to(self, api_url: str, data: dict, headers: dict) -> str:
+        session = self.session if api_url == self.api_url else get_pool().requests_session(api_url)
+        response = session.post(api_url, headers=headers, data=json.dumps(data))
+        response.raise_for_status()
+
+        try:
+            # Attempt to parse the response as JSON
+            result_dict = response.json()
+            # Extract text content from JSON
+            text = result_dict.get('text', '')
+        except json.JSONDecodeError:
+            # If result is not JSON, use it directly
+            text = response.text
+
+        return text
 
 
 if __name__ == "__main__":
@@ -0,0 +1,295 @@
+"""
+=======
+solver router
+=======
+@date: 2024-4-24
+@description:
+A difficulty-aware router in front of `mathSolve`: every problem is sent to the cheapest model which, according to the
+past evaluation results, is about as accurate as the best one on problems of its class (its level, or its level and
+label when the history has enough problems of the label), with a token budget for the class.
+
+1. `RoutingPolicy.from_history` builds the routes from a `ResultsStore` of `jsonl/eval` results: a model is eligible
+    for a class if its accuracy there is within `tolerance` of the best candidate, and the cheapest eligible model
+    (by `PRICES`, then by the median latency recorded by the telemetry) is chosen. The other candidates, the most
+    accurate first, are the fallback chain of the class.
+2. `token_budgets` derives the `max_tokens` of each level from the length of past solutions (the 95th percentile,
+    with a margin), so the easy classes do not reserve the budget of the hardest ones.
+3. `SolverRouter` solves with the routed model and falls back to the next model of the chain when no answer can be
+    extracted from the solution (an error, a truncated or malformed answer).
+"""
+
+import json
+import math
+import sys
+from os import path
+
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+from xyz.node.agent import Agent
+from xyz.utils.data.dataset import JsonlStore
+from xyz.utils.data.results import ResultsStore
+from xyz.utils.llm.telemetry import percentile, price_of
+from agents.solve import extract_answer
+
+__all__ = ["RoutingPolicy", "SolverRouter", "token_budgets", "telemetry_latencies"]
+
+
+def _relative_cost(model: str, costs: dict | None) -> float:
+    """
+    The relative cost of a model: from `costs` if given, else the price of a typical call (1 prompt token for 3
+    completion tokens). Unknown models count as the most expensive.
+    """
+
+    if costs is not None and model in costs:
+        return costs[model]
+    price = price_of(model, 1_000_000, 3_000_000)
+    return math.inf if price is None else price
+
+
+def telemetry_latencies(telemetry_file: str) -> dict:
+    """
+    The median latency of the successful calls of every (model, level) in a telemetry file (`calls.jsonl`).
+    """
+
+    latencies = {}
+    with open(telemetry_file, "r") as file:
+        for line in file:
+            record = json.loads(line)
+            if record.get("error") is None and record.get("latency") is not None and not record.get("cached"):
+                latencies.setdefault((record.get("model"), record.get("level")), []).append(record["latency"])
+    return {key: percentile(sorted(values), 50) for key, values in latencies.items()}
+
+
+def token_budgets(output_files: list, dataset: str, quantile: float = 95, margin: float = 1.25,
+                  minimum: int = 512, maximum: int = 4096) -> dict:
+    """
+    The `max_tokens` budget of every level, from the solutions of previous runs.
+
+    Parameters
+    ----------
+    output_files: list
+        The solver outputs (`jsonl/*.jsonl`).
+    dataset: str
+        The dataset, for the level of every problem.
+    quantile: float, optional
+        The percentile of the solution lengths covered, by default 95.
+    margin: float, optional
+        The factor applied to the percentile, by default 1.25.
+    minimum, maximum: int, optional
+        The bounds of a budget, by default 512 and 4096.
+
+    Returns
+    -------
+    dict
+        {level: max_tokens}, rounded up to a multiple of 128. The length of a solution is estimated at 4 characters
+        per token.
+    """
+
+    store = JsonlStore(dataset)
+    lengths = {}
+    for output_file in output_files:
+        with JsonlStore(output_file) as outputs:
+            for problem_id, solution in outputs.iter():
+                if problem_id in store and isinstance(solution, str):
+                    level = store.get(problem_id, fields=("level",)).get("level")
+                    lengths.setdefault(level, []).append(len(solution) / 4.)
+    store.close()
+
+    budgets = {}
+    for level, values in lengths.items():
+        tokens = percentile(sorted(values), quantile) * margin
+        budgets[level] = int(min(maximum, max(minimum, math.ceil(tokens / 128.) * 128)))
+    return budgets
+
+
+class RoutingPolicy:
+    """
+    The model chain and the token budget of every problem class.
+    """
+    routes: dict
+    budgets: dict
+    default: list
+
+    def __init__(self, routes: dict, default: list, budgets: dict = None) -> None:
+        """
+        Parameters
+        ----------
+        routes: dict
+            {(level, label): [model, fallback, ...]} for the classes routed by level and label, and
+            {(level, None): [...]} for the classes routed by level only.
+        default: list
+            The chain of the problems of an unknown class.
+        budgets: dict, optional
+            {level: max_tokens}, by default None (the budget of the client).
+        """
+
+        self.routes = routes
+        self.default = default
+        self.budgets = budgets or {}
+
+    def route(self, level: str = None, label: str = None) -> tuple[list, int | None]:
+        """
+        The model chain (the routed model first) and the token budget of a problem.
+        """
+
+        chain = self.routes.get((level, label)) or self.routes.get((level, None)) or self.default
+        return chain, self.budgets.get(level)
+
+    @classmethod
+    def from_history(cls, store: ResultsStore, candidates: dict, tolerance: float = 0.03, min_support: int = 20,
+                     costs: dict = None, latencies: dict = None, budgets: dict = None) -> "RoutingPolicy":
+        """
+        Build the routes from past evaluation results.
+
+        Parameters
+        ----------
+        store: ResultsStore
+            The evaluation results.
+        candidates: dict
+            {model: run}: the models which can be routed to, and the run of the store which measured each of them,
+            e.g. {"gpt-4o-mini": "gpt-4o-mini-solution-clean", "gpt-4-turbo": "gpt-4-turbo-2024-04-09-solution-clean"}.
+        tolerance: float, optional
+            The accuracy a cheaper model may lose on a class, by default 0.03 (3 points).
+        min_support: int, optional
+            The minimum number of problems of a (level, label) class to route it separately from its level, by
+            default 20.
+        costs: dict, optional
+            {model: relative cost}, by default from the price table of the telemetry.
+        latencies: dict, optional
+            {(model, level): seconds}, e.g. from `telemetry_latencies`, used to break the ties of cost.
+        budgets: dict, optional
+            {level: max_tokens}, e.g. from `token_budgets`.
+        """
+
+        models = list(candidates)
+        runs = [store.models.index(candidates[model]) if candidates[model] in store.models else None
+                for model in models]
+        correct, total = store.counts(("model", "level", "label"))
+        latencies = latencies or {}
+
+        def chain(level: str, correct_of: list, total_of: list) -> list | None:
+            accuracy = [c / t if t else None for c, t in zip(correct_of, total_of)]
+            known = [a for a in accuracy if a is not None]
+            if not known:
+                return None
+            best = max(known)
+            eligible = [i for i, a in enumerate(accuracy) if a is not None and a >= best - tolerance]
+            chosen = min(eligible, key=lambda i: (_relative_cost(models[i], costs),
+                                                  latencies.get((models[i], level), math.inf), -accuracy[i]))
+            rest = sorted((i for i in range(len(models)) if i != chosen),
+                          key=lambda i: -1. if accuracy[i] is None else -accuracy[i])
+            return [models[chosen]] + [models[i] for i in rest]
+
+        def counts(run: int | None, v: int, a: int | None) -> tuple[int, int]:
+            if run is None:
+                return 0, 0
+            if a is None:
+                return int(correct[run, v].sum()), int(total[run, v].sum())
+            return int(correct[run, v, a]), int(total[run, v, a])
+
+        routes = {}
+        for v, level in enumerate(store.levels):
+            level_counts = [counts(run, v, None) for run in runs]
+            route = chain(level, [c for c, _ in level_counts], [t for _, t in level_counts])
+            if route is not None:
+                routes[(level, None)] = route
+            for a, label in enumerate(store.labels):
+                label_counts = [counts(run, v, a) for run in runs]
+                if min((t for _, t in label_counts if t), default=0) < min_support:
+                    continue
+                route = chain(level, [c for c, _ in label_counts], [t for _, t in label_counts])
+                if route is not None:
+                    routes[(level, label)] = route
+
+        overall = [counts(run, slice(None), None) for run in runs]
+        default = chain(None, [c for c, _ in overall], [t for _, t in overall]) or models
+        return cls(routes, default, budgets)
+
+    def describe(self) -> str:
+        lines = []
+        for (level, label), route in sorted(self.routes.items(), key=lambda item: (item[0][0], item[0][1] or "")):
+            budget = self.budgets.get(level)
+            name = f"{level} / {label}" if label is not None else f"{level}"
+            lines.append(f"  {name}: {' -> '.join(route)}" + (f" (max_tokens {budget})" if budget else ""))
+        lines.append(f"  other: {' -> '.join(self.default)}")
+        return "\n".join(lines)
+
+
+class SolverRouter(Agent):
+    """
+    Solve every problem with the model routed for its class, falling back along the chain of the class.
+    """
+
+    def __init__(self, solvers: dict, policy: RoutingPolicy) -> None:
+        """
+        Parameters
+        ----------
+        solvers: dict
+            {model: mathSolve}, one solver per model of the policy.
+        policy: RoutingPolicy
+            The routes and the token budgets.
+        """
+
+        super().__init__()
+
+        self.solvers = solvers
+        self.policy = policy
+        # The problems routed to every model, the problems solved by a fallback and those no model could answer
+        self.stats = {"routed": {model: 0 for model in solvers}, "fallbacks": 0, "unanswered": 0}
+
+    def _chain(self, level: str, label: str) -> tuple[list, dict | None]:
+        chain, budget = self.policy.route(level, label)
+        chain = [model for model in chain if model in self.solvers] or list(self.solvers)
+        self.stats["routed"][chain[0]] += 1
+        return chain, ({"max_tokens": budget} if budget else None)
+
+    def flowing(self, question: str, level: str = None, label: str = None) -> str:
+
+        chain, generate_args = self._chain(level, label)
+        result, last_error, returned = None, None, False
+        for position, model in enumerate(chain):
+            try:
+                result = self.solvers[model](question=question, generate_args=generate_args)
+            except Exception as error:
+                print(f"Routing: {model} failed ({type(error).__name__}: {error}).")
+                last_error = error
+                continue
+            returned = True
+            if _answered(result):
+                self.stats["fallbacks"] += position > 0
+                return result
+        if not returned and last_error is not None:
+            # Every model failed: let the runner see the error (e.g. park the problem while the endpoints are down).
+            raise last_error
+        self.stats["unanswered"] += 1
+        return result
+
+    async def aflowing(self, question: str, level: str = None, label: str = None) -> str:
+
+        chain, generate_args = self._chain(level, label)
+        result, last_error, returned = None, None, False
+        for position, model in enumerate(chain):
+            try:
+                result = await self.solvers[model].acall(question=question, generate_args=generate_args)
+            except Exception as error:
+                print(f"Routing: {model} failed ({type(error).__name__}: {error}).")
+                last_error = error
+                continue
+            returned = True
+            if _answered(result):
+                self.stats["fallbacks"] += position > 0
+                return result
+        if not returned and last_error is not None:
+            # Every model failed: let the runner see the error (e.g. park the problem while the endpoints are down).
+            raise last_error
+        self.stats["unanswered"] += 1
+        return result
+
+
+def _answered(result) -> bool:
+    """
+    Whether an answer can be extracted from a solution (`mathSolve` returns the content of its ```json block, or the
+    whole text when the block is missing).
+    """
+
+    return extract_answer(result) is not None
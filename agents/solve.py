@@ -9,10 +9,12 @@ from os import path
 
 sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
 
+import asyncio
 import numpy as np
 from xyz.node.agent import Agent
 from xyz.node.basic.llm_agent import LLMAgent
 from xyz.utils.llm.openai_client import OpenAIClient
+from agents.answer_checker import check_equivalence, normalize_answer
 import os
 import json
 import re
@@ -22,13 +24,135 @@ from dotenv import load_dotenv
 load_dotenv()
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 
+class _Ballot:
+    """
+    The candidate answers of one problem, grouped by equivalence.
+    """
+
+    def __init__(self) -> None:
+        # [answer, votes, solution of the first candidate]
+        self.clusters = []
+        self.first = None
+        # The candidates asked for, whether or not they came back, so the budget is always spent
+        self.drawn = 0
+
+    def add_draw(self, texts: list, count: int) -> None:
+        """
+        Record a draw of `count` candidates and add the `texts` which came back (possibly fewer).
+        """
+
+        self.drawn += count
+        for text in texts:
+            self.add(text)
+
+    def add(self, text: str) -> None:
+        if self.first is None:
+            self.first = text
+        answer = extract_answer(text)
+        if answer is None:
+            return
+        key = normalize_answer(answer)
+        for cluster in self.clusters:
+            if normalize_answer(cluster[0]) == key or check_equivalence(cluster[0], answer) is True:
+                cluster[1] += 1
+                return
+        self.clusters.append([answer, 1, text])
+
+    @property
+    def leader(self) -> list | None:
+        # max() keeps the first cluster on ties, i.e. the earliest answer
+        return max(self.clusters, key=lambda cluster: cluster[1]) if self.clusters else None
+
+    def to_draw(self, samples: int, consensus: int) -> int:
+        """
+        The number of candidates to ask for next: the least which could bring the leader to the consensus, 0 once it
+        is reached or the budget is spent.
+        """
+
+        votes = self.leader[1] if self.clusters else 0
+        if votes >= consensus:
+            return 0
+        return max(0, min(consensus - votes, samples - self.drawn))
+
+    def result(self) -> str:
+        return self.leader[2] if self.clusters else self.first
+
+
+def extract_answer(text: str) -> str | None:
+    """
+    Extract the "answer" field of a solution in the SOLUTION format, None if there is none.
+    """
+
+    if not isinstance(text, str):
+        return None
+    match = re.search(r'```json(.*?)```', text, re.DOTALL)
+    block = match.group(1) if match else text
+    try:
+        answer = json.loads(block).get("answer")
+        return None if answer is None else str(answer)
+    except (ValueError, AttributeError):
+        pass
+    # The model often leaves a trailing comma in the JSON block
+    match = re.search(r'"answer"\s*:\s*"((?:[^"\\]|\\.)*)"', block)
+    if match is None:
+        return None
+    try:
+        return json.loads('"' + match.group(1) + '"')
+    except ValueError:
+        return match.group(1)
+
+
+def answer_complete(text: str) -> bool:
+    """
+    Whether a streamed solution already contains its closed ```json block.
+    """
+
+    start = text.find("```json")
+    return start >= 0 and text.find("```", start + 7) >= 0
+
+
 class mathSolve(Agent):
-    def __init__(self):
+    def __init__(self, llm_client: OpenAIClient = None, samples: int = 1, consensus: int = 2,
+                 temperature: float = 0.7, use_n: bool = True, stream: bool = False, **client_args):
+        """
+        Parameters
+        ----------
+        llm_client: OpenAIClient, optional
+            The client used to solve the problems. By default, gpt-4-turbo-2024-04-09 at temperature 0.
+        samples: int, optional
+            The maximum number of candidate solutions per problem, by default 1 (a single deterministic call). With
+            more than one sample, the answer is chosen by majority vote (self-consistency).
+        consensus: int, optional
+            The number of equivalent answers after which the vote stops early, by default 2. The first request asks
+            for `consensus` candidates, the next ones for the fewest which could still reach it.
+        temperature: float, optional
+            The sampling temperature of the voting mode, by default 0.7.
+        use_n: bool, optional
+            Whether to ask for several candidates in one request with the `n` parameter, by default True. Set it to
+            False for the providers which do not support it.
+        stream: bool, optional
+            Whether to stream the single-sample solutions and close the stream as soon as the ```json block is
+            complete, by default False. It saves the time and the tokens of the text models add after the answer.
+        client_args: dict, optional
+            Extra arguments of the default client, e.g. `cache`. They are ignored if `llm_client` is given.
+        """
         
         super().__init__()  
 
-        self.openai_agent = OpenAIClient(api_key=OPENAI_API_KEY, model='gpt-4-turbo-2024-04-09', temperature=0., top_p=0.8)
+        if llm_client is None:
+            client_args = {"model": 'gpt-4-turbo-2024-04-09', "temperature": 0., "top_p": 0.8, **client_args}
+            llm_client = OpenAIClient(api_key=OPENAI_API_KEY, **client_args)
+        self.openai_agent = llm_client
         self.llm_evaluate_agent = LLMAgent(SOLUTION, self.openai_agent, stream=False)
+        self.llm_vote_agent = LLMAgent(SOLUTION, self.openai_agent, stream=False, original_response=True)
+        self.llm_stream_agent = LLMAgent(SOLUTION, self.openai_agent, stream=True, stop_when=answer_complete)
+        self.stream = stream
+        self.samples = samples
+        self.consensus = max(1, min(consensus, samples))
+        self.temperature = temperature
+        self.use_n = use_n
+        # The cost of the voting mode: problems, requests, candidates and problems stopped before the budget
+        self.stats = {"problems": 0, "requests": 0, "samples": 0, "early_stops": 0}
 
     def extract_dict_from_json(self,text: str):
         """
@@ -39,10 +163,39 @@ class mathSolve(Agent):
 
         return extracted_text[0].strip() 
 
-    def flowing(self, question: str) -> str:
+    def flowing(self, question: str, generate_args: dict = None) -> str:
+        """
+        Solve a problem. `generate_args` override the arguments of the client for this problem, e.g. a token budget
+        {"max_tokens": 1024}; they are not applied in the streaming mode.
+        """
 
-        
-        result = self.llm_evaluate_agent(question=question)
+        if self.samples > 1:
+            ballot = _Ballot()
+            while count := ballot.to_draw(self.samples, self.consensus):
+                ballot.add_draw(self._sample(question, count, generate_args), count)
+            result = self._close(ballot)
+        elif self.stream:
+            result = "".join(self.llm_stream_agent(question=question))
+        else:
+            result = self.llm_evaluate_agent(question=question, generate_args=generate_args)
+        try:
+            result = self.extract_dict_from_json(result)
+        except:
+            pass
+
+        return result
+
+    async def aflowing(self, question: str, generate_args: dict = None) -> str:
+
+        if self.samples > 1:
+            ballot = _Ballot()
+            while count := ballot.to_draw(self.samples, self.consensus):
+                ballot.add_draw(await self._asample(question, count, generate_args), count)
+            result = self._close(ballot)
+        elif self.stream:
+            result = await asyncio.to_thread(lambda: "".join(self.llm_stream_agent(question=question)))
+        else:
+            result = await self.llm_evaluate_agent.acall(question=question, generate_args=generate_args)
         try:
             result = self.extract_dict_from_json(result)
         except:
@@ -50,6 +203,46 @@ class mathSolve(Agent):
 
         return result
 
+    def _sample(self, question: str, count: int, generate_args: dict = None) -> list:
+        """
+        Draw `count` candidate solutions, in one request if `use_n`.
+        """
+
+        generate_args = {**(generate_args or {}), "temperature": self.temperature}
+        if self.use_n:
+            self.stats["requests"] += 1
+            response = self.llm_vote_agent(question=question, generate_args={**generate_args, "n": count})
+            return [choice.message.content for choice in response.choices]
+
+        self.stats["requests"] += count
+        return [self.llm_vote_agent(question=question, generate_args=generate_args).choices[0].message.content
+                for _ in range(count)]
+
+    async def _asample(self, question: str, count: int, generate_args: dict = None) -> list:
+        """
+        The async counterpart of `_sample`. Without `use_n`, the requests are sent concurrently.
+        """
+
+        generate_args = {**(generate_args or {}), "temperature": self.temperature}
+        if self.use_n:
+            self.stats["requests"] += 1
+            response = await self.llm_vote_agent.acall(question=question, generate_args={**generate_args, "n": count})
+            return [choice.message.content for choice in response.choices]
+
+        self.stats["requests"] += count
+        responses = await asyncio.gather(*[
+            self.llm_vote_agent.acall(question=question, generate_args=generate_args)
+            for _ in range(count)
+        ])
+        return [response.choices[0].message.content for response in responses]
+
+    def _close(self, ballot: _Ballot) -> str:
+        self.stats["problems"] += 1
+        self.stats["samples"] += ballot.drawn
+        if ballot.drawn < self.samples:
+            self.stats["early_stops"] += 1
+        return ballot.result()
+
 
 SOLUTION = [
     {
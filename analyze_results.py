@@ -0,0 +1,122 @@
+import argparse
+import glob
+import json
+
+import numpy as np
+
+from xyz.utils.data.results import load_results
+
+
+def _percent(value):
+    return "    -" if np.isnan(value) else f"{value * 100:5.1f}"
+
+
+def _present(store):
+    """The codes of the models with at least one result."""
+    return np.flatnonzero(store.counts(("model",))[1] > 0)
+
+
+def print_accuracy(store, by):
+    """Print the accuracy of every model, broken down by the other columns of by (e.g. level)."""
+    if by == ("model",):
+        correct, total = store.counts(("model",))
+        for m in _present(store):
+            model = store.models[m]
+            print(f"  {model}: {_percent(correct[m] / total[m] if total[m] else np.nan)}% ({correct[m]}/{total[m]})")
+        return
+
+    correct, total = store.counts(by)
+    accuracy = store.accuracy(by)
+    columns = [store.categories(column) for column in by[1:]]
+    names = [" - ".join(values) for values in np.array(np.meshgrid(*columns, indexing="ij")).reshape(len(by) - 1, -1).T]
+    keep = total.reshape(len(store.models), -1).sum(axis=0) > 0
+    names = [name for name, kept in zip(names, keep) if kept]
+    width = max([len(model) for model in store.models] + [5])
+    widths = [max(len(name), 7) for name in names]
+    print(" " * (width + 2) + "  ".join(f"{name:>{w}}" for name, w in zip(names, widths)))
+    for m in _present(store):
+        row = accuracy[m].reshape(-1)[keep]
+        print(f"  {store.models[m]:<{width}}" + "  ".join(f"{_percent(value) + '%':>{w}}"
+                                                         for value, w in zip(row, widths)))
+
+
+def print_deltas(store, bootstrap):
+    """Print the pairwise accuracy differences, with their confidence intervals if bootstrapped."""
+    delta, common = store.deltas()
+    for i in _present(store):
+        for j in _present(store):
+            if j <= i or common[i, j] == 0:
+                continue
+            first, second = store.models[i], store.models[j]
+            line = f"  {first} - {second}: {delta[i, j] * 100:+.1f} points on {common[i, j]} problems"
+            if bootstrap is not None:
+                low, high = bootstrap["delta_low"][i, j], bootstrap["delta_high"][i, j]
+                significant = "*" if low > 0 or high < 0 else ""
+                line += f" [{low * 100:+.1f}, {high * 100:+.1f}]{significant}"
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Accuracy tables, model deltas and bootstrap confidence intervals "
+                                                 "of the evaluation results.")
+    parser.add_argument("files", nargs="*", help="The result files (default: jsonl/eval/result-*.jsonl).")
+    parser.add_argument("--store", default=".cache/results.npz",
+                        help="The columnar store, only the new or changed files are re-imported.")
+    parser.add_argument("--by", default="model,level",
+                        help="The comma-separated columns of the accuracy table: model, label and/or level.")
+    parser.add_argument("--label", action="append", default=None, help="Only use the problems with this label.")
+    parser.add_argument("--level", action="append", default=None, help="Only use the problems of this level.")
+    parser.add_argument("--model", action="append", default=None, help="Only use this run (repeatable).")
+    parser.add_argument("--deltas", action="store_true", help="Print the pairwise accuracy differences.")
+    parser.add_argument("--bootstrap", type=int, default=0, metavar="N",
+                        help="Add paired bootstrap confidence intervals with N samples.")
+    parser.add_argument("--confidence", type=float, default=0.95, help="The confidence level of the intervals.")
+    parser.add_argument("--json", default=None, help="Also write the tables to this JSON file.")
+    args = parser.parse_args()
+
+    store = load_results(args.files or sorted(glob.glob("jsonl/eval/result-*.jsonl")), store_path=args.store)
+    filters = {column: values for column, values in (("label", args.label), ("level", args.level),
+                                                      ("model", args.model)) if values}
+    if filters:
+        store = store.select(**filters)
+    unclean = int((~store.columns["clean"]).sum())
+    print(f"{len(store)} results of {len(_present(store))} runs ({unclean} verbose verdicts parsed).")
+
+    by = tuple(column.strip() for column in args.by.split(","))
+    if by[0] != "model":
+        by = ("model",) + tuple(column for column in by if column != "model")
+    print(f"\nAccuracy by {', '.join(by)} (%):")
+    print_accuracy(store, by)
+
+    bootstrap = None
+    if args.bootstrap:
+        bootstrap = store.bootstrap(samples=args.bootstrap, confidence=args.confidence)
+        print(f"\nAccuracy with {args.confidence:.0%} bootstrap intervals ({args.bootstrap} samples):")
+        for m in _present(store):
+            print(f"  {store.models[m]}: {_percent(bootstrap['accuracy'][m])}% "
+                  f"[{_percent(bootstrap['low'][m])}, {_percent(bootstrap['high'][m])}]")
+
+    if args.deltas:
+        print("\nPairwise deltas (row - column, * if the interval excludes 0):" if bootstrap else "\nPairwise deltas:")
+        print_deltas(store, bootstrap)
+
+    if args.json is not None:
+        correct, total = store.counts(by)
+        delta, common = store.deltas()
+        tables = {
+            "by": list(by),
+            "categories": {column: store.categories(column) for column in by},
+            "correct": correct.tolist(),
+            "total": total.tolist(),
+            "models": store.models,
+            "delta": np.where(np.isnan(delta), None, delta).tolist(),
+            "common": common.tolist(),
+        }
+        if bootstrap is not None:
+            tables["bootstrap"] = {key: np.where(np.isnan(value), None, value).tolist()
+                                   for key, value in bootstrap.items()}
+        with open(args.json, "w") as file:
+            json.dump(tables, file, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""
+==============
+bench_pipeline
+==============
+@file_name: bench_pipeline.py
+@description:
+An end-to-end benchmark of the solving and judging pipeline against the local `MockLLMServer`, over the real dataset.
+
+For every concurrency level, the benchmark runs:
+1. `solve-threads`: `mathSolve` called synchronously by the `AsyncRunner` (one worker thread per request in flight).
+2. `solve-async`: `generate_response.process_math_problems`, which awaits `mathSolve.acall` on the event loop.
+3. `judge-async`: `Evalutor.acall` (without the local checker) over the answers of step 2, at most `concurrency` at a
+    time.
+and, once, `evaluate`: `evaluate_response.process_files` (sequential, with the local checker) over the same answers.
+
+It reports the throughput, the p50/p95/p99 latency of the LLM calls, the number of requests and retries, the peak of
+concurrent requests seen by the server and the memory (peak RSS, and the peak Python heap with `--tracemalloc`).
+
+## Usage
+```
+python benchmarks/bench_pipeline.py --concurrency 1,8,32 --latency 0.2 --rate-limit 0.01
+python benchmarks/bench_pipeline.py --latency 0 --limit 100   # the overhead of the pipeline itself
+```
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.mock_server import MockLLMServer, load_answers
+
+DATASET = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                       "final-odyssey-math-with-levels.jsonl")
+
+
+def _write_subset(dataset: str, limit: int | None, path: str) -> int:
+    """
+    Copy the first `limit` problems of the dataset to `path` and return their number.
+    """
+
+    count = 0
+    with open(dataset, 'r') as infile, open(path, 'w') as outfile:
+        for line in itertools.islice((line for line in infile if line.strip()), limit):
+            outfile.write(line)
+            count += 1
+    return count
+
+
+class Measurement:
+    """
+    Measure one scenario: wall time, LLM call latencies (from the telemetry), server requests and memory.
+    """
+
+    def __init__(self, name: str, concurrency: int | None, items: int, server: MockLLMServer,
+                 trace_memory: bool) -> None:
+        self.name = name
+        self.concurrency = concurrency
+        self.items = items
+        self.server = server
+        self.trace_memory = trace_memory
+
+    def __enter__(self) -> "Measurement":
+        from xyz.utils.llm.telemetry import configure_telemetry
+
+        self.telemetry = configure_telemetry()
+        self.requests_before = self.server.stats["requests"]
+        self.server.stats["peak_in_flight"] = 0
+        if self.trace_memory:
+            tracemalloc.start()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.wall = time.perf_counter() - self.start
+        self.heap_peak = None
+        if self.trace_memory:
+            self.heap_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    def result(self) -> dict:
+        from xyz.utils.llm.telemetry import percentile
+
+        calls = [r for r in self.telemetry.records if r["source"] == "openai" and not r.get("cached")]
+        latencies = sorted(r["latency"] for r in calls if r["latency"] is not None)
+        return {
+            "scenario": self.name,
+            "concurrency": self.concurrency,
+            "items": self.items,
+            "wall_s": round(self.wall, 3),
+            "items_per_s": round(self.items / self.wall, 2) if self.wall else None,
+            "llm_calls": len(calls),
+            "requests": self.server.stats["requests"] - self.requests_before,
+            "retries": sum(max(0, (r["attempts"] or 0) - 1) for r in calls),
+            "errors": sum(1 for r in calls if r["error"] is not None),
+            "p50_s": _round(percentile(latencies, 50)),
+            "p95_s": _round(percentile(latencies, 95)),
+            "p99_s": _round(percentile(latencies, 99)),
+            "server_peak_in_flight": self.server.stats["peak_in_flight"],
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024., 1),
+            "heap_peak_mb": round(self.heap_peak / 2 ** 20, 1) if self.heap_peak is not None else None,
+        }
+
+
+def _round(value: float | None) -> float | None:
+    return None if value is None else round(value, 3)
+
+
+def _clean_predictions(path: str, clean_path: str) -> list:
+    """
+    Extract the answers of a solver output into `clean_path` (the `jsonl/clean` layout) and return the
+    (question, true, prediction) items joined with the dataset.
+    """
+
+    from agents.solve import extract_answer
+    from evaluate_response import iter_joined
+
+    with open(path, 'r') as infile, open(clean_path, 'w') as outfile:
+        for line in infile:
+            for problem_id, solution in json.loads(line).items():
+                outfile.write(json.dumps({problem_id: {"answer": extract_answer(solution)}}) + "\n")
+
+    items = []
+    for _, true_info, pred in iter_joined(DATASET, clean_path):
+        items.append({"question": true_info["question"], "true": true_info["answer"], "prediction": pred["answer"]})
+    return items
+
+
+def run(concurrency_levels: list, limit: int | None, server: MockLLMServer, trace_memory: bool) -> list:
+    import generate_response
+    import evaluate_response
+    from agents.evaluate import Evalutor
+    from agents.solve import mathSolve
+    from xyz.utils.runner import AsyncRunner
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        dataset = os.path.join(directory, "dataset.jsonl")
+        items = _write_subset(DATASET, limit, dataset)
+        predictions = None
+
+        for concurrency in concurrency_levels:
+            output = os.path.join(directory, f"threads-{concurrency}.jsonl")
+            solver = mathSolve()
+            with Measurement("solve-threads", concurrency, items, server, trace_memory) as measurement:
+                AsyncRunner(lambda problem: solver(question=problem["question"]),
+                            concurrency=concurrency).run(dataset, output)
+            results.append(measurement.result())
+
+            output = os.path.join(directory, f"async-{concurrency}.jsonl")
+            with Measurement("solve-async", concurrency, items, server, trace_memory) as measurement:
+                generate_response.process_math_problems(dataset, output, concurrency=concurrency)
+            results.append(measurement.result())
+
+            predictions = os.path.join(directory, f"clean-{concurrency}.jsonl")
+            judge_items = _clean_predictions(output, predictions)
+            evaluator = Evalutor(local_check=False)
+
+            async def judge() -> None:
+                semaphore = asyncio.Semaphore(concurrency)
+
+                async def one(item: dict) -> str:
+                    async with semaphore:
+                        return await evaluator.acall(**item)
+
+                await asyncio.gather(*[one(item) for item in judge_items])
+
+            with Measurement("judge-async", concurrency, len(judge_items), server, trace_memory) as measurement:
+                asyncio.run(judge())
+            results.append(measurement.result())
+
+        if predictions is not None:
+            output = os.path.join(directory, "result.jsonl")
+            with Measurement("evaluate", None, items, server, trace_memory) as measurement:
+                evaluate_response.process_files(dataset, predictions, output_file=output)
+            results.append(measurement.result())
+
+    return results
+
+
+def print_table(results: list) -> None:
+    columns = ["scenario", "concurrency", "items", "wall_s", "items_per_s", "llm_calls", "requests", "retries",
+               "errors", "p50_s", "p95_s", "p99_s", "server_peak_in_flight", "peak_rss_mb", "heap_peak_mb"]
+    widths = {column: max(len(column), *(len(str(row[column])) for row in results)) for column in columns}
+    print("  ".join(column.rjust(widths[column]) for column in columns))
+    for row in results:
+        print("  ".join(str(row[column]).rjust(widths[column]) for column in columns))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline against a local mock LLM server.")
+    parser.add_argument("--concurrency", default="1,8,32", help="The comma-separated concurrency levels.")
+    parser.add_argument("--limit", type=int, default=None, help="Only use the first N problems (default: all).")
+    parser.add_argument("--latency", type=float, default=0.2, help="The median latency of the mock in seconds.")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="The sigma of the log-normal latency.")
+    parser.add_argument("--error-rate", type=float, default=0., help="The fraction of 500 responses.")
+    parser.add_argument("--rate-limit", type=float, default=0., help="The fraction of 429 responses.")
+    parser.add_argument("--retry-after", type=float, default=0.5, help="The Retry-After of the 429 responses.")
+    parser.add_argument("--tracemalloc", action="store_true", help="Measure the peak Python heap (slower).")
+    parser.add_argument("--json", default=None, help="Also write the results to this JSON file.")
+    args = parser.parse_args()
+
+    server = MockLLMServer(latency=args.latency, latency_sigma=args.latency_sigma, error_rate=args.error_rate,
+                           rate_limit_rate=args.rate_limit, retry_after=args.retry_after,
+                           answers=load_answers(DATASET), seed=0)
+    with server:
+        # Every client of the pipeline reads its endpoint from the environment.
+        os.environ["OPENAI_BASE_URL"] = server.url
+        os.environ["OPENAI_API_KEY"] = "mock"
+        results = run([int(level) for level in args.concurrency.split(",")], args.limit, server, args.tracemalloc)
+
+    print_table(results)
+    if args.json is not None:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,373 @@
+"""
+=============
+MockLLMServer
+=============
+@file_name: mock_server.py
+@description:
+This module implements a local stand-in for the LLM providers used by the repository, so the pipeline can be measured
+without network or cost.
+
+## Features of the MockLLMServer include:
+1. OpenAI-Compatible Endpoints: `POST /v1/chat/completions` and `POST /v1/completions`, with `n` and with `stream`
+    (server-sent events). Any other `POST` path answers like the `Llama3APIClient` endpoint (`{"text": ...}`).
+2. Plausible Answers: A solver prompt receives a ```json block with the answer of the problem (looked up in the dataset,
+    right with probability `accuracy`), a judge prompt a score, a batch judge prompt an array of scores, and a cascade
+    (cheap) judge prompt a score with a random confidence.
+3. Fault Injection: The latency follows a log-normal distribution (optionally plus a per-token time), and a fraction of
+    the requests fail with 500 or with 429 and a `Retry-After` header.
+4. Statistics: `stats` counts the requests per path and status and the peak of concurrent requests.
+
+## Usage
+```python
+with MockLLMServer(latency=0.5, rate_limit_rate=0.02) as server:
+    client = OpenAIClient(api_key="mock", base_url=server.url)
+```
+or from the command line: `python benchmarks/mock_server.py --port 8000 --latency 0.5`.
+
+## Motivation
+The concurrency, caching and retry machinery can only be tuned against a provider whose behaviour is known and free.
+"""
+
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+__all__ = ["MockLLMServer", "load_answers"]
+
+_QUESTION = re.compile(r"Here is the question: (.*)\.\s*$", re.DOTALL)
+_BATCH = re.compile(r"exactly (\d+) scores")
+
+
+def load_answers(dataset: str) -> dict:
+    """
+    Map every question of a dataset in the `final-odyssey-math-with-levels.jsonl` layout to its answer.
+    """
+
+    answers = {}
+    with open(dataset, 'r') as file:
+        for line in file:
+            if line.strip():
+                for info in json.loads(line).values():
+                    answers[info["question"].strip()] = info["answer"]
+    return answers
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "_Server"
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_POST(self) -> None:
+        mock = self.server.mock
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        mock._enter(self.path)
+        try:
+            try:
+                request = json.loads(body or b"{}")
+            except ValueError:
+                self._send_json(400, {"error": {"message": "invalid JSON"}})
+                return
+
+            fault = mock._fault()
+            time.sleep(mock._latency())
+            if fault == 429:
+                self._send_json(429, {"error": {"message": "rate limited", "type": "rate_limit"}},
+                                {"Retry-After": f"{mock.retry_after:g}"})
+                return
+            if fault == 500:
+                self._send_json(500, {"error": {"message": "internal error", "type": "server_error"}})
+                return
+
+            if self.path.endswith("/chat/completions"):
+                self._chat(request, chat=True)
+            elif self.path.endswith("/completions"):
+                self._chat(request, chat=False)
+            else:
+                prompt = json.dumps(request.get("messages", request.get("inputs", "")))
+                self._send_json(200, {"text": mock.reply(prompt)})
+        finally:
+            mock._exit()
+
+    def _chat(self, request: dict, chat: bool) -> None:
+        mock = self.server.mock
+        if chat:
+            messages = request.get("messages", [])
+            prompt = "\n".join(m["content"] if isinstance(m.get("content"), str) else json.dumps(m.get("content"))
+                               for m in messages)
+        else:
+            prompt = str(request.get("prompt", ""))
+        choices = [mock.reply(prompt) for _ in range(int(request.get("n") or 1))]
+        model = request.get("model", "mock")
+        prompt_tokens = max(1, len(prompt) // 4)
+        completion_tokens = sum(max(1, len(text) // 4) for text in choices)
+        created = int(time.time())
+        kind = "chat.completion" if chat else "text_completion"
+
+        if request.get("stream"):
+            self._stream(choices, model, created, kind, chat)
+            return
+
+        if chat:
+            payload_choices = [{"index": i, "finish_reason": "stop", "logprobs": None,
+                                "message": {"role": "assistant", "content": text}} for i, text in enumerate(choices)]
+        else:
+            payload_choices = [{"index": i, "finish_reason": "stop", "logprobs": None, "text": text}
+                               for i, text in enumerate(choices)]
+        self._send_json(200, {
+            "id": f"mock-{random.getrandbits(32):08x}", "object": kind, "created": created, "model": model,
+            "choices": payload_choices,
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        })
+
+    def _stream(self, choices: list, model: str, created: int, kind: str, chat: bool) -> None:
+        mock = self.server.mock
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        base = {"id": f"mock-{random.getrandbits(32):08x}", "object": f"{kind}.chunk", "created": created,
+                "model": model}
+
+        def event(index: int, text: str | None, finish_reason: str = None) -> None:
+            if chat:
+                delta = {"content": text} if text is not None else {}
+                choice = {"index": index, "delta": delta, "finish_reason": finish_reason}
+            else:
+                choice = {"index": index, "text": text or "", "finish_reason": finish_reason}
+            self.wfile.write(b"data: " + json.dumps({**base, "choices": [choice]}).encode() + b"\n\n")
+            self.wfile.flush()
+
+        try:
+            if chat:
+                self.wfile.write(b"data: " + json.dumps({**base, "choices": [
+                    {"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}]}).encode()
+                                 + b"\n\n")
+            for index, text in enumerate(choices):
+                for start in range(0, len(text), mock.chunk_size):
+                    event(index, text[start:start + mock.chunk_size])
+                    if mock.token_time:
+                        time.sleep(mock.token_time * mock.chunk_size / 4)
+                event(index, None, "stop")
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client closed the stream early, e.g. once it has the answer.
+            mock._count("stream_closed_early")
+
+    def _send_json(self, status: int, payload: dict, headers: dict = None) -> None:
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        try:
+            self.end_headers()
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up on the request, e.g. the loser of a hedged request was cancelled.
+            self.server.mock._count(f"{self.path} cancelled")
+            return
+        self.server.mock._count(f"{self.path} {status}")
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+    mock: "MockLLMServer"
+
+
+class MockLLMServer:
+    """
+    A local OpenAI-compatible and Llama-compatible HTTP server with configurable latency and failures.
+    """
+    latency: float
+    latency_sigma: float
+    token_time: float
+    error_rate: float
+    rate_limit_rate: float
+    retry_after: float
+    accuracy: float
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.2, latency_sigma: float = 0.5,
+                 token_time: float = 0., error_rate: float = 0., rate_limit_rate: float = 0.,
+                 retry_after: float = 1., accuracy: float = 0.7, answers: dict = None, reasoning_words: int = 150,
+                 chunk_size: int = 16, seed: int = None) -> None:
+        """
+        Parameters
+        ----------
+        host: str, optional
+            The interface to listen on, by default 127.0.0.1.
+        port: int, optional
+            The port, by default 0 (any free port, see `url`).
+        latency: float, optional
+            The median latency of a request in seconds, by default 0.2.
+        latency_sigma: float, optional
+            The sigma of the log-normal latency distribution, by default 0.5 (0 for a constant latency).
+        token_time: float, optional
+            The time per streamed token in seconds, by default 0.
+        error_rate: float, optional
+            The fraction of requests failing with 500, by default 0.
+        rate_limit_rate: float, optional
+            The fraction of requests failing with 429, by default 0.
+        retry_after: float, optional
+            The `Retry-After` of the 429 responses in seconds, by default 1.
+        accuracy: float, optional
+            The probability that the mock solver gives the dataset answer, by default 0.7.
+        answers: dict, optional
+            The answers of the questions (see `load_answers`), by default None (the solver answers "0").
+        reasoning_words: int, optional
+            The length of the mock reasoning, by default 150 words.
+        chunk_size: int, optional
+            The number of characters per streamed chunk, by default 16.
+        seed: int, optional
+            The seed of the random generator.
+        """
+
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.token_time = token_time
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.accuracy = accuracy
+        self.answers = answers or {}
+        self.reasoning_words = reasoning_words
+        self.chunk_size = chunk_size
+        self.random = random.Random(seed)
+
+        self.stats = {"requests": 0, "in_flight": 0, "peak_in_flight": 0}
+        self._lock = threading.Lock()
+        self._server = _Server((host, port), _Handler)
+        self._server.mock = self
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        """
+        The base URL of the OpenAI-compatible API, e.g. "http://127.0.0.1:8000/v1".
+        """
+
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "MockLLMServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "MockLLMServer":
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+    def reply(self, prompt: str) -> str:
+        """
+        The mock answer to a prompt.
+        """
+
+        batch = _BATCH.search(prompt)
+        if batch:
+            return json.dumps([self._score() for _ in range(int(batch.group(1)))])
+        if '"confidence"' in prompt:
+            # The cheap judge of the cascade.
+            with self._lock:
+                confidence = round(self.random.uniform(0.5, 1.), 2)
+            return json.dumps({"score": self._score(), "confidence": confidence})
+        if "student answer" in prompt.lower():
+            return str(self._score())
+
+        match = _QUESTION.search(prompt)
+        question = match.group(1).strip() if match else None
+        answer = self.answers.get(question, "0") if question is not None else "0"
+        with self._lock:
+            if self.random.random() >= self.accuracy:
+                answer = f"{answer} + 1"
+        reasoning = " ".join(["step"] * self.reasoning_words)
+        return f"```json\n{json.dumps({'reasoning': reasoning, 'answer': answer})}\n```"
+
+    def _score(self) -> int:
+        with self._lock:
+            return int(self.random.random() < self.accuracy)
+
+    def _latency(self) -> float:
+        if self.latency <= 0:
+            return 0.
+        if self.latency_sigma <= 0:
+            return self.latency
+        with self._lock:
+            return self.latency * math.exp(self.random.gauss(0., self.latency_sigma))
+
+    def _fault(self) -> int | None:
+        with self._lock:
+            draw = self.random.random()
+        if draw < self.rate_limit_rate:
+            return 429
+        if draw < self.rate_limit_rate + self.error_rate:
+            return 500
+        return None
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.stats[name] = self.stats.get(name, 0) + 1
+
+    def _enter(self, path: str) -> None:
+        with self._lock:
+            self.stats["requests"] += 1
+            self.stats["in_flight"] += 1
+            self.stats["peak_in_flight"] = max(self.stats["peak_in_flight"], self.stats["in_flight"])
+
+    def _exit(self) -> None:
+        with self._lock:
+            self.stats["in_flight"] -= 1
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Serve a mock OpenAI-compatible and Llama-compatible API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.2, help="The median latency in seconds.")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="The sigma of the log-normal latency.")
+    parser.add_argument("--token-time", type=float, default=0., help="The time per streamed token in seconds.")
+    parser.add_argument("--error-rate", type=float, default=0., help="The fraction of 500 responses.")
+    parser.add_argument("--rate-limit", type=float, default=0., help="The fraction of 429 responses.")
+    parser.add_argument("--retry-after", type=float, default=1., help="The Retry-After of the 429 responses.")
+    parser.add_argument("--accuracy", type=float, default=0.7, help="The accuracy of the mock solver and judge.")
+    parser.add_argument("--dataset", default="final-odyssey-math-with-levels.jsonl",
+                        help="The dataset used to answer the questions.")
+    args = parser.parse_args()
+
+    try:
+        answers = load_answers(args.dataset)
+    except OSError:
+        answers = {}
+    server = MockLLMServer(host=args.host, port=args.port, latency=args.latency, latency_sigma=args.latency_sigma,
+                           token_time=args.token_time, error_rate=args.error_rate, rate_limit_rate=args.rate_limit,
+                           retry_after=args.retry_after, accuracy=args.accuracy, answers=answers)
+    print(f"Serving the mock API on {server.url} (Ctrl+C to stop).")
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server._server.server_close()
+        print(json.dumps(server.stats))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,51 +1,388 @@
+import argparse
+import asyncio
+import contextlib
 import json
+import os
+from agents.cascade import CheapJudge
 from agents.evaluate import Evalutor
+from agents.llama_client import Llama3APIClient
+from agents.ledger import VerdictLedger
+from xyz.utils.llm.cache import ResponseCache
+from xyz.utils.checkpoint import CheckpointWriter
+from xyz.utils.data.dataset import JsonlStore
+from xyz.utils.data.results import ResultsStore
+from xyz.utils.llm.circuit_breaker import Failover
+from xyz.utils.llm.hedging import HedgingPolicy
+from xyz.utils.llm.openai_client import OpenAIClient
+from xyz.utils.llm.singleflight import SingleFlight
+from xyz.utils.llm.telemetry import configure_telemetry
+from xyz.utils.tracing import configure_tracing
+from xyz.utils.runner import AsyncRunner
+from xyz.utils.sharding import merge_parts, parse_shard, part_path, shard_of
 
-def load_jsonl(filename):
-    """Load JSONL file and return a list of dictionaries."""
-    with open(filename, 'r') as file:
-        return [json.loads(line) for line in file]
-
-def save_jsonl(data, filename):
-    """Save a list of dictionaries to a JSONL file."""
-    with open(filename, 'w') as file:
-        for entry in data:
-            file.write(json.dumps(entry) + '\n')
-
-def process_files(file_true, file_pred):
-    """Process files to compare true and predicted answers and save results."""
-    true_answers = load_jsonl(file_true)
-    predicted_answers = load_jsonl(file_pred)
-    evalution = Evalutor()
-
-    results = []
-    for true, pred in zip(true_answers, predicted_answers):
-        problem_id = list(true.keys())[0]
-        true_info = true[problem_id]
-        
-        pred_answer = pred[problem_id]["answer"]
-
-        comparison_result = evalution(question=true_info["question"], true=true_info["answer"], prediction=pred_answer)
-
-        result_data = {
-            problem_id: {
-                "true": true_info["answer"],
-                "prediction": pred_answer,
-                "is_correct": comparison_result,
-                "label": true_info["label"],
-                "level": true_info["level"],  
-            }
+def iter_joined(file_true, file_pred, report=None, shard=None):
+    """Stream the predictions and join each one with its ground truth by problem id.
+
+    Yields (problem_id, true_info, pred_value) in the order of the prediction file. Only complete lines are read, so a
+    prediction file which is still being written can be evaluated. Predictions without a ground truth ("extra") and
+    repeated ids ("duplicate", the first one wins) are skipped, and so are the lines which are not a JSON object
+    ("corrupt", counted). The ground-truth ids never seen are reported as "missing". The counts and ids are stored in
+    the report dict if given. With shard=(k, N), only the problems of
+    shard k of N are joined (and reported).
+    """
+    report = report if report is not None else {}
+    report.update({"joined": 0, "extra": [], "duplicate": [], "missing": [], "corrupt": 0})
+    store = JsonlStore(file_true)
+    seen = set()
+
+    with store, open(file_pred, 'rb') as pred_file:
+        for line in pred_file:
+            if not line.endswith(b'\n') or not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                record = None
+            if not isinstance(record, dict):
+                report["corrupt"] += 1
+                continue
+            for problem_id, pred_value in record.items():
+                if shard is not None and shard_of(problem_id, shard[1]) != shard[0]:
+                    continue
+                if problem_id not in store:
+                    report["extra"].append(problem_id)
+                    continue
+                if problem_id in seen:
+                    report["duplicate"].append(problem_id)
+                    continue
+                seen.add(problem_id)
+                true_info = store[problem_id]
+                report["joined"] += 1
+                yield problem_id, true_info, pred_value
+
+    report["missing"] = [problem_id for problem_id in store if problem_id not in seen
+                         and (shard is None or shard_of(problem_id, shard[1]) == shard[0])]
+
+def iter_results(file_true, file_pred, evalution, skip=(), report=None, batch_size=1, shard=None):
+    """Judge the joined predictions and yield the result rows.
+
+    With batch_size > 1, the predictions are judged in groups of batch_size with evalution.judge_batch, so a group of
+    undecided answers costs a single judge request.
+    """
+    pending = []
+    for problem_id, true_info, pred in iter_joined(file_true, file_pred, report, shard=shard):
+        if problem_id in skip:
+            continue
+
+        pred_answer = pred.get("answer") if isinstance(pred, dict) else pred
+        if batch_size <= 1:
+            comparison_result = evalution(question=true_info["question"], true=true_info["answer"],
+                                          prediction=pred_answer)
+            yield _result_row(problem_id, true_info, pred_answer, comparison_result)
+            continue
+
+        pending.append((problem_id, true_info, pred_answer))
+        if len(pending) == batch_size:
+            yield from _judge_pending(evalution, pending)
+            pending = []
+
+    if pending:
+        yield from _judge_pending(evalution, pending)
+
+def _judge_pending(evalution, pending):
+    """Judge a group of (problem_id, true_info, pred_answer) with one batch call and yield their result rows."""
+    verdicts = evalution.judge_batch([
+        {"question": true_info["question"], "true": true_info["answer"], "prediction": pred_answer}
+        for _, true_info, pred_answer in pending
+    ])
+    for (problem_id, true_info, pred_answer), comparison_result in zip(pending, verdicts):
+        yield _result_row(problem_id, true_info, pred_answer, comparison_result)
+
+def _result_row(problem_id, true_info, pred_answer, comparison_result):
+    return {
+        problem_id: {
+            "true": true_info["answer"],
+            "prediction": pred_answer,
+            "is_correct": comparison_result,
+            "label": true_info["label"],
+            "level": true_info["level"],  
         }
-        results.append(result_data)
+    }
+
+def process_files(file_true, file_pred, output_file=None, resume=False, cache_path=None, local_check=True,
+                  batch_size=1, shard=None, ledger_path=None, cascade=None, audit=0., hedging=None,
+                  failover=None):
+    """Process files to compare true and predicted answers and save results.
+
+    Predictions are joined with the ground truth by problem id, so partial, reordered or sharded prediction files can
+    be evaluated. If output_file is given, every result is appended to it as soon as it is judged and the number of
+    results is returned; otherwise the list of results is returned. With resume=True the problems already judged in
+    output_file are skipped. With cache_path, the judge responses are cached on disk. With local_check, the obvious
+    cases are decided by the local answer checker without calling the judge. With batch_size > 1, up to batch_size
+    undecided answers are packed into one judge request. With shard=(k, N), only the problems of shard k of N are
+    judged, and written to the part file of the shard instead of output_file (see xyz.utils.sharding). With
+    ledger_path, the verdicts of previous runs (of any prediction file) are reused from the verdict ledger, so only the
+    new or changed answers are sent to the judge. With cascade (a CheapJudge), the cheap judge decides first and only
+    the answers it is unsure about are escalated to the strong judge; audit is the fraction of its accepted verdicts
+    which are checked by the strong judge anyway. With hedging (a HedgingPolicy), the slow judge requests are
+    duplicated. With failover (a Failover), the judge requests go to its first healthy endpoint.
+    """
+    cache = ResponseCache(cache_path) if cache_path is not None else None
+    ledger = VerdictLedger(ledger_path) if ledger_path is not None else None
+    evalution = Evalutor(local_check=local_check, batch_size=batch_size, ledger=ledger,
+                         cascade=cascade, audit=audit, cache=cache, hedging=hedging,
+                         failover=failover)
+    report = {}
 
+    if output_file is None:
+        results = list(iter_results(file_true, file_pred, evalution, report=report,
+                                    batch_size=batch_size, shard=shard))
+    else:
+        if shard is not None:
+            output_file = part_path(output_file, *shard)
+        with CheckpointWriter(output_file, resume=resume,
+                              is_complete=lambda value: value.get("is_correct") is not None) as writer:
+            if writer.completed:
+                print(f"Resuming: {len(writer.completed)} problems are already judged in {output_file}.")
+            results = 0
+            for result_data in iter_results(file_true, file_pred, evalution, skip=writer.completed, report=report,
+                                            batch_size=batch_size, shard=shard):
+                writer.write(json.dumps(result_data) + '\n')
+                results += 1
+
+    print(f"Joined {report['joined']} predictions: {len(report['missing'])} missing, "
+          f"{len(report['duplicate'])} duplicate, {len(report['extra'])} without ground truth, "
+          f"{report['corrupt']} corrupt lines skipped.")
+    if batch_size > 1:
+        print(f"Batches: {evalution.stats['batches']} judge requests, "
+              f"{evalution.stats['batch_fallbacks']} fell back to single items.")
+    _print_verdicts(evalution)
     return results
 
+def _print_verdicts(evalution):
+    """Print where the verdicts came from, and the cascade statistics if there is a cheap judge."""
+    print(f"Verdicts: {evalution.stats['local']} decided locally, {evalution.stats['ledger']} from the ledger, "
+          f"{evalution.stats['llm']} by the LLM judge.")
+    if evalution.cascade is not None:
+        stats = evalution.cascade_stats
+        screened = stats["cheap"] + stats["escalated"] + stats["audited"]
+        agreement = f"{stats['agreed'] / stats['compared']:.1%}" if stats["compared"] else "-"
+        print(f"Cascade: {stats['cheap']} of {screened} cheap verdicts accepted, {stats['escalated']} escalated "
+              f"({stats['escalated'] / max(screened, 1):.1%}), {stats['audited']} audited; the judges agreed on "
+              f"{stats['agreed']} of the {stats['compared']} answers both judged ({agreement}).")
+
+def result_path(file_pred):
+    """The result file of a prediction file."""
+    return 'jsonl/eval/result-' + file_pred.split('/')[-1]
+
+def _interleave(iterators):
+    """Take one item of every iterator in turn, so the same problem of several prediction files is judged at about
+    the same time."""
+    iterators = list(iterators)
+    while iterators:
+        for iterator in list(iterators):
+            try:
+                yield next(iterator)
+            except StopIteration:
+                iterators.remove(iterator)
+
+def judge_files(file_true, file_preds, concurrency=8, resume=False, cache_path=None, local_check=True, shard=None,
+                ledger_path=None, cascade=None, audit=0., hedging=None, failover=None, dedup=False):
+    """Judge several prediction files at once, with up to concurrency answers in flight over all the files.
+
+    Every prediction file gets its own result file (see result_path), written as the verdicts arrive. The files are
+    read in turn, so the same problem of every file is in flight at about the same time, and with dedup the identical
+    judge requests in flight (the same answer given by several models) share a single call. The other arguments are
+    those of process_files; the answers are judged one by one (no batches). Returns the number of results written per
+    file.
+    """
+    cache = ResponseCache(cache_path) if cache_path is not None else None
+    ledger = VerdictLedger(ledger_path) if ledger_path is not None else None
+    singleflight = SingleFlight() if dedup else None
+    evalution = Evalutor(local_check=local_check, ledger=ledger, cascade=cascade, audit=audit, cache=cache,
+                         hedging=hedging, failover=failover, singleflight=singleflight)
+    reports = [{} for _ in file_preds]
+    written = [0] * len(file_preds)
+
+    with contextlib.ExitStack() as stack:
+        writers = []
+        for file_pred in file_preds:
+            output_file = result_path(file_pred)
+            if shard is not None:
+                output_file = part_path(output_file, *shard)
+            writer = CheckpointWriter(output_file, resume=resume,
+                                      is_complete=lambda value: value.get("is_correct") is not None)
+            stack.enter_context(writer)
+            if writer.completed:
+                print(f"Resuming: {len(writer.completed)} problems are already judged in {output_file}.")
+            writers.append(writer)
+
+        def joined(index, file_pred):
+            for problem_id, true_info, pred in iter_joined(file_true, file_pred, reports[index], shard=shard):
+                if problem_id not in writers[index].completed:
+                    pred_answer = pred.get("answer") if isinstance(pred, dict) else pred
+                    yield problem_id, {"file": index, "true_info": true_info, "prediction": pred_answer,
+                                       "label": true_info["label"], "level": true_info["level"]}
+
+        async def judge(item):
+            true_info = item["true_info"]
+            verdict = await evalution.acall(question=true_info["question"], true=true_info["answer"],
+                                            prediction=item["prediction"])
+            return {"file": item["file"], "true_info": true_info, "prediction": item["prediction"],
+                    "verdict": verdict}
+
+        def write(line):
+            for problem_id, value in json.loads(line).items():
+                row = _result_row(problem_id, value["true_info"], value["prediction"], value["verdict"])
+                writers[value["file"]].write(json.dumps(row) + '\n')
+                written[value["file"]] += 1
+
+        runner = AsyncRunner(judge, concurrency=concurrency, ordered=False)
+        asyncio.run(runner.arun_problems(_interleave(joined(index, file_pred)
+                                                     for index, file_pred in enumerate(file_preds)), write))
+
+    for file_pred, report, count in zip(file_preds, reports, written):
+        print(f"{file_pred}: joined {report['joined']} predictions, {len(report['missing'])} missing, "
+              f"{len(report['duplicate'])} duplicate, {len(report['extra'])} without ground truth, "
+              f"{report['corrupt']} corrupt lines skipped; {count} results written.")
+    _print_verdicts(evalution)
+    if singleflight is not None:
+        stats = singleflight.stats()
+        print(f"Deduplication: {stats['shared']} of {stats['calls']} judge requests shared an identical request in "
+              f"flight.")
+    return written
+
+def _verdicts(file_result):
+    """The verdicts of a result file, {problem_id: correct}."""
+    return {problem_id: correct for _, problem_id, _, _, correct, _ in ResultsStore.from_files([file_result]).rows()}
+
+def compare_results(file_result, file_reference):
+    """Compare the verdicts of two result files of the same predictions, e.g. a cascaded run and a full strong-judge
+    run. Returns the number of common problems, of agreements, and the (verdict, reference verdict) counts. The files
+    are read by the ResultsStore, so their verdicts are parsed as in the analyses and their corrupt lines skipped."""
+    reference = _verdicts(file_reference)
+    confusion = {(True, True): 0, (True, False): 0, (False, True): 0, (False, False): 0}
+    for problem_id, correct in _verdicts(file_result).items():
+        if problem_id in reference:
+            confusion[(correct, reference[problem_id])] += 1
+    common = sum(confusion.values())
+    return {"common": common, "agreed": confusion[(True, True)] + confusion[(False, False)], "confusion": confusion}
+
 def main():
-    file_true = 'final-odyssey-math-with-levels.jsonl'
-    file_pred = "/Users/elricwan/Downloads/NetmindAI/odyssey-math/jsonl/clean/deepseek-v3-Instruct-solution-clean.jsonl"
-    results = process_files(file_true, file_pred)
-    save_jsonl(results, 'jsonl/eval/result-'+file_pred.split('/')[-1])
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--true", default='final-odyssey-math-with-levels.jsonl')
+    parser.add_argument("--pred", nargs="+", default=["/Users/elricwan/Downloads/NetmindAI/odyssey-math/jsonl/clean/deepseek-v3-Instruct-solution-clean.jsonl"],
+                        help="The prediction file(s); several files are judged concurrently.")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="The number of answers judged at the same time, over all the prediction files.")
+    parser.add_argument("--dedup", action="store_true",
+                        help="Share one call between the identical judge requests in flight (concurrent judging).")
+    parser.add_argument("--resume", action="store_true", help="Skip the problems already judged in the result file.")
+    parser.add_argument("--cache", default=None, help="The path of the SQLite response cache.")
+    parser.add_argument("--ledger", default=None,
+                        help="The path of the SQLite verdict ledger, e.g. .cache/verdicts.sqlite.")
+    parser.add_argument("--no-local-check", action="store_true", help="Send every answer to the LLM judge.")
+    parser.add_argument("--batch-size", type=int, default=1, help="The number of answers judged in one request.")
+    parser.add_argument("--cascade-model", default=None,
+                        help="Judge with this cheaper OpenAI model first, and only escalate the uncertain answers.")
+    parser.add_argument("--cascade-url", default=None,
+                        help="Judge with the model of this Llama3APIClient endpoint first (NETMIND_POWER_KEY).")
+    parser.add_argument("--cascade-threshold", type=float, default=0.9,
+                        help="The minimum confidence of an accepted cheap verdict.")
+    parser.add_argument("--cascade-samples", type=int, default=1,
+                        help="The number of cheap verdicts per answer; a disagreement escalates the answer.")
+    parser.add_argument("--audit", type=float, default=0.,
+                        help="The fraction of the accepted cheap verdicts also checked by the strong judge.")
+    parser.add_argument("--compare", default=None,
+                        help="A result file of the same predictions judged by the strong judge only, to report the "
+                             "agreement with it.")
+    parser.add_argument("--shard", type=parse_shard, default=None,
+                        help="k/N: only judge shard k of N (from 0) and write it to its own part file.")
+    parser.add_argument("--merge", type=int, default=None, metavar="N",
+                        help="Merge the part files of N shards into the result file and exit.")
+    parser.add_argument("--hedge", action="store_true",
+                        help="Duplicate the requests slower than a percentile of the observed latencies.")
+    parser.add_argument("--hedge-percentile", type=float, default=95, help="The percentile which triggers a hedge.")
+    parser.add_argument("--hedge-budget", type=float, default=0.05,
+                        help="The maximum fraction of the requests which are duplicated.")
+    parser.add_argument("--hedge-url", default=None,
+                        help="A secondary endpoint serving the same model for the duplicates (default: the same one).")
+    parser.add_argument("--fallback-url", action="append", default=[],
+                        help="An alternate base URL serving the same model, used while the main one is down "
+                             "(repeatable).")
+    parser.add_argument("--telemetry", default=None,
+                        help="A directory for the per-call records (calls.jsonl) and metrics (metrics.prom).")
+    parser.add_argument("--trace", default=None, metavar="PATH",
+                        help="Write a Chrome / Perfetto trace of the agent calls to this JSON file.")
+    args = parser.parse_args()
+
+    file_true = args.true
+    concurrent = len(args.pred) > 1 or args.concurrency > 1
+    if concurrent and args.batch_size > 1:
+        parser.error("--batch-size cannot be combined with concurrent judging (--concurrency or several --pred).")
+    if args.dedup and not concurrent:
+        parser.error("--dedup needs concurrent judging (--concurrency or several --pred).")
+    if args.compare is not None and len(args.pred) > 1:
+        parser.error("--compare needs a single --pred file.")
+    if args.merge is not None:
+        for file_pred in args.pred:
+            output_file = result_path(file_pred)
+            report = merge_parts(output_file, args.merge, expected=JsonlStore(file_true).ids())
+            print(f"Merged {report['records']} results of {args.merge} shards into {output_file}, "
+                  f"{len(report['missing'])} problems missing.")
+        return
+
+    telemetry = None
+    if args.telemetry is not None:
+        telemetry = configure_telemetry(path=os.path.join(args.telemetry, "calls.jsonl"),
+                                        prometheus_path=os.path.join(args.telemetry, "metrics.prom"))
+    tracer = configure_tracing(args.trace) if args.trace is not None else None
+
+    cascade = None
+    if args.cascade_model is not None:
+        temperature = 0.7 if args.cascade_samples > 1 else 0.
+        cascade = CheapJudge(OpenAIClient(api_key=os.getenv('OPENAI_API_KEY'), model=args.cascade_model,
+                                          temperature=temperature, max_tokens=64, logprobs=True, top_logprobs=5),
+                             threshold=args.cascade_threshold, samples=args.cascade_samples)
+    elif args.cascade_url is not None:
+        cascade = CheapJudge(Llama3APIClient(args.cascade_url, os.getenv('NETMIND_POWER_KEY'), max_new_tokens=64),
+                             threshold=args.cascade_threshold, samples=args.cascade_samples)
+
+    hedging = None
+    if args.hedge:
+        hedging = HedgingPolicy(percentile=args.hedge_percentile, budget=args.hedge_budget, base_url=args.hedge_url)
+
+    failover = None
+    if args.fallback_url:
+        failover = Failover([os.getenv('OPENAI_BASE_URL') or "https://api.openai.com/v1"] + args.fallback_url)
+
+    if concurrent:
+        judge_files(file_true, args.pred, concurrency=args.concurrency, resume=args.resume, cache_path=args.cache,
+                    local_check=not args.no_local_check, shard=args.shard, ledger_path=args.ledger, cascade=cascade,
+                    audit=args.audit, hedging=hedging, failover=failover, dedup=args.dedup)
+    else:
+        process_files(file_true, args.pred[0], output_file=result_path(args.pred[0]), resume=args.resume,
+                      cache_path=args.cache, local_check=not args.no_local_check, batch_size=args.batch_size,
+                      shard=args.shard, ledger_path=args.ledger, cascade=cascade, audit=args.audit, hedging=hedging,
+                      failover=failover)
     print("Results have been saved.")
+    if hedging is not None:
+        stats = hedging.stats()
+        print(f"Hedging: {stats['hedged']} of {stats['requests']} requests duplicated ({stats['extra_load']:.1%}), "
+              f"{stats['wins']} answered first by the duplicate, {stats['denied']} denied by the budget.")
+    if args.compare is not None and args.shard is None:
+        comparison = compare_results(result_path(args.pred[0]), args.compare)
+        print(f"Agreement with {args.compare}: {comparison['agreed']} of {comparison['common']} verdicts "
+              f"({comparison['agreed'] / max(comparison['common'], 1):.1%}), "
+              f"{comparison['confusion'][(True, False)]} accepted and {comparison['confusion'][(False, True)]} "
+              f"rejected only by this run.")
+    if telemetry is not None:
+        telemetry.close()
+        print(telemetry.report())
+    if tracer is not None:
+        tracer.close()
+        print(f"Trace written to {args.trace}:")
+        print(tracer.report())
 
 if __name__ == "__main__":
     main()
@@ -1,20 +1,166 @@
+import argparse
+import glob
+import os
+
+from agents.router import RoutingPolicy, SolverRouter, telemetry_latencies, token_budgets
 from agents.solve import mathSolve
-import json
-
-def process_math_problems(input_file, output_file):
-    msv = mathSolve()  # Initialize your solving class
-    with open(input_file, 'r') as infile, open(output_file, 'w') as outfile:
-        for line in infile:
-            problem = json.loads(line)  # Convert JSON line to dictionary
-            for key, value in problem.items():
-                question = value['question']
-                response = msv(question=question)  # Solve the problem
-                output_json = json.dumps({key: response})  # Convert response to JSON line
-                outfile.write(output_json + '\n')  # Write to file
+from xyz.utils.data.results import load_results
+from xyz.utils.llm.cache import ResponseCache
+from xyz.utils.llm.circuit_breaker import Failover
+from xyz.utils.llm.hedging import HedgingPolicy
+from xyz.utils.llm.telemetry import configure_telemetry
+from xyz.utils.tracing import configure_tracing
+from xyz.utils.data.dataset import JsonlStore
+from xyz.utils.runner import AsyncRunner
+from xyz.utils.scheduler import LongestFirstScheduler
+from xyz.utils.sharding import merge_parts, parse_shard
+
+
+def process_math_problems(input_file, output_file, concurrency=8, resume=False, cache_path=None, samples=1,
+                          consensus=2, stream=False, label=None, level=None, shard=None, policy=None,
+                          scheduler=None, hedging=None, failover=None):
+    cache = ResponseCache(cache_path) if cache_path is not None else None
+    msv = router = None
+    if policy is not None:
+        # One solver per routed model, the problems are solved by the model of their class
+        models = {model for route in list(policy.routes.values()) + [policy.default] for model in route}
+        router = SolverRouter({model: mathSolve(samples=samples, consensus=consensus, stream=stream, cache=cache,
+                                                hedging=hedging, failover=failover, model=model)
+                                 for model in models}, policy)
+    else:
+        msv = mathSolve(samples=samples, consensus=consensus, stream=stream, cache=cache,
+                        hedging=hedging, failover=failover)  # Initialize your solving class
+
+    async def solve(problem):
+        if router is not None:
+            return await router.acall(question=problem['question'], level=problem.get('level'),
+                                      label=problem.get('label'))
+        return await msv.acall(question=problem['question'])  # Solve the problem without blocking the event loop
+
+    runner = AsyncRunner(solve, concurrency=concurrency, ordered=scheduler is None, scheduler=scheduler)
+    written = runner.run(input_file, output_file, resume=resume, label=label, level=level, shard=shard)
+    if samples > 1:
+        # The voting statistics of all the solvers, the routed ones included
+        solvers = list(router.solvers.values()) if router is not None else [msv]
+        voting = {key: sum(solver.stats[key] for solver in solvers) for key in solvers[0].stats}
+        print(f"Voting: {voting['samples']} samples in {voting['requests']} requests for "
+              f"{voting['problems']} problems, {voting['early_stops']} stopped at consensus.")
+    if router is not None:
+        routed = ", ".join(f"{model} {count}" for model, count in router.stats["routed"].items())
+        print(f"Routing: {routed}; {router.stats['fallbacks']} solved by a fallback model, "
+              f"{router.stats['unanswered']} without an answer.")
+    if hedging is not None:
+        stats = hedging.stats()
+        print(f"Hedging: {stats['hedged']} of {stats['requests']} requests duplicated ({stats['extra_load']:.1%}), "
+              f"{stats['wins']} answered first by the duplicate, {stats['denied']} denied by the budget.")
+    return written
+
+
+def routing_policy(routes, results, outputs, input_file, telemetry=None, tolerance=0.03):
+    """Build the routing policy from the evaluation results, the past solutions and the telemetry of past runs."""
+    candidates = dict(route.split("=", 1) for route in routes.split(","))
+    store = load_results(sorted(glob.glob(results)))
+    latencies = telemetry_latencies(telemetry) if telemetry is not None else None
+    budgets = token_budgets(sorted(glob.glob(outputs)), input_file) if outputs else None
+    policy = RoutingPolicy.from_history(store, candidates, tolerance=tolerance, latencies=latencies, budgets=budgets)
+    print(f"Routes:\n{policy.describe()}")
+    return policy
 
 # Specify your input and output files
 input_file_path = 'final-odyssey-math-with-levels.jsonl'
 output_file_path = 'jsonl/gpt-4-turbo-2024-04-09-second.jsonl'
 
-# Call the processing function
-process_math_problems(input_file_path, output_file_path)
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default=input_file_path)
+    parser.add_argument("--output", default=output_file_path)
+    parser.add_argument("--concurrency", type=int, default=8, help="The number of problems in flight.")
+    parser.add_argument("--resume", action="store_true", help="Skip the problems already in the output file.")
+    parser.add_argument("--cache", default=None, help="The path of the SQLite response cache.")
+    parser.add_argument("--samples", type=int, default=1, help="The maximum number of voting samples per problem.")
+    parser.add_argument("--consensus", type=int, default=2, help="Stop voting once this many samples agree.")
+    parser.add_argument("--stream", action="store_true", help="Stop reading each answer after its JSON block.")
+    parser.add_argument("--label", action="append", default=None,
+                        help="Only solve the problems with this label (repeatable).")
+    parser.add_argument("--level", action="append", default=None,
+                        help="Only solve the problems of this level (repeatable).")
+    parser.add_argument("--shard", type=parse_shard, default=None,
+                        help="k/N: only solve shard k of N (from 0) and write it to its own part file.")
+    parser.add_argument("--merge", type=int, default=None, metavar="N",
+                        help="Merge the part files of N shards into the output file and exit.")
+    parser.add_argument("--schedule", action="append", default=None, metavar="OUTPUT",
+                        help="Dispatch the longest problems first, by their solution length in this past output file "
+                             "(repeatable, a past run of the same model is the best guide). Results are written in "
+                             "completion order.")
+    parser.add_argument("--schedule-telemetry", action="append", default=None, metavar="CALLS",
+                        help="Also use the latencies of a past run recorded by --telemetry (calls.jsonl, repeatable).")
+    parser.add_argument("--hedge", action="store_true",
+                        help="Duplicate the requests slower than a percentile of the observed latencies.")
+    parser.add_argument("--hedge-percentile", type=float, default=95, help="The percentile which triggers a hedge.")
+    parser.add_argument("--hedge-budget", type=float, default=0.05,
+                        help="The maximum fraction of the requests which are duplicated.")
+    parser.add_argument("--hedge-url", default=None,
+                        help="A secondary endpoint serving the same model for the duplicates (default: the same one).")
+    parser.add_argument("--fallback-url", action="append", default=[],
+                        help="An alternate base URL serving the same model, used while the main one is down "
+                             "(repeatable).")
+    parser.add_argument("--telemetry", default=None,
+                        help="A directory for the per-call records (calls.jsonl) and metrics (metrics.prom).")
+    parser.add_argument("--trace", default=None, metavar="PATH",
+                        help="Write a Chrome / Perfetto trace of the agent calls to this JSON file.")
+    parser.add_argument("--route", default=None, metavar="MODEL=RUN,...",
+                        help="Route each problem to one of these models by the past accuracy of the run measuring it "
+                             "on the level and label of the problem, e.g. "
+                             "gpt-4o-mini=gpt-4o-mini-solution-clean,gpt-4-turbo=gpt-4-turbo-2024-04-09-solution-clean.")
+    parser.add_argument("--route-results", default="jsonl/eval/result-*.jsonl",
+                        help="The evaluation results the routes are built from.")
+    parser.add_argument("--route-outputs", default=None,
+                        help="Past solutions (a glob) to size the max_tokens budget of each level from.")
+    parser.add_argument("--route-telemetry", default=None,
+                        help="A calls.jsonl of past runs, to prefer the faster of equally cheap models.")
+    parser.add_argument("--route-tolerance", type=float, default=0.03,
+                        help="The accuracy a cheaper model may lose on a class and still be routed to.")
+    args = parser.parse_args()
+
+    if args.merge is not None:
+        report = merge_parts(args.output, args.merge, expected=JsonlStore(args.input).ids())
+        print(f"Merged {report['records']} results of {args.merge} shards into {args.output}, "
+              f"{len(report['missing'])} problems missing.")
+        raise SystemExit(0)
+
+    telemetry = None
+    if args.telemetry is not None:
+        telemetry = configure_telemetry(path=os.path.join(args.telemetry, "calls.jsonl"),
+                                        prometheus_path=os.path.join(args.telemetry, "metrics.prom"))
+    tracer = configure_tracing(args.trace) if args.trace is not None else None
+
+    policy = None
+    if args.route is not None:
+        policy = routing_policy(args.route, args.route_results, args.route_outputs, args.input,
+                                telemetry=args.route_telemetry, tolerance=args.route_tolerance)
+    scheduler = None
+    if args.schedule or args.schedule_telemetry:
+        scheduler = LongestFirstScheduler.from_history(output_files=args.schedule or (),
+                                                       telemetry_files=args.schedule_telemetry or ())
+
+    hedging = None
+    if args.hedge:
+        hedging = HedgingPolicy(percentile=args.hedge_percentile, budget=args.hedge_budget, base_url=args.hedge_url,
+                                max_workers=2 * args.concurrency)
+
+    failover = None
+    if args.fallback_url:
+        failover = Failover([os.getenv('OPENAI_BASE_URL') or "https://api.openai.com/v1"] + args.fallback_url)
+
+    # Call the processing function
+    process_math_problems(args.input, args.output, concurrency=args.concurrency, resume=args.resume,
+                          cache_path=args.cache, samples=args.samples, consensus=args.consensus,
+                          stream=args.stream, label=args.label, level=args.level, shard=args.shard,
+                          policy=policy, scheduler=scheduler, hedging=hedging, failover=failover)
+    if telemetry is not None:
+        telemetry.close()
+        print(telemetry.report())
+    if tracer is not None:
+        tracer.close()
+        print(f"Trace written to {args.trace}:")
+        print(tracer.report())
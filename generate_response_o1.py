@@ -1,14 +1,17 @@
-import json
+import argparse
 from openai import OpenAI
 from dotenv import load_dotenv
 import os
 import copy
 
+from xyz.utils.llm.transport import get_pool
+from xyz.utils.runner import AsyncRunner
+
 # Load the environment variables from the .env file
 load_dotenv()
 
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-client_openai = OpenAI(api_key=OPENAI_API_KEY)
+client_openai = OpenAI(api_key=OPENAI_API_KEY, http_client=get_pool().httpx_client("https://api.openai.com/v1"))
 
 def run_openai(messages, client):
     
@@ -61,20 +64,26 @@ SOLUTION = [
 ]
 
 
-def process_math_problems(input_file, output_file):
-    with open(input_file, 'r') as infile, open(output_file, 'w') as outfile:
-        for line in infile:
-            problem = json.loads(line)  # Convert JSON line to dictionary
-            for key, value in problem.items():
-                question = value['question']
-                updated_template = generate_feature_engineer_templates(SOLUTION, question)
-                response = run_openai(updated_template, client_openai)
-                output_json = json.dumps({key: response})  # Convert response to JSON line
-                outfile.write(output_json + '\n')  # Write to file
+def process_math_problems(input_file, output_file, concurrency=8, resume=False):
+
+    def solve(problem):
+        updated_template = generate_feature_engineer_templates(SOLUTION, problem['question'])
+        return run_openai(updated_template, client_openai)
+
+    runner = AsyncRunner(solve, concurrency=concurrency)
+    return runner.run(input_file, output_file, resume=resume)
 
 # Specify your input and output files
 input_file_path = 'final-odyssey-math-with-levels.jsonl'
 output_file_path = 'jsonl/gpt-4-o1-preview-solution.jsonl'
 
-# Call the processing function
-process_math_problems(input_file_path, output_file_path)
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default=input_file_path)
+    parser.add_argument("--output", default=output_file_path)
+    parser.add_argument("--concurrency", type=int, default=8, help="The number of problems in flight.")
+    parser.add_argument("--resume", action="store_true", help="Skip the problems already in the output file.")
+    args = parser.parse_args()
+
+    # Call the processing function
+    process_math_problems(args.input, args.output, concurrency=args.concurrency, resume=args.resume)
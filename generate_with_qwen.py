@@ -1,3 +1,4 @@
+import argparse
 import os
 import time
 import traceback
@@ -9,20 +10,64 @@ import time
 from openai import OpenAI
 from dotenv import load_dotenv
 
+from xyz.utils.llm.circuit_breaker import Failover
+from xyz.utils.llm.rate_limiter import RateLimiter
+from xyz.utils.llm.telemetry import configure_telemetry, get_telemetry
+from xyz.utils.llm.transport import get_pool
+from xyz.utils.data.dataset import JsonlStore
+from xyz.utils.runner import AsyncRunner
+from xyz.utils.scheduler import LongestFirstScheduler
+from xyz.utils.sharding import merge_parts, parse_shard
+
 # Load the environment variables from the .env file
 load_dotenv()
 api_token = os.getenv('NETMIND_POWER_KEY')
 
-# Set up the client with the new OpenAI structure
+base_url = "https://inference-api.netmind.ai/inference-api/openai/v1"
+
+# Set up the client with the new OpenAI structure. The retries are handled by the rate limiter, and the connections are
+# taken from the shared pool.
 client = OpenAI(
-    base_url="https://inference-api.netmind.ai/inference-api/openai/v1",
+    max_retries=0,
+    base_url=base_url,
     api_key=api_token,
+    http_client=get_pool().httpx_client(base_url),
 )
 
 model = "Qwen/Qwen2.5-72B-Instruct"
 stream = False  # Set to True if you want streamed output
 max_tokens = 2000
 
+# Shared by all the concurrent requests: adapts the concurrency to 429/5xx and backs off with jitter.
+limiter = RateLimiter(concurrency=8, max_retries=20)
+
+# The endpoints, the preferred one first: an endpoint which keeps failing is skipped by its circuit breaker until it
+# answers a probe again, and the problems are parked by the runner while every endpoint is down.
+failover = Failover([base_url])
+clients = {base_url: client}
+
+
+def create(method, **kwargs):
+    """Send one request to the first healthy endpoint, method being e.g. "chat.completions"."""
+    def send(endpoint):
+        if endpoint not in clients:
+            clients[endpoint] = OpenAI(max_retries=0, base_url=endpoint, api_key=api_token,
+                                       http_client=get_pool().httpx_client(endpoint))
+        api = clients[endpoint]
+        for name in method.split("."):
+            api = getattr(api, name)
+        return api.create(**kwargs)
+    return failover.call(send)
+
+
+def record(start, attempts, usage=None, error=None):
+    """Report one request (its retries included) to the telemetry, if it is enabled with --telemetry."""
+    telemetry = get_telemetry()
+    if telemetry is not None:
+        telemetry.record("netmind", model=model, latency=time.perf_counter() - start, attempts=attempts,
+                         prompt_tokens=getattr(usage, "prompt_tokens", None),
+                         completion_tokens=getattr(usage, "completion_tokens", None), error=error)
+
 # Define the request prompt for solving math problems
 request = """
     You are now assuming the role of a math professor. Your task is to assist the user by solving complex mathematical problems in a detailed and step-by-step manner.
@@ -51,44 +96,98 @@ request = """
     Ensure that all task requirements are meticulously followed in your response.
 """
 
-def process_math_problems(input_file, output_file):
-    with open(input_file, 'r') as infile, open(output_file, 'w') as outfile:
-        for line in infile:
-            time.sleep(2)
-            status = 0
-            problem = json.loads(line)  # Convert JSON line to dictionary
-            for key, value in problem.items():
-                question = value['question']
-                question_prompt =  "The given question is:  \n" + question
-                full_prompt = request + "\n\n" + question_prompt
-                
-                while status == 0:
-                    try:
-                        # Run the completion request using the new OpenAI API structure
-                        completion_res = client.completions.create(
-                            model=model,
-                            prompt=full_prompt,
-                            stream=stream,
-                            max_tokens=max_tokens,
-                        )
-                        
-                        # Process streaming or non-streaming response
-                        if stream:
-                            response = ''.join([chunk.choices[0].text for chunk in completion_res])
-                        else:
-                            response = completion_res.choices[0].text
-                        
-                        status = 1  # Set status to 1 after successful completion
-                    except:
-                        time.sleep(10)
-                        status = 0
-                
-                output_json = json.dumps({key: response})  # Convert response to JSON line
-                outfile.write(output_json + '\n')  # Write to file
+def solve(problem):
+    question_prompt =  "The given question is:  \n" + problem['question']
+    full_prompt = request + "\n\n" + question_prompt
+
+    start = time.perf_counter()
+    attempts = []
+
+    def send(*args, **kwargs):
+        attempts.append(1)
+        return create(*args, **kwargs)
+
+    # Run the completion request using the new OpenAI API structure
+    try:
+        completion_res = limiter.call(
+            send, "completions",
+            model=model,
+            prompt=full_prompt,
+            stream=stream,
+            max_tokens=max_tokens,
+            estimated_tokens=len(full_prompt) // 4 + max_tokens,
+        )
+
+        # Process streaming or non-streaming response
+        if stream:
+            text = ''.join([chunk.choices[0].text for chunk in completion_res])
+        else:
+            text = completion_res.choices[0].text
+    except Exception as error:
+        record(start, len(attempts), error=type(error).__name__)
+        raise
+    record(start, len(attempts), usage=None if stream else completion_res.usage)
+    return text
+
+
+def process_math_problems(input_file, output_file, concurrency=8, resume=False, label=None, level=None,
+                          shard=None, scheduler=None):
+    runner = AsyncRunner(solve, concurrency=concurrency, ordered=scheduler is None, scheduler=scheduler)
+    return runner.run(input_file, output_file, resume=resume, label=label, level=level, shard=shard)
 
 # Specify your input and output files
 input_file_path = 'final-odyssey-math-with-levels.jsonl'
 output_file_path = 'jsonl/Qwen2.5-72B-Instruct-solution.jsonl'
 
-# Call the processing function
-process_math_problems(input_file_path, output_file_path)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default=input_file_path)
+    parser.add_argument("--output", default=output_file_path)
+    parser.add_argument("--concurrency", type=int, default=8, help="The number of problems in flight.")
+    parser.add_argument("--resume", action="store_true", help="Skip the problems already in the output file.")
+    parser.add_argument("--label", action="append", default=None,
+                        help="Only solve the problems with this label (repeatable).")
+    parser.add_argument("--level", action="append", default=None,
+                        help="Only solve the problems of this level (repeatable).")
+    parser.add_argument("--shard", type=parse_shard, default=None,
+                        help="k/N: only solve shard k of N (from 0) and write it to its own part file.")
+    parser.add_argument("--merge", type=int, default=None, metavar="N",
+                        help="Merge the part files of N shards into the output file and exit.")
+    parser.add_argument("--schedule", action="append", default=None, metavar="OUTPUT",
+                        help="Dispatch the longest problems first, by their solution length in this past output file "
+                             "(repeatable, a past run of the same model is the best guide). Results are written in "
+                             "completion order.")
+    parser.add_argument("--schedule-telemetry", action="append", default=None, metavar="CALLS",
+                        help="Also use the latencies of a past run recorded by --telemetry (calls.jsonl, repeatable).")
+    parser.add_argument("--fallback-url", action="append", default=[],
+                        help="An alternate base URL serving the same model, used while the main one is down "
+                             "(repeatable).")
+    parser.add_argument("--telemetry", default=None,
+                        help="A directory for the per-call records (calls.jsonl) and metrics (metrics.prom).")
+    args = parser.parse_args()
+
+    if args.merge is not None:
+        report = merge_parts(args.output, args.merge, expected=JsonlStore(args.input).ids())
+        print(f"Merged {report['records']} results of {args.merge} shards into {args.output}, "
+              f"{len(report['missing'])} problems missing.")
+        raise SystemExit(0)
+
+    if args.fallback_url:
+        failover = Failover([base_url] + args.fallback_url)
+
+    telemetry = None
+    if args.telemetry is not None:
+        telemetry = configure_telemetry(path=os.path.join(args.telemetry, "calls.jsonl"),
+                                        prometheus_path=os.path.join(args.telemetry, "metrics.prom"))
+
+    scheduler = None
+    if args.schedule or args.schedule_telemetry:
+        scheduler = LongestFirstScheduler.from_history(output_files=args.schedule or (),
+                                                       telemetry_files=args.schedule_telemetry or ())
+
+    # Call the processing function
+    process_math_problems(args.input, args.output, concurrency=args.concurrency, resume=args.resume,
+                          label=args.label, level=args.level, shard=args.shard, scheduler=scheduler)
+    if telemetry is not None:
+        telemetry.close()
+        print(telemetry.report())
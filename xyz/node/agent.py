@@ -11,11 +11,16 @@ programming logic.
 
 ## Features of the AI-Agent include:
 - Callable: AI-Agents can be invoked using the `agent()` method.
+- Async: AI-Agents can be awaited with `await agent.acall()`, so composite agents can run several sub-agents at once
+    with `asyncio.gather`. Agents which only implement `flowing()` run in a worker thread; agents can override
+    `aflowing()` with a native async implementation.
 - Information Configuration: Users can set the properties of the AI-Agent using the `set_information()` method, adhering
     to the function call format specified by OpenAI.
 - Nestability: AI-Agents can be nested within other AI-Agents.
 - Structural Visibility: The structure of the AI-Agent can be inspected using the `__str__()` method, which can be
     directly printed using `print(agent)`.
+- Tracing: When tracing is enabled (see `xyz.utils.tracing`), every call of an AI-Agent is recorded as a span nested in
+    the span of the calling AI-Agent, so the slow sub-agents of a pipeline show up on a timeline.
 
 ## Motivation
 AI-Agents leverage large language models and flexible programming combinations to achieve diverse functionalities.
@@ -26,8 +31,11 @@ documentation and papers associated with this project.
 
 __all__ = ["Agent"]
 
+import asyncio
 from abc import abstractmethod
-from typing import Callable, Any
+from typing import Callable, Any, Coroutine
+
+from xyz.utils.tracing import get_tracer, kwargs_size
 
 
 class Agent:
@@ -72,10 +80,37 @@ class Agent:
             self.flowing(**kwargs)
         """
 
-        return self.flowing(**kwargs)
+        tracer = get_tracer()
+        if tracer is None:
+            return self.flowing(**kwargs)
+        with tracer.span(type(self).__name__, kwargs_size=kwargs_size(kwargs)):
+            return self.flowing(**kwargs)
 
     __call__: Callable[..., Any] = _wrap_call
 
+    async def _wrap_acall(self, **kwargs) -> Any:
+        """
+        The async wrap call function for the agent. The user can call the agent by `await agent.acall(**kwargs)`.
+        The agent will call the method `aflowing` automatically.
+
+        Parameters
+        ----------
+            **kwargs:
+                The parameters of the agent are determined by the user-defined `flowing` method of the object.
+
+        Returns
+        -------
+            await self.aflowing(**kwargs)
+        """
+
+        tracer = get_tracer()
+        if tracer is None:
+            return await self.aflowing(**kwargs)
+        with tracer.span(type(self).__name__, kwargs_size=kwargs_size(kwargs)):
+            return await self.aflowing(**kwargs)
+
+    acall: Callable[..., Coroutine[Any, Any, Any]] = _wrap_acall
+
     @abstractmethod
     def flowing(self, **kwargs) -> Any:
         """
@@ -88,6 +123,19 @@ class Agent:
         """
         ...
 
+    async def aflowing(self, **kwargs) -> Any:
+        """
+        The async counterpart of `flowing`. By default, `flowing` runs in a worker thread (with the current context
+        variables) so the event loop is not blocked. Agents with a native async implementation override this method.
+
+        Parameters
+        ----------
+            **kwargs:
+                The parameters of the agent are determined by the user-defined `flowing` method of the object.
+        """
+
+        return await asyncio.to_thread(self.flowing, **kwargs)
+
     def set_information(self, information: dict) -> None:
         """
         Set the information of the agent. And check the format of the information.
@@ -10,12 +10,18 @@ to process messages with a predefined template and then utilize various language
 
 ## Features of the LLMAgent include:
 1. Template Usage: The agent utilizes a template, which is a list of strings formatted in OpenAI’s message structure.
-    The text content within this template can be dynamically formatted using f-strings.
+    The text content within this template can be dynamically formatted using f-strings. The template is compiled once
+    when it is assigned: the placeholders are parsed ahead of time, the messages without placeholders are shared by
+    every request and a call with missing arguments is rejected before any message is rendered.
 2. LLM Client: The agent includes a llm_client for invoking language model APIs. **Currently**, we use the OpenAI API.
     Users can also create their own LLM API by emulating the code found in `utils.llm.openai_client`.
 3. Streaming Option: The agent has a stream parameter that controls whether the assistant’s messages are processed in a
-    streaming manner.
-4. Original Response Control: There is an original_response parameter that determines whether to return the raw
+    streaming manner. With stop_when, the stream is closed as soon as the text received so far satisfies it.
+4. Async Path: `await agent.acall(...)` sends the request with the `arun` method of the client without blocking the
+    event loop. Clients without `arun` (and the streaming mode) run in a worker thread.
+5. Tracing: With tracing enabled (see `xyz.utils.tracing`), every non-streaming request is a span of its own, with the
+    latency, the attempts and the token counts reported by the client.
+6. Original Response Control: There is an original_response parameter that determines whether to return the raw
     response. If original_response is set to True, the raw response is returned; otherwise, only the content part is
         returned.
 
@@ -24,16 +30,68 @@ When creating a llm based agent, we need to pass messages and tools to the API.
     preprocessing before being sent. This agent facilitates this process, simplifying the engineering of prompts.
 """
 
+import asyncio
 import string
-from copy import deepcopy
-from typing import Generator, Any
+import time
+from typing import Callable, Generator, Any
 
 from xyz.node.agent import Agent
 from xyz.utils.llm.openai_client import OpenAIClient
+from xyz.utils.llm.telemetry import get_telemetry
+from xyz.utils.tracing import get_tracer
 
 __all__ = ["LLMAgent"]
 
 
+class _CompiledText:
+    """
+    A template string whose placeholders are parsed once.
+
+    The simple placeholders, e.g. "{question}" or "{value!r:>10}", are rendered directly from the pre-parsed segments.
+    The other ones (attribute or index access, nested format specs, positional fields) fall back to `str.format`.
+    """
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+        self.segments = []
+        self.names = []
+        self.simple = True
+
+        for literal, name, spec, conversion in string.Formatter().parse(text):
+            if name is None:
+                self.segments.append((literal, None, None, None))
+                continue
+            if not name.isidentifier() or "{" in (spec or ""):
+                self.simple = False
+            root = name.split(".")[0].split("[")[0]
+            if root and not root.isdigit() and root not in self.names:
+                self.names.append(root)
+            self.segments.append((literal, name, spec or "", conversion))
+
+    @property
+    def static(self) -> bool:
+        return self.simple and not self.names
+
+    def render(self, kwargs: dict) -> str:
+        if not self.simple:
+            return self.text.format(**kwargs)
+
+        parts = []
+        for literal, name, spec, conversion in self.segments:
+            parts.append(literal)
+            if name is None:
+                continue
+            value = kwargs[name]
+            if conversion == "r":
+                value = repr(value)
+            elif conversion == "a":
+                value = ascii(value)
+            elif conversion == "s":
+                value = str(value)
+            parts.append(format(value, spec))
+        return "".join(parts)
+
+
 class LLMAgent(Agent):
     """ 
     An assistant that uses the LLM (Language Learning Model) for processing messages.
@@ -42,13 +100,14 @@ class LLMAgent(Agent):
     llm_client: OpenAIClient
     last_request_info: dict
     node_config: dict
-    template: list
     generate_parameters: dict
     stream: bool
     original_response: bool
+    stop_when: Callable[[str], bool] | None
 
     def __init__(self, template: list, llm_client: OpenAIClient,
-                 stream: bool = False, original_response: bool = False) -> None:
+                 stream: bool = False, original_response: bool = False,
+                 stop_when: Callable[[str], bool] = None) -> None:
         # noinspection PyUnresolvedReferences
         """
         Initialize the assistant with the given template and core agent.
@@ -63,6 +122,9 @@ class LLMAgent(Agent):
             Whether to stream the assistant's messages, by default False.
         original_response: bool, optional
             Whether to return the original response, by default False.
+        stop_when: Callable, optional
+            In the streaming mode, a condition on the text received so far after which the stream is closed, e.g. once
+            the answer is complete. By default None (read the whole stream).
         """
         super().__init__()
 
@@ -71,12 +133,14 @@ class LLMAgent(Agent):
         self.template = template
         self.stream = stream
         self.original_response = original_response
+        self.stop_when = stop_when
 
         self.last_request_info = {}
 
     def flowing(self, messages: list = None,
                 tools: list = None,
-                images: list = None, **kwargs) -> str | Generator[str, None, None]:
+                images: list = None,
+                generate_args: dict = None, **kwargs) -> str | Generator[str, None, None]:
         """When you call this assistant, we will run the assistant with the given keyword arguments from the prompts.
         Before we call the OpenAI's API, we do some interface on this message.
 
@@ -88,6 +152,9 @@ class LLMAgent(Agent):
             The tools to use for completing the prompts, by default None.
         images: list, optional
             The images to use for completing the prompts, by default None.
+        generate_args: dict, optional
+            Arguments overriding the generate arguments of the client for this call only, e.g. {"n": 4}, by default
+            None. Not supported in the streaming mode.
         **kwargs
             The placeholders in the templates' text. They will be used to complete the prompts.
 
@@ -101,9 +168,10 @@ class LLMAgent(Agent):
         local_tools, tools = self._reset_default_list(tools)
         local_messages.extend(self._complete_prompts(**kwargs))
 
-        return self.request(messages=local_messages, tools=local_tools, images=images)
+        return self.request(messages=local_messages, tools=local_tools, images=images, generate_args=generate_args)
 
-    def request(self, messages: list, tools: list, images: list) -> str | Generator[str, None, None]:
+    def request(self, messages: list, tools: list, images: list,
+                generate_args: dict = None) -> str | Generator[str, None, None]:
         """
         Run the assistant with the given messages tools and images.
         """
@@ -115,17 +183,109 @@ class LLMAgent(Agent):
 
         if self.stream:
             return self._stream_run(messages=messages, images=images)
+
+        tracer = get_tracer()
+        if tracer is None:
+            return self._request(messages, tools, images, generate_args)
+        with tracer.span("LLMAgent.request", "llm", **self._span_args(messages, generate_args)):
+            return self._request(messages, tools, images, generate_args)
+
+    def _request(self, messages: list, tools: list, images: list, generate_args: dict = None) -> Any:
+        start = time.perf_counter()
+        if generate_args:
+            response = self.llm_client.run(messages=messages, tools=tools, images=images,
+                                           generate_args=generate_args)
         else:
             response = self.llm_client.run(messages=messages, tools=tools, images=images)
-            if self.original_response:
-                return response
+        self._record(start, response)
+        return self._content(response)
 
-            content = response.choices[0].message.content
+    async def aflowing(self, messages: list = None,
+                       tools: list = None,
+                       images: list = None,
+                       generate_args: dict = None, **kwargs) -> str | Generator[str, None, None]:
+        """
+        The async counterpart of `flowing`. See `flowing`.
+        """
 
-            if content is None:
-                return response.choices[0].message.tool_calls[0].function
-            else:
-                return content
+        local_messages, messages = self._reset_default_list(messages)
+        local_tools, tools = self._reset_default_list(tools)
+        local_messages.extend(self._complete_prompts(**kwargs))
+
+        return await self.arequest(messages=local_messages, tools=local_tools, images=images,
+                                   generate_args=generate_args)
+
+    async def arequest(self, messages: list, tools: list, images: list,
+                       generate_args: dict = None) -> str | Generator[str, None, None]:
+        """
+        The async counterpart of `request`. The client's `arun` is awaited if it has one; otherwise, and in the
+        streaming mode, `request` runs in a worker thread.
+        """
+
+        if self.stream or not hasattr(self.llm_client, "arun"):
+            return await asyncio.to_thread(self.request, messages=messages, tools=tools, images=images,
+                                           generate_args=generate_args)
+
+        self.last_request_info = {
+            "messages": messages,
+            "tools": tools
+        }
+
+        tracer = get_tracer()
+        if tracer is None:
+            return await self._arequest(messages, tools, images, generate_args)
+        with tracer.span("LLMAgent.request", "llm", **self._span_args(messages, generate_args)):
+            return await self._arequest(messages, tools, images, generate_args)
+
+    async def _arequest(self, messages: list, tools: list, images: list, generate_args: dict = None) -> Any:
+        start = time.perf_counter()
+        if generate_args:
+            response = await self.llm_client.arun(messages=messages, tools=tools, images=images,
+                                                  generate_args=generate_args)
+        else:
+            response = await self.llm_client.arun(messages=messages, tools=tools, images=images)
+        self._record(start, response)
+        return self._content(response)
+
+    def _span_args(self, messages: list, generate_args: dict | None) -> dict:
+        """
+        The arguments of the span of a request: the model and the size of the messages.
+        """
+
+        model = (generate_args or {}).get("model") or getattr(self.llm_client, "generate_args", {}).get("model")
+        return {"model": model, "messages": len(messages),
+                "message_chars": sum(len(m["content"]) if isinstance(m.get("content"), str) else 0 for m in messages)}
+
+    def _record(self, start: float, response) -> None:
+        """
+        Report the request to the telemetry, if it is enabled. Its latency includes the retries of the client. The
+        tokens, the attempts and the cost are recorded by the client, so the record carries none of them and the sums
+        over the sources count every call once.
+        """
+
+        telemetry = get_telemetry()
+        if telemetry is not None:
+            model = getattr(self.llm_client, "generate_args", {}).get("model") or getattr(response, "model", None)
+            telemetry.record("llm_agent", model=model,
+                             latency=time.perf_counter() - start,
+                             attempts=0, cost=0.,
+                             error=None if response is not None else "NoResponse",
+                             template_messages=len(self.template))
+
+    def _content(self, response) -> Any:
+        """
+        The content of a chat completion, its first tool call, or the response itself with original_response.
+        """
+
+        if self.original_response:
+            return response
+
+        content = response.choices[0].message.content
+
+        if content is None:
+            return response.choices[0].message.tool_calls[0].function
+        else:
+            return content
 
     def _stream_run(self, messages: list, images: list) -> Generator[str, None, None]:
         """
@@ -142,6 +302,8 @@ class LLMAgent(Agent):
             The generator for the token(already be decoded) in assistant's messages.
         """
 
+        if self.stop_when is not None:
+            return self.llm_client.stream_run(messages=messages, images=images, stop_when=self.stop_when)
         return self.llm_client.stream_run(messages=messages, images=images)
 
     def debug(self) -> dict[Any, Any]:
@@ -183,15 +345,63 @@ class LLMAgent(Agent):
         if parameter is None:
             local = []
         else:
-            local = deepcopy(parameter)
+            # A shallow copy: the caller's list is never modified, and its items are shared since they are not either.
+            local = list(parameter)
             parameter = None
 
         return local, parameter
 
+    @property
+    def template(self) -> list:
+        """
+        The template of the assistant's prompts. Assigning a new template compiles it again; a template modified in
+        place is not recompiled.
+        """
+
+        return self._template
+
+    @template.setter
+    def template(self, template: list) -> None:
+        if not isinstance(template, list):
+            raise TypeError("The template of the LLMAgent must be a list of OpenAI's messages.")
+
+        # Every message is compiled into a ready message (without placeholders, rendered once so the escaped braces
+        # are unescaped like `str.format` does), a `_CompiledText`, or a list of parts which are one or the other.
+        compiled = []
+        names = []
+        for message in template:
+            content = message.get('content')
+            if isinstance(content, str):
+                text = _CompiledText(content)
+                names.extend(name for name in text.names if name not in names)
+                compiled.append({**message, 'content': text.render({})} if text.static else text)
+            elif isinstance(content, list):
+                parts = []
+                for part in content:
+                    if isinstance(part, dict) and isinstance(part.get('content'), str):
+                        text = _CompiledText(part['content'])
+                        names.extend(name for name in text.names if name not in names)
+                        parts.append({**part, 'content': text.render({})} if text.static else text)
+                    else:
+                        parts.append(part)
+                if any(isinstance(part, _CompiledText) for part in parts):
+                    compiled.append(parts)
+                else:
+                    compiled.append({**message, 'content': parts})
+            else:
+                compiled.append(message)
+
+        self._template = template
+        self._compiled = compiled
+        self._variables = names
+
     def _complete_prompts(self, **kwargs) -> list:
         """
         Complete the assistant's prompts with the given keyword arguments.
 
+        The messages without placeholders are rendered once, when the template is assigned, and shared by every call;
+        only the dynamic ones are rendered into new messages. The returned messages must therefore not be modified in place.
+
         Parameters
         ----------
         **kwargs
@@ -199,34 +409,31 @@ class LLMAgent(Agent):
 
         Returns
         -------
-        tuple
-            A tuple containing the system message and the user message.
-        """
-
-        if type(self.template) is list:
+        list
+            The completed messages.
 
-            current_messages = deepcopy(self.template)
+        Raises
+        ------
+        ValueError
+            Some placeholders of the template are not given.
+        """
 
-            for i in range(len(current_messages)):
+        not_provided = [name for name in self._variables if name not in kwargs]
+        if not_provided:
+            raise ValueError(f"Missing required arguments: {not_provided} when calling the LLMAgent.")
 
-                if isinstance(current_messages[i]['content'], str):
-                    try:
-                        current_messages[i]['content'] = current_messages[i]['content'].format(**kwargs)
-                    except KeyError:
-                        variables = self.get_variables_from_fstring(current_messages[i]['content'])
-                        not_provided = [var for var in variables if var not in kwargs]
-                        raise ValueError(f"Missing required arguments: {not_provided} when calling the LLMAgent.")
-                elif isinstance(current_messages[i]['content'], list):
-                    for j in range(len(current_messages[i]['content'])):
-                        try:
-                            current_messages[i]['content'][j]['content'] = current_messages[i]['content'][j][
-                                'content'].format(**kwargs)
-                        except KeyError:
-                            variables = self.get_variables_from_fstring(current_messages[i]['content'][j]['content'])
-                            not_provided = [var for var in variables if var not in kwargs]
-                            raise ValueError(f"Missing required arguments: {not_provided} when calling the LLMAgent.")
+        current_messages = []
+        for message, compiled in zip(self._template, self._compiled):
+            if isinstance(compiled, dict):
+                current_messages.append(compiled)
+            elif isinstance(compiled, _CompiledText):
+                current_messages.append({**message, 'content': compiled.render(kwargs)})
+            else:
+                content = [{**part, 'content': text.render(kwargs)} if isinstance(text, _CompiledText) else text
+                           for part, text in zip(message['content'], compiled)]
+                current_messages.append({**message, 'content': content})
 
-            return current_messages
+        return current_messages
 
     @staticmethod
     def get_variables_from_fstring(fstring):
@@ -0,0 +1,135 @@
+"""
+================
+CheckpointWriter
+================
+@file_name: checkpoint.py
+@description:
+This module implements an append-only JSONL writer used to checkpoint long running generation and evaluation runs.
+Every line of the output file is a JSON object `{problem_id: value}`.
+
+## Features of the CheckpointWriter include:
+1. Resume: With `resume=True` the existing output file is scanned, the ids of the completed problems are collected in
+    `completed`, and new results are appended. A partially written last line (e.g. the process was killed in the middle
+    of a write) is truncated away; blank and corrupt lines elsewhere are skipped.
+2. Durability: Every line is flushed to the OS immediately, and the file is `fsync`ed every `fsync_every` lines and when
+    the writer is closed, so at most a handful of results are lost on a power failure.
+
+## Motivation
+A multi-hour run which crashes at problem 300 should not have to start from problem 1 again.
+"""
+
+import json
+import os
+from typing import Any, Callable
+
+__all__ = ["CheckpointWriter"]
+
+
+class CheckpointWriter:
+    """
+    An append-only JSONL writer which can resume from an existing output file.
+    """
+    path: str
+    completed: set
+    fsync_every: int
+
+    def __init__(self, path: str, resume: bool = False, fsync_every: int = 20,
+                 is_complete: Callable[[Any], bool] = None) -> None:
+        """
+        Open the output file.
+
+        Parameters
+        ----------
+        path: str
+            The path of the output JSONL file.
+        resume: bool, optional
+            Whether to keep the existing results and append to the file, by default False. If False, the file is
+            truncated.
+        fsync_every: int, optional
+            The number of lines between two `fsync` calls, by default 20.
+        is_complete: Callable, optional
+            Decide whether an existing value counts as completed. By default, every value except None is completed.
+        """
+
+        self.path = path
+        self.completed = set()
+        self.fsync_every = fsync_every
+        self._is_complete = is_complete or (lambda value: value is not None)
+        self._unsynced = 0
+
+        if resume and os.path.exists(path):
+            self._scan()
+            self._file = open(path, 'a')
+        else:
+            self._file = open(path, 'w')
+
+    def _scan(self) -> None:
+        """
+        Collect the completed problem ids and truncate an incomplete trailing line. Blank lines are skipped, and a
+        corrupt line in the middle of the file is reported and left in place.
+        """
+
+        offset = 0
+        bad = None
+        with open(self.path, 'rb') as file:
+            for number, line in enumerate(file, start=1):
+                start, offset = offset, offset + len(line)
+                if bad is not None:
+                    print(f"Skipping the corrupt line {bad[0]} of {self.path}.")
+                    bad = None
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    record = None
+                if not isinstance(record, dict) or not line.endswith(b'\n'):
+                    # Only the last line can be cut off by a crash: decide once the next line is read.
+                    bad = (number, start)
+                    continue
+                for key, value in record.items():
+                    if self._is_complete(value):
+                        self.completed.add(key)
+
+        if bad is not None:
+            print(f"Truncating the incomplete tail of {self.path} at byte {bad[1]}.")
+            with open(self.path, 'r+b') as file:
+                file.truncate(bad[1])
+
+    def write(self, line: str) -> None:
+        """
+        Append one JSON line (including the trailing newline) to the file.
+        """
+
+        self._file.write(line)
+        self._file.flush()
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every:
+            self.sync()
+
+    def write_record(self, key: str, value: Any) -> None:
+        """
+        Append the record `{key: value}` to the file.
+        """
+
+        self.write(json.dumps({key: value}) + '\n')
+
+    def sync(self) -> None:
+        """
+        Flush the file and force it to the disk.
+        """
+
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def close(self) -> None:
+        if not self._file.closed:
+            self.sync()
+            self._file.close()
+
+    def __enter__(self) -> "CheckpointWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
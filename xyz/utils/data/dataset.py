@@ -0,0 +1,321 @@
+"""
+==========
+JsonlStore
+==========
+@file_name: dataset.py
+@description:
+This module implements an indexed, memory-mapped, read-only view of a JSONL file whose lines are
+`{problem_id: value}` objects: the dataset (`final-odyssey-math-with-levels.jsonl`), the model outputs (`jsonl/*.jsonl`)
+and the evaluation results (`jsonl/eval/*.jsonl`).
+
+## Features of the JsonlStore include:
+1. Persistent Index: The byte offset of every record is computed once and saved under `.cache/jsonl_index/`. The index
+    is reused while the file is unchanged, and extended (not rebuilt) when the file only grew, e.g. an output file
+    which is still being written.
+2. O(1) Lookup: `store[problem_id]` parses only the line of that problem, from a memory map of the file.
+3. Filters: When the values are dicts, the ids are indexed by their `label` and `level` (the posting lists are part of
+    the index), so `store.ids(label="Geometry", level="college math")` costs no parsing.
+4. Projection: `store.iter(fields=("question", "answer"))` yields only the requested fields of the selected records.
+
+## Usage
+```python
+store = JsonlStore("final-odyssey-math-with-levels.jsonl")
+print(store.labels(), store.levels())
+for problem_id, problem in store.iter(fields=("question",), level="college math"):
+    ...
+```
+
+## Motivation
+Every script re-read and re-parsed the whole dataset to look a few problems up or to select a subset, and the model
+output files with their long solutions are much larger than the dataset.
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import re
+from typing import Any, Iterator
+
+__all__ = ["JsonlStore"]
+
+_KEY = re.compile(rb'^\s*\{\s*"((?:[^"\\]|\\.)*)"\s*:')
+
+# The format of the saved index. Bump it when the layout changes.
+_INDEX_VERSION = 1
+
+
+class JsonlStore:
+    """
+    A read-only, indexed view of a `{problem_id: value}` JSONL file.
+    """
+    path: str
+    index_path: str | None
+    filter_fields: tuple
+
+    def __init__(self, path: str, index_dir: str | None = ".cache/jsonl_index",
+                 filter_fields: tuple = ("label", "level")) -> None:
+        """
+        Parameters
+        ----------
+        path: str
+            The JSONL file.
+        index_dir: str, optional
+            The directory of the saved indexes, by default ".cache/jsonl_index". None keeps the index in memory only.
+        filter_fields: tuple, optional
+            The fields of the dict values with posting lists, by default ("label", "level").
+        """
+
+        self.path = path
+        self.filter_fields = tuple(filter_fields)
+        self.index_path = None
+        if index_dir is not None:
+            digest = hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()[:16]
+            self.index_path = os.path.join(index_dir, f"{os.path.basename(path)}.{digest}.json")
+
+        self._file = None
+        self._map = None
+        self._load_index()
+
+    # ----------------------------------------------------------------------------------------------------------------
+    # Index
+
+    def _load_index(self) -> None:
+        stat = os.stat(self.path)
+        index = None
+        if self.index_path is not None and os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, "r") as file:
+                    index = json.load(file)
+            except (OSError, ValueError):
+                index = None
+        if index is not None and (index.get("version") != _INDEX_VERSION
+                                  or index.get("filter_fields") != list(self.filter_fields)):
+            index = None
+
+        if index is not None and index["size"] == stat.st_size and index["mtime_ns"] == stat.st_mtime_ns:
+            self._set_index(index)
+            return
+
+        if index is not None and index["size"] < stat.st_size and self._is_prefix(index):
+            # The file only grew: index the new lines.
+            self._set_index(index)
+            self._scan(index["size"])
+        else:
+            self._set_index({"offsets": {}, "order": [], "postings": {}, "duplicates": 0, "size": 0,
+                             "tail": ""})
+            self._scan(0)
+        self._save_index(stat)
+
+    def _set_index(self, index: dict) -> None:
+        self._offsets = index["offsets"]
+        self._order = index["order"]
+        self._postings = {field: {value: list(ids) for value, ids in values.items()}
+                          for field, values in index["postings"].items()}
+        self.duplicates = index["duplicates"]
+        self._size = index["size"]
+        self._tail = index.get("tail", "")
+
+    def _is_prefix(self, index: dict) -> bool:
+        """
+        Whether the indexed part of the file is unchanged, checked on its last bytes.
+        """
+
+        tail = index.get("tail", "").encode("latin-1")
+        if not tail:
+            return index["size"] == 0
+        with open(self.path, "rb") as file:
+            file.seek(index["size"] - len(tail))
+            return file.read(len(tail)) == tail
+
+    def _scan(self, start: int) -> None:
+        """
+        Index the lines from byte `start`. A last line without a newline is only indexed if it is valid JSON,
+        otherwise it is being written and left for the next scan.
+        """
+
+        offset = start
+        with open(self.path, "rb") as file:
+            file.seek(start)
+            for line in file:
+                if not line.endswith(b"\n"):
+                    try:
+                        json.loads(line)
+                    except ValueError:
+                        break
+                match = _KEY.match(line)
+                if match:
+                    problem_id = json.loads(b'"' + match.group(1) + b'"')
+                    if problem_id in self._offsets:
+                        self.duplicates += 1
+                    else:
+                        self._offsets[problem_id] = [offset, len(line)]
+                        self._order.append(problem_id)
+                        if self.filter_fields:
+                            self._post(problem_id, line)
+                offset += len(line)
+        self._size = offset
+        if offset:
+            with open(self.path, "rb") as file:
+                file.seek(max(0, offset - 64))
+                self._tail = file.read(offset - max(0, offset - 64)).decode("latin-1")
+
+    def _post(self, problem_id: str, line: bytes) -> None:
+        try:
+            value = json.loads(line)[problem_id]
+        except (ValueError, KeyError):
+            return
+        if not isinstance(value, dict):
+            return
+        for field in self.filter_fields:
+            if field in value and isinstance(value[field], (str, int, float, bool)):
+                self._postings.setdefault(field, {}).setdefault(str(value[field]), []).append(problem_id)
+
+    def _save_index(self, stat: os.stat_result) -> None:
+        if self.index_path is None:
+            return
+        index = {
+            "version": _INDEX_VERSION,
+            "filter_fields": list(self.filter_fields),
+            "size": self._size,
+            # The mtime only validates a complete scan: a partial one is extended from its size next time.
+            "mtime_ns": stat.st_mtime_ns if self._size == stat.st_size else None,
+            "tail": self._tail,
+            "duplicates": self.duplicates,
+            "offsets": self._offsets,
+            "order": self._order,
+            "postings": self._postings,
+        }
+        try:
+            os.makedirs(os.path.dirname(self.index_path) or ".", exist_ok=True)
+            with open(self.index_path + ".tmp", "w") as file:
+                json.dump(index, file)
+            os.replace(self.index_path + ".tmp", self.index_path)
+        except OSError:
+            # A read-only location only costs a rescan next time.
+            pass
+
+    def refresh(self) -> None:
+        """
+        Pick up the lines appended since the store was opened (or rebuild the index if the file was rewritten).
+        """
+
+        self.close()
+        self._load_index()
+
+    # ----------------------------------------------------------------------------------------------------------------
+    # Access
+
+    def _bytes(self, problem_id: str) -> bytes:
+        offset, length = self._offsets[problem_id]
+        if self._map is None:
+            self._file = open(self.path, "rb")
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map[offset:offset + length]
+
+    def raw(self, problem_id: str) -> bytes:
+        """
+        The JSON line of a problem, without parsing it.
+        """
+
+        return self._bytes(problem_id)
+
+    def __getitem__(self, problem_id: str) -> Any:
+        return json.loads(self._bytes(problem_id))[problem_id]
+
+    def get(self, problem_id: str, default: Any = None, fields: tuple = None) -> Any:
+        """
+        The value of a problem (only `fields` of it if given), or `default` if the id is unknown.
+        """
+
+        if problem_id not in self._offsets:
+            return default
+        return _project(self[problem_id], fields)
+
+    def __contains__(self, problem_id: str) -> bool:
+        return problem_id in self._offsets
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._order)
+
+    def ids(self, **filters) -> list:
+        """
+        The ids in file order, restricted to the records whose fields equal the given values, e.g.
+        `ids(label="Geometry")`. A value may also be a list or set of accepted values.
+        """
+
+        if not filters:
+            return list(self._order)
+        selected = None
+        for field, accepted in filters.items():
+            if field not in self.filter_fields:
+                raise ValueError(f"The field {field!r} is not indexed, the indexed fields are {self.filter_fields}.")
+            if isinstance(accepted, (list, tuple, set, frozenset)):
+                values = [str(value) for value in accepted]
+            else:
+                values = [str(accepted)]
+            postings = self._postings.get(field, {})
+            matched = set()
+            for value in values:
+                matched.update(postings.get(value, ()))
+            selected = matched if selected is None else selected & matched
+        return [problem_id for problem_id in self._order if problem_id in selected]
+
+    def values(self, field: str) -> dict:
+        """
+        The number of records for every value of an indexed field.
+        """
+
+        return {value: len(ids) for value, ids in self._postings.get(field, {}).items()}
+
+    def labels(self) -> dict:
+        return self.values("label")
+
+    def levels(self) -> dict:
+        return self.values("level")
+
+    def iter(self, fields: tuple = None, ids: list = None, **filters) -> Iterator[tuple[str, Any]]:
+        """
+        Lazily yield (problem_id, value) in file order.
+
+        Parameters
+        ----------
+        fields: tuple, optional
+            Only keep these fields of the dict values, by default all of them.
+        ids: list, optional
+            Only yield these ids (in this order), by default all of them.
+        filters
+            Field filters, see `ids()`.
+        """
+
+        if ids is None:
+            ids = self.ids(**filters)
+        elif filters:
+            allowed = set(self.ids(**filters))
+            ids = [problem_id for problem_id in ids if problem_id in allowed]
+        for problem_id in ids:
+            if problem_id in self._offsets:
+                yield problem_id, _project(self[problem_id], fields)
+
+    def close(self) -> None:
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self) -> "JsonlStore":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def _project(value: Any, fields: tuple | None) -> Any:
+    if fields is None or not isinstance(value, dict):
+        return value
+    return {field: value[field] for field in fields if field in value}
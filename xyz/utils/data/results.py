@@ -0,0 +1,403 @@
+"""
+============
+ResultsStore
+============
+@file_name: results.py
+@description:
+This module keeps the evaluation results (`jsonl/eval/result-*.jsonl`) of many runs in a compact columnar store and
+aggregates them with vectorized NumPy operations.
+
+## Features of the ResultsStore include:
+1. Columnar Layout: One row per (model, problem) with int8 verdicts and categorical codes for the model, the problem,
+    the label and the level. The store of all the runs of the repository fits in a few tens of kilobytes.
+2. Incremental Import: `load_results()` saves the store (`.npz`) with the size and mtime of every imported file and
+    only re-imports the files which changed, so refreshing a dashboard over dozens of runs only reads one small file.
+3. Verdict Parsing: The verdicts are parsed once, at import, with the rules of `visualize.ipynb`: an integer, else the
+    first integer word of a verbose answer, else "Score: N", else 0. The rows whose verdict was not a clean "0"/"1"
+    are flagged in `clean`.
+4. Aggregates: `accuracy(by=...)` (any combination of model, label and level, with a `bincount`), `deltas()` (the
+    pairwise accuracy differences of the models on their common problems, as matrix products) and `bootstrap()` (the
+    paired bootstrap confidence intervals of the accuracies and of the deltas).
+
+## Usage
+```python
+store = load_results(glob.glob("jsonl/eval/result-*.jsonl"))
+correct, total = store.counts(by=("model", "level"))
+print(store.select(level="college math").bootstrap(samples=2000))
+```
+See also `analyze_results.py`.
+
+## Motivation
+The accuracy tables were computed in the notebook by re-parsing every result file with Python loops, one file at a
+time, and the verbose judge answers had to be handled in every copy of the loop.
+"""
+
+import json
+import os
+import re
+import warnings
+from typing import Any
+
+import numpy as np
+
+__all__ = ["ResultsStore", "load_results", "parse_verdict", "model_name"]
+
+_COLUMNS = ("model", "problem", "label", "level")
+
+
+def parse_verdict(value: Any) -> tuple[int, bool]:
+    """
+    Parse a judge verdict.
+
+    Returns
+    -------
+    tuple
+        The score (1 is correct, anything else is not) and whether the verdict was a clean "0" or "1".
+    """
+
+    text = str(value).strip()
+    if text in ("0", "1"):
+        return int(text), True
+    try:
+        return int(text), False
+    except ValueError:
+        pass
+    for part in re.split(r"\s+", text):
+        try:
+            return int(part), False
+        except ValueError:
+            continue
+    match = re.search(r"Score:\s*(-?\d+)", text)
+    return (int(match.group(1)) if match else 0), False
+
+
+def model_name(path: str) -> str:
+    """
+    The name of the run of a result file: `jsonl/eval/result-gpt-4-0613-solution-clean.jsonl` is
+    `gpt-4-0613-solution-clean`.
+    """
+
+    name = os.path.splitext(os.path.basename(path))[0]
+    return name[len("result-"):] if name.startswith("result-") else name
+
+
+def _natural(problem_id: str) -> tuple:
+    return tuple((0, int(part), "") if part.isdigit() else (1, 0, part)
+                 for part in re.split(r"(\d+)", problem_id) if part)
+
+
+class ResultsStore:
+    """
+    The evaluation results of several runs as NumPy columns.
+    """
+    models: list
+    problems: list
+    labels: list
+    levels: list
+
+    def __init__(self, categories: dict, columns: dict, sources: dict = None) -> None:
+        """
+        Parameters
+        ----------
+        categories: dict
+            The values of every categorical column ("model", "problem", "label" and "level"), indexed by their code.
+        columns: dict
+            The equal-length arrays "model", "problem", "label", "level" (the codes), "correct" (0/1) and "clean"
+            (whether the verdict was a clean "0"/"1").
+        sources: dict, optional
+            {path: [size, mtime_ns, model]} of the imported files.
+        """
+
+        self.models = list(categories["model"])
+        self.problems = list(categories["problem"])
+        self.labels = list(categories["label"])
+        self.levels = list(categories["level"])
+        self.columns = columns
+        self.sources = sources or {}
+
+    def __len__(self) -> int:
+        return len(self.columns["correct"])
+
+    def categories(self, column: str) -> list:
+        return {"model": self.models, "problem": self.problems, "label": self.labels, "level": self.levels}[column]
+
+    # ----------------------------------------------------------------------------------------------------------------
+    # Import and persistence
+
+    @classmethod
+    def from_rows(cls, rows: list, sources: dict = None) -> "ResultsStore":
+        """
+        Build a store from (model, problem_id, label, level, correct, clean) rows, with the verdicts parsed by
+        `parse_verdict`. A later row replaces an earlier one with the same model and problem.
+        """
+
+        latest = {}
+        for model, problem_id, label, level, correct, clean in rows:
+            latest[(model, problem_id)] = (label, level, correct, clean)
+
+        categories = {
+            "model": sorted({model for model, _ in latest}),
+            "problem": sorted({problem_id for _, problem_id in latest}, key=_natural),
+            "label": sorted({str(row[0]) for row in latest.values()}),
+            "level": sorted({str(row[1]) for row in latest.values()}),
+        }
+        codes = {column: {value: code for code, value in enumerate(values)} for column, values in categories.items()}
+
+        size = len(latest)
+        columns = {
+            "model": np.empty(size, dtype=np.int32),
+            "problem": np.empty(size, dtype=np.int32),
+            "label": np.empty(size, dtype=np.int32),
+            "level": np.empty(size, dtype=np.int32),
+            "correct": np.empty(size, dtype=np.int8),
+            "clean": np.empty(size, dtype=bool),
+        }
+        for row, ((model, problem_id), (label, level, correct, clean)) in enumerate(latest.items()):
+            columns["model"][row] = codes["model"][model]
+            columns["problem"][row] = codes["problem"][problem_id]
+            columns["label"][row] = codes["label"][str(label)]
+            columns["level"][row] = codes["level"][str(level)]
+            columns["correct"][row] = correct
+            columns["clean"][row] = clean
+        return cls(categories, columns, sources)
+
+    @classmethod
+    def from_files(cls, paths: list) -> "ResultsStore":
+        """
+        Import result files, one run per file (named by `model_name`).
+        """
+
+        rows, sources = [], {}
+        for path in paths:
+            rows.extend(_read_rows(path))
+            sources[path] = _signature(path)
+        return cls.from_rows(rows, sources)
+
+    def rows(self) -> list:
+        """
+        The (model, problem_id, label, level, correct, clean) rows of the store.
+        """
+
+        return [(self.models[m], self.problems[p], self.labels[a], self.levels[v], bool(c), bool(k))
+                for m, p, a, v, c, k in zip(*(self.columns[column].tolist()
+                                               for column in (*_COLUMNS, "correct", "clean")))]
+
+    def save(self, path: str) -> None:
+        """
+        Save the store to a `.npz` file, atomically.
+        """
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        arrays = {f"column_{name}": values for name, values in self.columns.items()}
+        for column in _COLUMNS:
+            arrays[f"categories_{column}"] = np.array(self.categories(column), dtype=str)
+        arrays["sources"] = np.array(json.dumps(self.sources))
+        with open(path + ".tmp", "wb") as file:
+            np.savez_compressed(file, **arrays)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path: str) -> "ResultsStore":
+        with np.load(path) as data:
+            categories = {column: data[f"categories_{column}"].tolist() for column in _COLUMNS}
+            columns = {name[len("column_"):]: data[name] for name in data.files if name.startswith("column_")}
+            sources = json.loads(str(data["sources"]))
+        return cls(categories, columns, sources)
+
+    # ----------------------------------------------------------------------------------------------------------------
+    # Selection
+
+    def select(self, **filters) -> "ResultsStore":
+        """
+        The rows whose columns equal the given values, e.g. `select(level="college math", model=["a", "b"])`. A
+        value may be a list of accepted values. The categories are kept, so tables of selections stay aligned.
+        """
+
+        mask = np.ones(len(self), dtype=bool)
+        for column, accepted in filters.items():
+            values = accepted if isinstance(accepted, (list, tuple, set)) else [accepted]
+            codes = [self.categories(column).index(value) for value in values if value in self.categories(column)]
+            mask &= np.isin(self.columns[column], codes)
+        categories = {column: self.categories(column) for column in _COLUMNS}
+        return ResultsStore(categories, {name: values[mask] for name, values in self.columns.items()}, self.sources)
+
+    # ----------------------------------------------------------------------------------------------------------------
+    # Aggregates
+
+    def counts(self, by: tuple = ("model",)) -> tuple[np.ndarray, np.ndarray]:
+        """
+        The number of correct answers and of answers, grouped by the given columns.
+
+        Returns
+        -------
+        tuple
+            Two integer arrays of shape (len(categories(by[0])), len(categories(by[1])), ...).
+        """
+
+        shape = tuple(len(self.categories(column)) for column in by)
+        index = np.ravel_multi_index(tuple(self.columns[column] for column in by), shape) if by else \
+            np.zeros(len(self), dtype=np.int64)
+        size = int(np.prod(shape)) if by else 1
+        total = np.bincount(index, minlength=size).reshape(shape)
+        correct = np.bincount(index, weights=self.columns["correct"], minlength=size).astype(np.int64).reshape(shape)
+        return correct, total
+
+    def accuracy(self, by: tuple = ("model",)) -> np.ndarray:
+        """
+        The accuracy grouped by the given columns (see `counts`), NaN for the empty groups.
+        """
+
+        correct, total = self.counts(by)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(total > 0, correct / np.maximum(total, 1), np.nan)
+
+    def grid(self) -> np.ndarray:
+        """
+        The (models, problems) matrix of the verdicts, -1 where a model has no result for a problem.
+        """
+
+        grid = np.full((len(self.models), len(self.problems)), -1, dtype=np.int8)
+        grid[self.columns["model"], self.columns["problem"]] = self.columns["correct"]
+        return grid
+
+    def deltas(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        The pairwise accuracy differences of the models, each pair compared on the problems both were evaluated on.
+
+        Returns
+        -------
+        tuple
+            delta[i, j] (accuracy of model i minus accuracy of model j, NaN without common problems) and common[i, j]
+            (the number of common problems).
+        """
+
+        grid = self.grid()
+        present = (grid >= 0).astype(np.float64)
+        correct = np.where(grid > 0, 1., 0.)
+        common = present @ present.T
+        with np.errstate(invalid="ignore", divide="ignore"):
+            delta = (correct @ present.T - present @ correct.T) / common
+        return np.where(common > 0, delta, np.nan), common.astype(np.int64)
+
+    def bootstrap(self, samples: int = 1000, confidence: float = 0.95, seed: int = 0) -> dict:
+        """
+        Paired bootstrap over the problems: every sample draws the problems with replacement and scores every model on
+        the same draw.
+
+        Parameters
+        ----------
+        samples: int, optional
+            The number of bootstrap samples, by default 1000.
+        confidence: float, optional
+            The confidence level of the intervals, by default 0.95.
+        seed: int, optional
+            The seed of the generator, by default 0.
+
+        Returns
+        -------
+        dict
+            "accuracy", "low" and "high" (per model), and "delta", "delta_low", "delta_high" (per pair of models,
+            see `deltas`).
+        """
+
+        grid = self.grid()
+        # Only the problems with at least one result are drawn.
+        grid = grid[:, (grid >= 0).any(axis=0)]
+        problems = grid.shape[1]
+        present = (grid >= 0).astype(np.float64)
+        correct = np.where(grid > 0, 1., 0.)
+
+        rng = np.random.default_rng(seed)
+        draws = rng.integers(0, problems, size=(samples, problems))
+        # weights[s, p]: how many times problem p is drawn in sample s.
+        weights = np.bincount((draws + problems * np.arange(samples)[:, None]).ravel(),
+                              minlength=samples * problems).reshape(samples, problems).astype(np.float64)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            accuracy = (weights @ correct.T) / (weights @ present.T)
+            both = np.einsum("sp,ip,jp->sij", weights, present, present, optimize=True)
+            delta = (np.einsum("sp,ip,jp->sij", weights, correct, present, optimize=True)
+                     - np.einsum("sp,ip,jp->sij", weights, present, correct, optimize=True)) / both
+
+        tail = (1. - confidence) / 2. * 100.
+        point_delta, _ = self.deltas()
+        with warnings.catch_warnings():
+            # The models without results (e.g. filtered out by `select`) only have NaN samples.
+            warnings.simplefilter("ignore", RuntimeWarning)
+            return {
+                "accuracy": self.accuracy(("model",)),
+                "low": np.nanpercentile(accuracy, tail, axis=0),
+                "high": np.nanpercentile(accuracy, 100. - tail, axis=0),
+                "delta": point_delta,
+                "delta_low": np.nanpercentile(delta, tail, axis=0),
+                "delta_high": np.nanpercentile(delta, 100. - tail, axis=0),
+            }
+
+
+def _signature(path: str) -> list:
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns, model_name(path)]
+
+
+def _read_rows(path: str) -> list:
+    model = model_name(path)
+    rows = []
+    with open(path, "r") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                print(f"Skipping a corrupt line of {path}.")
+                continue
+            for problem_id, value in record.items():
+                score, clean = parse_verdict(value.get("is_correct"))
+                rows.append((model, problem_id, value.get("label"), value.get("level"), score == 1, clean))
+    return rows
+
+
+def load_results(paths: list, store_path: str | None = ".cache/results.npz") -> ResultsStore:
+    """
+    Load the results of the given files, through the saved store: only the files added or changed since the store was
+    saved are read, and the runs of the files which are no longer given are dropped.
+
+    Parameters
+    ----------
+    paths: list
+        The result files.
+    store_path: str, optional
+        The saved store, by default ".cache/results.npz". None always imports every file.
+
+    Returns
+    -------
+    ResultsStore
+        The store of the given files.
+    """
+
+    if store_path is None:
+        return ResultsStore.from_files(paths)
+
+    store = None
+    if os.path.exists(store_path):
+        try:
+            store = ResultsStore.load(store_path)
+        except (OSError, ValueError, KeyError):
+            store = None
+    if store is None:
+        store = ResultsStore.from_files([])
+
+    signatures = {path: _signature(path) for path in paths}
+    if store.sources == signatures:
+        return store
+
+    unchanged = {path for path, signature in signatures.items() if store.sources.get(path) == signature}
+    kept_models = {signature[2] for path, signature in store.sources.items() if path in unchanged}
+    rows = [row for row in store.rows() if row[0] in kept_models]
+    for path in paths:
+        if path not in unchanged:
+            rows.extend(_read_rows(path))
+
+    store = ResultsStore.from_rows(rows, signatures)
+    store.save(store_path)
+    return store
@@ -0,0 +1,226 @@
+"""
+=============
+ResponseCache
+=============
+@file_name: cache.py
+@description:
+This module implements a persistent, content-addressed cache for LLM responses. It is backed by a single SQLite file, so
+it can be shared by several processes running on the same machine.
+
+## Features of the ResponseCache include:
+1. Content Addressing: A request is identified by the SHA-256 of its canonical JSON form (messages, tools and generate
+    arguments). Two requests with the same content always map to the same entry.
+2. Determinism Guard: By default only requests with `temperature == 0` are cached, because other requests are not
+    expected to return the same answer twice.
+3. Eviction: Entries older than `max_age` seconds are dropped, and when the cache grows beyond `max_entries` or
+    `max_bytes` the least recently used entries are evicted.
+4. Statistics: The `hits` and `misses` counters, together with the size of the store, are available from `stats()`.
+
+## Motivation
+Re-running the evaluator on the same predictions, or re-solving after a crash, would otherwise pay the full latency and
+cost of every request again.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+__all__ = ["ResponseCache"]
+
+
+class ResponseCache:
+    """
+    An on-disk cache of LLM responses keyed by a stable hash of the request.
+    """
+    path: str
+    max_entries: int | None
+    max_bytes: int | None
+    max_age: float | None
+    only_deterministic: bool
+    hits: int
+    misses: int
+
+    def __init__(self, path: str = ".cache/llm_responses.sqlite", max_entries: int | None = 100000,
+                 max_bytes: int | None = None, max_age: float | None = None, only_deterministic: bool = True) -> None:
+        """
+        Open (or create) the cache.
+
+        Parameters
+        ----------
+        path: str, optional
+            The path of the SQLite file, by default ".cache/llm_responses.sqlite".
+        max_entries: int, optional
+            The maximum number of entries, by default 100000. None means unlimited.
+        max_bytes: int, optional
+            The maximum total size of the stored responses in bytes, by default None (unlimited).
+        max_age: float, optional
+            The maximum age of an entry in seconds, by default None (entries never expire).
+        only_deterministic: bool, optional
+            Whether to cache only requests with temperature 0, by default True.
+        """
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.only_deterministic = only_deterministic
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self._connection.commit()
+
+    @staticmethod
+    def make_key(request: dict) -> str:
+        """
+        Compute the stable key of a request.
+
+        Parameters
+        ----------
+        request: dict
+            The JSON-serializable content of the request.
+
+        Returns
+        -------
+        str
+            The hex digest of the canonical JSON form of the request.
+        """
+
+        canonical = json.dumps(request, sort_keys=True, ensure_ascii=False, separators=(',', ':'), default=str)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def cacheable(self, generate_args: dict) -> bool:
+        """
+        Whether a request made with these generate arguments may be served from the cache.
+        """
+
+        if generate_args.get("stream"):
+            return False
+        if self.only_deterministic:
+            return generate_args.get("temperature", 1.0) == 0
+        return True
+
+    def get(self, key: str) -> str | None:
+        """
+        Look up a stored response.
+
+        Parameters
+        ----------
+        key: str
+            The key produced by `make_key`.
+
+        Returns
+        -------
+        str | None
+            The stored response, or None on a miss.
+        """
+
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or (self.max_age is not None and now - row[1] > self.max_age):
+                self.misses += 1
+                return None
+            self._connection.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self._connection.commit()
+            self.hits += 1
+            return row[0]
+
+    def set(self, key: str, value: str) -> None:
+        """
+        Store a response and evict the entries exceeding the limits.
+
+        Parameters
+        ----------
+        key: str
+            The key produced by `make_key`.
+        value: str
+            The serialized response.
+        """
+
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value.encode("utf-8")), now, now)
+            )
+            self._evict(now)
+            self._connection.commit()
+
+    def _evict(self, now: float) -> None:
+        """
+        Drop the expired entries, then the least recently used ones until the cache fits in its limits.
+        """
+
+        if self.max_age is not None:
+            self._connection.execute("DELETE FROM responses WHERE created < ?", (now - self.max_age,))
+
+        if self.max_entries is not None:
+            self._connection.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+        if self.max_bytes is not None:
+            total = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                rows = self._connection.execute("SELECT key, size FROM responses ORDER BY accessed ASC").fetchall()
+                evicted = []
+                for key, size in rows:
+                    if total <= self.max_bytes:
+                        break
+                    evicted.append((key,))
+                    total -= size
+                self._connection.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def clear(self) -> None:
+        """
+        Remove all entries and reset the counters.
+        """
+
+        with self._lock:
+            self._connection.execute("DELETE FROM responses")
+            self._connection.commit()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        """
+        The hit/miss counters and the size of the cache.
+
+        Returns
+        -------
+        dict
+            The keys are "hits", "misses", "hit_rate", "entries" and "bytes".
+        """
+
+        with self._lock:
+            entries, size = self._connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.,
+            "entries": entries,
+            "bytes": size,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
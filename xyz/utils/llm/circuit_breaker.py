@@ -0,0 +1,363 @@
+"""
+==============
+CircuitBreaker
+==============
+@file_name: circuit_breaker.py
+@description:
+This module stops sending requests to an LLM endpoint which is down, and fails over to alternate endpoints.
+
+## Features of the CircuitBreaker include:
+1. Three States: A breaker is `closed` (requests go through) until `failure_threshold` consecutive failures, then
+    `open` (requests fail fast with `CircuitOpenError`) for `recovery_time` seconds, then `half_open`: one probe request
+    is let through, and its outcome closes the breaker or opens it again for twice as long (up to `max_recovery_time`).
+2. Health Failures Only: Only the errors which say something about the endpoint open a breaker: network errors,
+    timeouts and 5xx responses (see `error_info`). A 4xx is the fault of the request, and a 429 is left to the
+    `RateLimiter`.
+3. Shared per Endpoint: `get_breaker(endpoint)` returns the process-wide breaker of an endpoint, so every client and
+    every thread talking to the same endpoint sees the same health.
+4. Failover: `Failover` sends a request to the first healthy endpoint of an ordered list and moves on to the next one
+    when an endpoint fails. When every breaker is open, it raises `CircuitOpenError` with the time until the first
+    endpoint can be probed again.
+
+## Usage
+```python
+failover = Failover(["https://api.netmind.ai/inference-api/openai/v1", "https://backup.example.com/v1"])
+client = OpenAIClient(failover=failover, model="deepseek-v3")
+```
+`OpenAIClient` and `Llama3APIClient` send their requests through the failover, and `AsyncRunner` parks the problems
+which fail with `CircuitOpenError` and retries them once the run has gone through the others.
+
+## Motivation
+When a provider went down, every request of a sweep went through all its retries (and their sleeps) before failing,
+so a short outage stalled the run for hours.
+"""
+
+import threading
+import time
+from typing import Any, Awaitable, Callable
+
+from xyz.utils.llm.rate_limiter import error_info
+
+__all__ = ["CircuitBreaker", "CircuitOpenError", "Failover", "get_breaker", "is_health_failure"]
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised without sending the request when the breaker of the endpoint (of every endpoint, with a failover) is open.
+    `retry_at` is the `time.monotonic()` at which a probe will be let through.
+    """
+    retry_after: float
+    retry_at: float
+
+    def __init__(self, message: str, retry_after: float = 0.) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.retry_at = time.monotonic() + retry_after
+
+
+def is_health_failure(error: BaseException) -> bool:
+    """
+    Whether an error means that the endpoint is unhealthy: a network error, a timeout or a 5xx response.
+    """
+
+    if isinstance(error, CircuitOpenError):
+        return False
+    retryable, status, _ = error_info(error)
+    return retryable and (status is None or status >= 500)
+
+
+class CircuitBreaker:
+    """
+    The health of one endpoint: closed, open or half-open.
+    """
+    name: str
+    failure_threshold: int
+    recovery_time: float
+    max_recovery_time: float
+
+    def __init__(self, name: str = "endpoint", failure_threshold: int = 5, recovery_time: float = 30.,
+                 max_recovery_time: float = 600.) -> None:
+        """
+        Parameters
+        ----------
+        name: str, optional
+            The name of the endpoint, for the messages.
+        failure_threshold: int, optional
+            The number of consecutive health failures which open the breaker, by default 5.
+        recovery_time: float, optional
+            The seconds the breaker stays open before a probe, by default 30. It doubles after every failed probe.
+        max_recovery_time: float, optional
+            The upper bound of the recovery time, by default 600.
+        """
+
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.max_recovery_time = max_recovery_time
+
+        self._lock = threading.Lock()
+        self._state = "closed"
+        self._failures = 0
+        self._opened_at = 0.
+        self._cooldown = recovery_time
+        self._probing = False
+        self._stats = {"calls": 0, "failures": 0, "rejected": 0, "opened": 0}
+
+    @property
+    def state(self) -> str:
+        """
+        "closed", "open" or "half_open". An open breaker whose recovery time has passed is half-open.
+        """
+
+        with self._lock:
+            if self._state == "open" and time.monotonic() >= self._opened_at + self._cooldown:
+                return "half_open"
+            return self._state
+
+    def retry_after(self) -> float:
+        """
+        The seconds until the breaker lets a probe through, 0 if it is not open.
+        """
+
+        with self._lock:
+            if self._state != "open":
+                return 0.
+            return max(0., self._opened_at + self._cooldown - time.monotonic())
+
+    def allow(self) -> bool:
+        """
+        Whether a request may be sent now. In the half-open state, only one probe is let through at a time.
+        """
+
+        with self._lock:
+            if self._state == "closed":
+                self._stats["calls"] += 1
+                return True
+            if self._state == "open" and time.monotonic() >= self._opened_at + self._cooldown:
+                self._state = "half_open"
+            if self._state == "half_open" and not self._probing:
+                self._probing = True
+                self._stats["calls"] += 1
+                return True
+            self._stats["rejected"] += 1
+            return False
+
+    def record_success(self) -> None:
+        """
+        A request reached the endpoint: close the breaker.
+        """
+
+        with self._lock:
+            if self._state != "closed":
+                print(f"Circuit of {self.name} closed: the endpoint answers again.")
+            self._state = "closed"
+            self._failures = 0
+            self._cooldown = self.recovery_time
+            self._probing = False
+
+    def record_failure(self) -> None:
+        """
+        A request failed because of the endpoint: open the breaker after `failure_threshold` consecutive failures, or
+        at once if it was the probe.
+        """
+
+        with self._lock:
+            self._stats["failures"] += 1
+            self._failures += 1
+            if self._state == "half_open":
+                self._cooldown = min(self.max_recovery_time, self._cooldown * 2)
+                self._open()
+            elif self._state == "closed" and self._failures >= self.failure_threshold:
+                self._open()
+
+    def _open(self) -> None:
+        self._state = "open"
+        self._opened_at = time.monotonic()
+        self._probing = False
+        self._stats["opened"] += 1
+        print(f"Circuit of {self.name} opened after {self._failures} failures, next probe in {self._cooldown:g} "
+              f"seconds.")
+
+    def _settle(self, error: BaseException | None) -> None:
+        if error is None or not is_health_failure(error):
+            # Any answer of the endpoint, even an error about the request, shows that it is up.
+            self.record_success()
+        else:
+            self.record_failure()
+
+    def call(self, function: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Call `function(*args, **kwargs)` if the breaker allows it.
+
+        Raises
+        ------
+        CircuitOpenError
+            The breaker is open, the function was not called.
+        """
+
+        if not self.allow():
+            raise CircuitOpenError(f"The circuit of {self.name} is open.", self.retry_after())
+        try:
+            result = function(*args, **kwargs)
+        except Exception as error:
+            self._settle(error)
+            raise
+        except BaseException:
+            self._release()
+            raise
+        self._settle(None)
+        return result
+
+    async def acall(self, function: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        """
+        The async counterpart of `call`. A cancelled request does not count as a failure.
+        """
+
+        if not self.allow():
+            raise CircuitOpenError(f"The circuit of {self.name} is open.", self.retry_after())
+        try:
+            result = await function(*args, **kwargs)
+        except Exception as error:
+            self._settle(error)
+            raise
+        except BaseException:
+            self._release()
+            raise
+        self._settle(None)
+        return result
+
+    def _release(self) -> None:
+        """
+        Give back the probe slot of a request which ended without an outcome (e.g. cancelled).
+        """
+
+        with self._lock:
+            self._probing = False
+
+    def stats(self) -> dict:
+        """
+        The state of the breaker and its counters: "calls" (let through), "failures" (health failures), "rejected"
+        (failed fast) and "opened" (the number of times it opened).
+        """
+
+        with self._lock:
+            stats = dict(self._stats)
+        stats["state"] = self.state
+        return stats
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(endpoint: str, **kwargs) -> CircuitBreaker:
+    """
+    The process-wide breaker of an endpoint, created with `kwargs` (see `CircuitBreaker`) on the first call.
+    """
+
+    with _breakers_lock:
+        breaker = _breakers.get(endpoint)
+        if breaker is None:
+            breaker = _breakers[endpoint] = CircuitBreaker(name=endpoint, **kwargs)
+        return breaker
+
+
+class Failover:
+    """
+    An ordered list of endpoints serving the same model, each guarded by its breaker.
+    """
+    endpoints: list
+    api_keys: dict
+
+    def __init__(self, endpoints: list, api_keys: dict = None, **breaker_args) -> None:
+        """
+        Parameters
+        ----------
+        endpoints: list
+            The endpoints (e.g. base URLs), the preferred one first.
+        api_keys: dict, optional
+            {endpoint: API key} for the endpoints which do not use the key of the client.
+        breaker_args: dict, optional
+            The arguments of the breakers of endpoints which have none yet (see `CircuitBreaker`).
+        """
+
+        assert endpoints, "A failover needs at least one endpoint."
+
+        self.endpoints = list(endpoints)
+        self.api_keys = api_keys or {}
+        self.breakers = {endpoint: get_breaker(endpoint, **breaker_args) for endpoint in self.endpoints}
+        self._lock = threading.Lock()
+        self._served = {endpoint: 0 for endpoint in self.endpoints}
+
+    def call(self, send: Callable[[str], Any]) -> Any:
+        """
+        Send a request to the first healthy endpoint, and to the next ones while the endpoints fail.
+
+        Parameters
+        ----------
+        send: Callable
+            Sends the request to the endpoint it receives.
+
+        Raises
+        ------
+        CircuitOpenError
+            Every breaker is open: nothing was sent.
+        Exception
+            The error of the last endpoint tried, or an error which is not about the health of the endpoint.
+        """
+
+        last_error = None
+        for endpoint in self.endpoints:
+            try:
+                result = self.breakers[endpoint].call(send, endpoint)
+            except CircuitOpenError:
+                continue
+            except Exception as error:
+                if not is_health_failure(error):
+                    raise
+                last_error = error
+                continue
+            self._count(endpoint)
+            return result
+        raise self._exhausted(last_error)
+
+    async def acall(self, send: Callable[[str], Awaitable[Any]]) -> Any:
+        """
+        The async counterpart of `call`.
+        """
+
+        last_error = None
+        for endpoint in self.endpoints:
+            try:
+                result = await self.breakers[endpoint].acall(send, endpoint)
+            except CircuitOpenError:
+                continue
+            except Exception as error:
+                if not is_health_failure(error):
+                    raise
+                last_error = error
+                continue
+            self._count(endpoint)
+            return result
+        raise self._exhausted(last_error)
+
+    def _count(self, endpoint: str) -> None:
+        with self._lock:
+            self._served[endpoint] += 1
+
+    def _exhausted(self, last_error: Exception | None) -> Exception:
+        if last_error is not None:
+            return last_error
+        retry_after = min(breaker.retry_after() for breaker in self.breakers.values())
+        return CircuitOpenError(f"The circuits of all the endpoints are open ({', '.join(self.endpoints)}).",
+                                retry_after)
+
+    def stats(self) -> dict:
+        """
+        {endpoint: the stats of its breaker and "served", the requests it answered through this failover}.
+        """
+
+        with self._lock:
+            served = dict(self._served)
+        return {endpoint: {**self.breakers[endpoint].stats(), "served": served[endpoint]}
+                for endpoint in self.endpoints}
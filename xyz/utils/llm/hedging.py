@@ -0,0 +1,249 @@
+"""
+=============
+HedgingPolicy
+=============
+@file_name: hedging.py
+@description:
+This module cuts the tail latency of the LLM calls with hedged requests: when a request has not returned after a
+high percentile of the observed latencies, a duplicate is sent (optionally to a secondary endpoint serving the same
+model) and the first response wins.
+
+## Features of the HedgingPolicy include:
+1. Adaptive Delay: The duplicate is sent after the `percentile` (default 95) of the latencies of the recent successful
+    requests, never earlier than `min_delay`. Until `min_samples` latencies are known, no request is hedged.
+2. Budget Cap: At most a fraction `budget` (default 5%) of the requests are hedged, so hedging adds at most that much
+    load to the provider, whatever the latencies.
+3. Secondary Endpoint: With `base_url` (and `api_key`), the duplicates are sent to another OpenAI-compatible endpoint,
+    e.g. a second region or provider of the same model; by default they go to the endpoint of the client.
+4. Cancellation: In async code the losing request is cancelled, which closes its connection. A sync request cannot be
+    interrupted: the loser finishes in a background thread and its response is discarded.
+5. Statistics: `stats()` reports the requests, the hedges, the hedges which won (returned first), the hedges denied by
+    the budget and the current delay.
+
+## Usage
+```python
+hedging = HedgingPolicy(percentile=95, budget=0.05, base_url="https://secondary.example.com/v1")
+client = OpenAIClient(hedging=hedging, model="gpt-4-turbo")
+...
+print(hedging.stats())
+```
+`OpenAIClient` hedges every attempt of its non-streaming requests. The retries stay with the client (or its rate
+limiter), and a request whose primary fails before the delay is not hedged but retried.
+
+## Motivation
+A few calls of every sweep take 5 to 10 times the median latency and hold up the run. A duplicate sent at the 95th
+percentile usually returns long before the slow original, for a few percent of extra requests.
+"""
+
+import asyncio
+import collections
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Awaitable, Callable
+
+__all__ = ["HedgingPolicy"]
+
+
+class HedgingPolicy:
+    """
+    Decide when to send a duplicate of a slow request, and run the race between the two.
+    """
+    percentile: float
+    budget: float
+    min_delay: float
+    min_samples: int
+    base_url: str | None
+    api_key: str | None
+
+    def __init__(self, percentile: float = 95, budget: float = 0.05, min_delay: float = 0.5, min_samples: int = 20,
+                 window: int = 500, base_url: str = None, api_key: str = None, max_workers: int = 32) -> None:
+        """
+        Parameters
+        ----------
+        percentile: float, optional
+            The percentile of the recent latencies after which a request is hedged, by default 95.
+        budget: float, optional
+            The maximum fraction of the requests which are hedged, by default 0.05.
+        min_delay: float, optional
+            The minimum delay in seconds before hedging, by default 0.5.
+        min_samples: int, optional
+            The number of latencies needed before the first hedge, by default 20.
+        window: int, optional
+            The number of recent latencies the percentile is computed on, by default 500.
+        base_url: str, optional
+            The endpoint of the duplicates, by default None (the endpoint of the client).
+        api_key: str, optional
+            The API key of the secondary endpoint, by default None (the key of the client).
+        max_workers: int, optional
+            The threads running the hedged sync requests, by default 32. Use at least twice the number of concurrent
+            requests.
+        """
+
+        assert 0 < percentile < 100, "The percentile must be between 0 and 100."
+        assert 0 <= budget <= 1, "The budget must be a fraction of the requests."
+
+        self.percentile = percentile
+        self.budget = budget
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.base_url = base_url
+        self.api_key = api_key
+
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=window)
+        self._executor = None
+        self._max_workers = max_workers
+        self._stats = {"requests": 0, "hedged": 0, "wins": 0, "denied": 0}
+
+    def delay(self) -> float | None:
+        """
+        The time after which a request is hedged, None while too few latencies are known.
+        """
+
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100.))
+        return max(self.min_delay, latencies[index])
+
+    def observe(self, latency: float) -> None:
+        """
+        Record the latency of a successful request.
+        """
+
+        with self._lock:
+            self._latencies.append(latency)
+
+    def _allow(self) -> bool:
+        """
+        Whether one more hedge stays within the budget, counting it if so.
+        """
+
+        with self._lock:
+            if self._stats["hedged"] + 1 > self.budget * self._stats["requests"]:
+                self._stats["denied"] += 1
+                return False
+            self._stats["hedged"] += 1
+            return True
+
+    def _start(self) -> float | None:
+        with self._lock:
+            self._stats["requests"] += 1
+        return self.delay()
+
+    def _won(self, hedge: bool) -> None:
+        if hedge:
+            with self._lock:
+                self._stats["wins"] += 1
+
+    def call(self, send: Callable[[bool], Any]) -> Any:
+        """
+        Send a request, and a duplicate if it is slow.
+
+        Parameters
+        ----------
+        send: Callable
+            Sends the request, its argument tells whether it is the duplicate (to be sent to the secondary endpoint).
+
+        Returns
+        -------
+        Any
+            The first successful response.
+
+        Raises
+        ------
+        Exception
+            The error of the original request if no request succeeded.
+        """
+
+        delay = self._start()
+        if delay is None:
+            return self._timed(send, False)
+
+        executor = self._get_executor()
+        primary = executor.submit(self._timed, send, False)
+        done, _ = wait([primary], timeout=delay)
+        if done or not self._allow():
+            return primary.result()
+
+        hedge = executor.submit(self._timed, send, True)
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for loser in pending:
+                        loser.cancel()
+                    self._won(future is hedge)
+                    return future.result()
+        return primary.result()
+
+    async def acall(self, send: Callable[[bool], Awaitable[Any]]) -> Any:
+        """
+        The async counterpart of `call`: the request which loses the race is cancelled.
+        """
+
+        delay = self._start()
+        if delay is None:
+            return await self._atimed(send, False)
+
+        primary = asyncio.ensure_future(self._atimed(send, False))
+        tasks = [primary]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done or not self._allow():
+                return await primary
+
+            hedge = asyncio.ensure_future(self._atimed(send, True))
+            tasks.append(hedge)
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self._won(task is hedge)
+                        return task.result()
+            return primary.result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def _timed(self, send: Callable[[bool], Any], hedge: bool) -> Any:
+        start = time.perf_counter()
+        response = send(hedge)
+        self.observe(time.perf_counter() - start)
+        return response
+
+    async def _atimed(self, send: Callable[[bool], Awaitable[Any]], hedge: bool) -> Any:
+        start = time.perf_counter()
+        response = await send(hedge)
+        self.observe(time.perf_counter() - start)
+        return response
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix="hedging")
+            return self._executor
+
+    def stats(self) -> dict:
+        """
+        The hedging statistics.
+
+        Returns
+        -------
+        dict
+            "requests", "hedged", "wins" (the hedges which returned first), "denied" (the hedges refused by the
+            budget), "win_rate" (wins / hedged), "extra_load" (hedged / requests) and "delay" (the current delay in
+            seconds, None before `min_samples` latencies).
+        """
+
+        with self._lock:
+            stats = dict(self._stats)
+        stats["win_rate"] = stats["wins"] / stats["hedged"] if stats["hedged"] else 0.
+        stats["extra_load"] = stats["hedged"] / stats["requests"] if stats["requests"] else 0.
+        stats["delay"] = self.delay()
+        return stats
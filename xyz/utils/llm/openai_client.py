@@ -11,8 +11,21 @@ This module provides an interface to interact with OpenAI services. We have enca
 Users initialize the OpenAIClient by specifying the api_key and generate_args:
 
 - `api_key`: The API key for OpenAI. This must be obtained from your OpenAI account.
+- `base_url`: The base URL of an OpenAI-compatible provider, by default the OpenAI API. The HTTP connections are taken
+ from the process-wide pool of `xyz.utils.llm.transport`, so every client of the same provider shares them.
 - `generate_args`: Arguments for the chat completion request. For detailed information on these parameters, refer to the
  OpenAI documentation. https://platform.openai.com/docs/api-reference/chat/create
+- `rate_limiter`: An optional `RateLimiter` shared with other clients. It paces the requests and retries the failed ones
+ with exponential backoff. See `xyz.utils.llm.rate_limiter`.
+- `cache`: An optional `ResponseCache`. If it is given, deterministic requests are served from the on-disk cache when an
+ identical request has been made before. See `xyz.utils.llm.cache`.
+- `singleflight`: An optional `SingleFlight`. If it is given, identical deterministic requests in flight at the same
+ time share one upstream call. See `xyz.utils.llm.singleflight`.
+- `failover`: An optional `Failover`. If it is given, the requests are sent to its endpoints instead of `base_url`: to
+ the first one whose circuit breaker is closed, then to the next ones while they fail. See
+ `xyz.utils.llm.circuit_breaker`.
+- `hedging`: An optional `HedgingPolicy`. If it is given, a request slower than a percentile of the observed latencies
+ is duplicated, possibly to a secondary endpoint, and the first response is used. See `xyz.utils.llm.hedging`.
 
 ## Methods
 The class includes two primary methods for interacting with OpenAI:
@@ -22,8 +35,11 @@ parameters:
     - `messages`: A list of strings, each representing a conversation turn.
     - `images`: A list of URLs pointing to images to be included in the request.
     - `tools`: An optional list that specifies additional tools to be used in the request.
+- `arun`: The async counterpart of `run`, sending the request through `AsyncOpenAI` without blocking the event loop.
 - `stream_run`: This method is designed for streaming requests to OpenAI and also requires the messages and images
-parameters.
+parameters. With `stop_when`, the stream is closed as soon as the text received so far satisfies a condition (e.g. the
+answer is complete). A retried stream resumes after the text already yielded, and the time to the first token and to
+the answer are reported in `last_stream_stats`. A stream which cannot be completed raises `StreamIncomplete`.
 These methods simplify the process of integrating OpenAI functionalities into your applications, allowing for both
 standard and streaming interactions.
 
@@ -34,18 +50,31 @@ code reusability. Parameters commonly used in API requests can be encapsulated a
 """
 
 
+import asyncio
 import os
+import threading
 import time
 import traceback
-from typing import Generator
+import weakref
+from typing import Callable, Generator
 
+import httpx
 from dotenv import load_dotenv
 from openai import OpenAIError
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 from openai import Stream
 from openai.types.chat import ChatCompletion, ChatCompletionChunk
 
-__all__ = ["OpenAIClient"]
+from xyz.utils.llm.cache import ResponseCache
+from xyz.utils.llm.circuit_breaker import CircuitOpenError, Failover
+from xyz.utils.llm.hedging import HedgingPolicy
+from xyz.utils.llm.rate_limiter import RateLimiter, RateLimitExceeded, estimate_tokens
+from xyz.utils.llm.singleflight import SingleFlight
+from xyz.utils.llm.telemetry import get_telemetry, price_of
+from xyz.utils.tracing import annotate
+from xyz.utils.llm.transport import get_pool
+
+__all__ = ["OpenAIClient", "StreamIncomplete"]
 
 
 class OpenAIClient:
@@ -53,16 +82,37 @@ class OpenAIClient:
     The OpenAI client which uses the OpenAI API to generate responses to messages.
     """
     client: OpenAI
+    base_url: str
     generate_args: dict
+    cache: ResponseCache | None
+    rate_limiter: RateLimiter | None
+    singleflight: SingleFlight | None
+    hedging: HedgingPolicy | None
+    failover: Failover | None
     last_time_price: float
 
-    def __init__(self, api_key=None, **generate_args):
+    def __init__(self, api_key=None, base_url: str = None, cache: ResponseCache = None,
+                 rate_limiter: RateLimiter = None, singleflight: SingleFlight = None, hedging: HedgingPolicy = None,
+                 failover: Failover = None, **generate_args):
         """Initializes the OpenAI Client.
 
         Parameters
         ----------
         api_key : str, optional
             The OpenAI API key.
+        base_url : str, optional
+            The base URL of the API, by default the `OPENAI_BASE_URL` environment variable or the OpenAI API.
+        cache : ResponseCache, optional
+            The on-disk response cache, by default None (no caching).
+        rate_limiter : RateLimiter, optional
+            The limiter controlling the request rate and the retries, by default None. Without a limiter, a failed
+            request is retried up to 10 times with a fixed delay of 2 seconds.
+        singleflight : SingleFlight, optional
+            The group coalescing the identical deterministic requests in flight at the same time, by default None.
+        hedging : HedgingPolicy, optional
+            The policy duplicating the slow non-streaming requests, by default None (no hedging).
+        failover : Failover, optional
+            The endpoints (with their circuit breakers) of the non-streaming requests, by default None (`base_url`).
         generate_args : dict, optional
             Arguments for the chat completion request.
             ref: https://platform.openai.com/docs/api-reference/chat/create
@@ -72,7 +122,13 @@ class OpenAIClient:
             if api_key is None:
                 load_dotenv()
                 api_key = os.getenv('OPENAI_API_KEY')
-            self.client = OpenAI(api_key=api_key)
+            if base_url is None:
+                base_url = os.getenv('OPENAI_BASE_URL') or "https://api.openai.com/v1"
+            client_args = {"api_key": api_key, "base_url": base_url, "http_client": get_pool().httpx_client(base_url)}
+            if rate_limiter is not None:
+                # The rate limiter owns the retries, so the built-in retries of the SDK are disabled.
+                client_args["max_retries"] = 0
+            self.client = OpenAI(**client_args)
         except OpenAIError:
             raise OpenAIError("The OpenAI client is not available. Please check the OpenAI API key.")
 
@@ -85,8 +141,22 @@ class OpenAIClient:
         # If the user provides generate arguments, update the default values
         self.generate_args.update(generate_args)
 
+        self.base_url = base_url
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        self.singleflight = singleflight
+        self.hedging = hedging
+        self.failover = failover
+        self.last_time_price = 0.
+        # The clients of the failover and hedging endpoints, and the async clients (one set per event loop), are
+        # created on demand
+        self._clients = {}
+        self._async_clients = weakref.WeakKeyDictionary()
+        # The stream statistics are kept per thread, so concurrent streams do not overwrite each other
+        self._local = threading.local()
+
     def run(self, messages: list, tools: list = None,
-            images: list = None) -> ChatCompletion | Stream[ChatCompletionChunk]:
+            images: list = None, generate_args: dict = None) -> ChatCompletion | Stream[ChatCompletionChunk]:
         """
         Run the assistant with the given messages.
 
@@ -98,6 +168,9 @@ class OpenAIClient:
             A list of tools to be used by the assistant, by default [].
         images : list, optional
             A list of image URLs to be used by the assistant, by default [].
+        generate_args : dict, optional
+            Arguments overriding the default generate arguments for this request only, e.g.
+            {"n": 4, "temperature": 0.7}.
 
         Returns
         -------
@@ -110,88 +183,338 @@ class OpenAIClient:
             There may be different errors in different situations, which need to be handled according to the actual
                 situation. An error message is printed in the console when an error is reported.
             ref: https://platform.openai.com/docs/guides/error-codes/python-library-error-types
+        RateLimitExceeded
+            The request still fails after the maximum number of retries (of the rate limiter if there is one, 10
+            otherwise).
+        CircuitOpenError
+            With a failover, the circuit breakers of all its endpoints are open: the request was not sent.
         """
 
-        if images:
-            last_message = messages.pop()
-            text = last_message['content']
-            content = [
-                {"type": "text", "text": text},
-            ]
-            for image_url in images:
-                content.append({
-                    "type": "image_url",
-                    "image_url": {
-                        "url": image_url,
-                    },
-                })
-            messages.append({
-                "role": last_message['role'],
-                "content": content
-            })
+        self._attach_images(messages, images)
+        generate_args = {**self.generate_args, **generate_args} if generate_args else self.generate_args
 
         # If the user provides tools, use them; otherwise, this client will not use any tools
         if tools:
-            tool_choice = "auto"
             local_tools = tools
             # noinspection PyUnusedLocal
             tools = None  # pyright: ignore[reportIncompatibleVariableOverride]
         else:
             local_tools = []
-            tool_choice = "none"
+
+        start = time.perf_counter()
+        cache_key, cached = self._cache_lookup(messages, local_tools, generate_args)
+        if cached is not None:
+            self._record(start, generate_args, cached, attempts=0, cached=True)
+            return cached
+
+        if self.singleflight is not None and cache_key is not None and _deterministic(generate_args):
+            response, shared = self.singleflight.do(
+                cache_key, lambda: self._fetch(start, messages, local_tools, generate_args, cache_key))
+            if shared:
+                self._record(start, generate_args, response, attempts=0, shared=True)
+                return response.model_copy(deep=True) if response is not None else None
+            return response
+
+        return self._fetch(start, messages, local_tools, generate_args, cache_key)
+
+    def _fetch(self, start: float, messages: list, tools: list, generate_args: dict,
+               cache_key: str | None) -> ChatCompletion | None:
+        """
+        Send the request with its retries, store the response in the cache and report it to the telemetry.
+        """
+
+        if self.rate_limiter is not None:
+            attempts = []
+
+            def create(*args):
+                attempts.append(1)
+                return self._create(*args)
+
+            try:
+                response = self.rate_limiter.call(
+                    create, messages, tools, generate_args,
+                    estimated_tokens=self._estimate_tokens(messages, generate_args),
+                    count_tokens=lambda result: result.usage.total_tokens
+                )
+            except Exception as error:
+                self._record(start, generate_args, attempts=len(attempts), error=type(error).__name__)
+                raise
+            self._cache_store(cache_key, generate_args, response)
+            self._record(start, generate_args, response, attempts=len(attempts))
+            return response
 
         get_response_signal = False
         count = 0
         while not get_response_signal and count < 10:
             try:
-                # In OpenAI's api, if we request with tools == [], it will make an error. Caz the OpenAI use the default
-                # value is 'NOT_GIVEN' which is a special type designed by them.
-                if tool_choice == "auto":
-                    response = self.client.chat.completions.create(
-                        messages=messages,
-                        tools=local_tools,
-                        tool_choice="auto",
-                        **self.generate_args
-                    )
-                else:
-                    response = self.client.chat.completions.create(
-                        messages=messages,
-                        **self.generate_args
-                    )
+                response = self._create(messages, tools, generate_args)
                 get_response_signal = True
 
+                self._cache_store(cache_key, generate_args, response)
+
+                self._record(start, generate_args, response, attempts=count + 1)
                 return response
-            except OpenAIError:
+            except CircuitOpenError:
+                self._record(start, generate_args, attempts=count, error="CircuitOpenError")
+                raise
+            except OpenAIError as error:
                 count += 1
                 error_message = str(traceback.format_exc())
                 print(f"The error: {error_message}")
                 print(f"The messages: {messages}")
                 if count < 10:
                     print("We will try again in 2 seconds.")
-                time.sleep(2)
+                    time.sleep(2)
+                else:
+                    self._record(start, generate_args, attempts=count, error="OpenAIError")
+                    raise RateLimitExceeded(f"The request failed after {count} attempts.") from error
 
-    def stream_run(self, messages: list, images: list) -> Generator[str, None, None]:
+    def _create(self, messages: list, tools: list, generate_args: dict) -> ChatCompletion:
+        """
+        Send one chat completion request, without any retry. With a hedging policy, a slow request is duplicated.
         """
-        Run the assistant with the given messages in a streaming manner.
 
-        Parameters
-        ----------
-        images : list
-            A list of image URLs to be used by the assistant.
-        messages : list
-            A list of messages to be processed by the assistant.
+        def send(hedge: bool = False) -> ChatCompletion:
+            if hedge:
+                return self._send(self._sync_client(*self._hedging_endpoint()), messages, tools, generate_args)
+            if self.failover is not None:
+                return self.failover.call(lambda endpoint: self._send(
+                    self._sync_client(endpoint, self.failover.api_keys.get(endpoint)), messages, tools, generate_args))
+            return self._send(self.client, messages, tools, generate_args)
 
-        Yields
-        ------
-        str
-            The assistant's response to the messages, yielded one piece at a time.
+        if self.hedging is not None:
+            return self.hedging.call(send)
+        return send()
 
-        Raises
-        ------
-        OpenAIError
-            There may be different errors in different situations, which need to be handled according to the actual
-                situation. An error message is printed in the console when an error is reported.
-            ref: https://platform.openai.com/docs/guides/error-codes/python-library-error-types
+    @staticmethod
+    def _send(client: OpenAI, messages: list, tools: list, generate_args: dict) -> ChatCompletion:
+        # In OpenAI's api, if we request with tools == [], it will make an error. Caz the OpenAI use the default
+        # value is 'NOT_GIVEN' which is a special type designed by them.
+        if tools:
+            return client.chat.completions.create(
+                messages=messages,
+                tools=tools,
+                tool_choice="auto",
+                **generate_args
+            )
+        else:
+            return client.chat.completions.create(
+                messages=messages,
+                **generate_args
+            )
+
+    async def arun(self, messages: list, tools: list = None, images: list = None,
+                   generate_args: dict = None) -> ChatCompletion:
+        """
+        The async counterpart of `run`, sending the request with `AsyncOpenAI` without blocking the event loop. The
+        rate limiter and the cache are shared with `run`. See `run`.
+        """
+
+        self._attach_images(messages, images)
+        generate_args = {**self.generate_args, **generate_args} if generate_args else self.generate_args
+        local_tools = tools if tools else []
+
+        start = time.perf_counter()
+        cache_key, cached = self._cache_lookup(messages, local_tools, generate_args)
+        if cached is not None:
+            self._record(start, generate_args, cached, attempts=0, cached=True)
+            return cached
+
+        if self.singleflight is not None and cache_key is not None and _deterministic(generate_args):
+            response, shared = await self.singleflight.ado(
+                cache_key, lambda: self._afetch(start, messages, local_tools, generate_args, cache_key))
+            if shared:
+                self._record(start, generate_args, response, attempts=0, shared=True)
+                return response.model_copy(deep=True) if response is not None else None
+            return response
+
+        return await self._afetch(start, messages, local_tools, generate_args, cache_key)
+
+    async def _afetch(self, start: float, messages: list, tools: list, generate_args: dict,
+                      cache_key: str | None) -> ChatCompletion | None:
+        """
+        The async counterpart of `_fetch`.
+        """
+
+        if self.rate_limiter is not None:
+            attempts = []
+
+            async def create(*args):
+                attempts.append(1)
+                return await self._acreate(*args)
+
+            try:
+                response = await self.rate_limiter.acall(
+                    create, messages, tools, generate_args,
+                    estimated_tokens=self._estimate_tokens(messages, generate_args),
+                    count_tokens=lambda result: result.usage.total_tokens
+                )
+            except Exception as error:
+                self._record(start, generate_args, attempts=len(attempts), error=type(error).__name__)
+                raise
+            self._cache_store(cache_key, generate_args, response)
+            self._record(start, generate_args, response, attempts=len(attempts))
+            return response
+
+        count = 0
+        while count < 10:
+            try:
+                response = await self._acreate(messages, tools, generate_args)
+
+                self._cache_store(cache_key, generate_args, response)
+
+                self._record(start, generate_args, response, attempts=count + 1)
+                return response
+            except CircuitOpenError:
+                self._record(start, generate_args, attempts=count, error="CircuitOpenError")
+                raise
+            except OpenAIError as error:
+                count += 1
+                error_message = str(traceback.format_exc())
+                print(f"The error: {error_message}")
+                print(f"The messages: {messages}")
+                if count < 10:
+                    print("We will try again in 2 seconds.")
+                    await asyncio.sleep(2)
+                else:
+                    self._record(start, generate_args, attempts=count, error="OpenAIError")
+                    raise RateLimitExceeded(f"The request failed after {count} attempts.") from error
+
+    async def _acreate(self, messages: list, tools: list, generate_args: dict) -> ChatCompletion:
+        """
+        Send one chat completion request with the async client, without any retry. With a hedging policy, a slow
+        request is duplicated and the loser is cancelled.
+        """
+
+        async def send(hedge: bool = False) -> ChatCompletion:
+            if hedge:
+                return await self._asend(self._async_client(*self._hedging_endpoint()), messages, tools, generate_args)
+            if self.failover is not None:
+                return await self.failover.acall(lambda endpoint: self._asend(
+                    self._async_client(endpoint, self.failover.api_keys.get(endpoint)), messages, tools,
+                    generate_args))
+            return await self._asend(self._async_client(), messages, tools, generate_args)
+
+        if self.hedging is not None:
+            return await self.hedging.acall(send)
+        return await send()
+
+    @staticmethod
+    async def _asend(client: AsyncOpenAI, messages: list, tools: list, generate_args: dict) -> ChatCompletion:
+        if tools:
+            return await client.chat.completions.create(
+                messages=messages,
+                tools=tools,
+                tool_choice="auto",
+                **generate_args
+            )
+        else:
+            return await client.chat.completions.create(
+                messages=messages,
+                **generate_args
+            )
+
+    def _sync_client(self, base_url: str = None, api_key: str = None) -> OpenAI:
+        """
+        The client of an endpoint, by default the client of `base_url`. The clients of the other endpoints (failover
+        and hedging) do not retry: a failed request goes back to the failover or the hedging policy at once.
+        """
+
+        if base_url is None:
+            return self.client
+        key = (base_url, api_key or self.client.api_key)
+        client = self._clients.get(key)
+        if client is None:
+            client = self._clients[key] = OpenAI(api_key=key[1], base_url=base_url,
+                                                 http_client=get_pool().httpx_client(base_url), max_retries=0)
+        return client
+
+    def _async_client(self, base_url: str = None, api_key: str = None) -> AsyncOpenAI:
+        """
+        The `AsyncOpenAI` client of an endpoint (see `_sync_client`) for the running event loop, built on the shared
+        async connections of the pool.
+        """
+
+        loop = asyncio.get_running_loop()
+        clients = self._async_clients.get(loop)
+        if clients is None:
+            clients = self._async_clients[loop] = {}
+        key = None if base_url is None else (base_url, api_key or self.client.api_key)
+        client = clients.get(key)
+        if client is None:
+            if key is None:
+                client = AsyncOpenAI(api_key=self.client.api_key, base_url=self.base_url,
+                                     http_client=get_pool().async_httpx_client(self.base_url),
+                                     max_retries=self.client.max_retries)
+            else:
+                client = AsyncOpenAI(api_key=key[1], base_url=base_url,
+                                     http_client=get_pool().async_httpx_client(base_url), max_retries=0)
+            clients[key] = client
+        return client
+
+    def _hedging_endpoint(self) -> tuple[str, str | None]:
+        return self.hedging.base_url or self.base_url, self.hedging.api_key
+
+    def _record(self, start: float, generate_args: dict, response: ChatCompletion = None, attempts: int = 1,
+                error: str = None, **fields) -> None:
+        """
+        Set `last_time_price` and report the call to the telemetry and to the current trace span, if they are
+        enabled.
+        """
+
+        usage = getattr(response, "usage", None)
+        prompt_tokens = getattr(usage, "prompt_tokens", None)
+        completion_tokens = getattr(usage, "completion_tokens", None)
+        model = generate_args.get("model")
+        telemetry = get_telemetry()
+        if fields.get("cached"):
+            cost = 0.
+        else:
+            cost = price_of(model, prompt_tokens, completion_tokens, telemetry.prices if telemetry else None)
+        self.last_time_price = cost
+        latency = time.perf_counter() - start
+        annotate(client_latency=latency, attempts=attempts, retries=max(0, attempts - 1), prompt_tokens=prompt_tokens,
+                 completion_tokens=completion_tokens, **fields)
+
+        if telemetry is not None:
+            finish_reason = response.choices[0].finish_reason if response is not None and response.choices else None
+            telemetry.record("openai", model=model, latency=latency, attempts=attempts,
+                             prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                             finish_reason=finish_reason, cost=cost, error=error, base_url=self.base_url, **fields)
+
+    @staticmethod
+    def _estimate_tokens(messages: list, generate_args: dict) -> int:
+        return estimate_tokens(messages, generate_args.get("max_tokens", 1024) * generate_args.get("n", 1))
+
+    def _cache_lookup(self, messages: list, tools: list,
+                      generate_args: dict) -> tuple[str | None, ChatCompletion | None]:
+        """
+        The key of the request (None if neither the cache nor the single-flight group may handle it) and the cached
+        response (None on a miss).
+        """
+
+        use_cache = self.cache is not None and self.cache.cacheable(generate_args)
+        if not use_cache and not (self.singleflight is not None and _deterministic(generate_args)):
+            return None, None
+        key = ResponseCache.make_key({
+            "messages": messages,
+            "tools": tools,
+            "generate_args": generate_args,
+        })
+        if use_cache:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return key, ChatCompletion.model_validate_json(cached)
+        return key, None
+
+    def _cache_store(self, cache_key: str | None, generate_args: dict, response: ChatCompletion) -> None:
+        if cache_key is not None and self.cache is not None and self.cache.cacheable(generate_args):
+            self.cache.set(cache_key, response.model_dump_json())
+
+    @staticmethod
+    def _attach_images(messages: list, images: list | None) -> None:
+        """
+        Replace the last message by a multi-part message with its text and the images.
         """
 
         if images:
@@ -212,24 +535,150 @@ class OpenAIClient:
                 "content": content
             })
 
-        get_response_signal = False
-        count = 0
-        while not get_response_signal and count < 10:
-            try:
-                for response in self.client.chat.completions.create(
+    def stream_run(self, messages: list, images: list,
+                   stop_when: Callable[[str], bool] = None) -> Generator[str, None, None]:
+        """
+        Run the assistant with the given messages in a streaming manner.
+
+        The chunks without content (e.g. the role header) are skipped and the stream ends with its finish reason. If
+        the stream breaks (an error, or the end of the stream without a finish reason), the request is sent again and
+        the text already yielded is not yielded twice: the consumer only receives the continuation. An attempt which
+        does not reproduce the text already yielded counts as failed, so a stream which already yielded text is only
+        resumed when the generation is reproducible (temperature 0 or a `seed`). The timings of the last call are
+        stored in `last_stream_stats`.
+
+        Parameters
+        ----------
+        images : list
+            A list of image URLs to be used by the assistant.
+        messages : list
+            A list of messages to be processed by the assistant.
+        stop_when : Callable, optional
+            Called with the text received so far after each chunk. When it returns True, the connection is closed and
+            the generator stops, e.g. as soon as the answer is complete. By default None (read the whole stream).
+
+        Yields
+        ------
+        str
+            The assistant's response to the messages, yielded one piece at a time.
+
+        Raises
+        ------
+        OpenAIError
+            There may be different errors in different situations, which need to be handled according to the actual
+                situation. An error message is printed in the console when an error is reported.
+            ref: https://platform.openai.com/docs/guides/error-codes/python-library-error-types
+        StreamIncomplete
+            The stream still breaks after 10 attempts, or it broke after yielding text and cannot be resumed. The
+            consumer received a truncated text; the statistics of the stream are in the `stats` of the error.
+        """
+
+        self._attach_images(messages, images)
+        resumable = self.generate_args.get("temperature", 1.0) == 0 or self.generate_args.get("seed") is not None
+
+        start = time.perf_counter()
+        stats = {"ttft": None, "time_to_answer": None, "total_time": None, "attempts": 0, "stopped_early": False,
+                 "finish_reason": None}
+        self._local.last_stream_stats = stats
+
+        try:
+            emitted = ""
+            count = 0
+            while count < 10:
+                stats["attempts"] += 1
+                received = ""
+                try:
+                    stream = self.client.chat.completions.create(
                         messages=messages,
                         stream=True,
                         timeout=5,
                         **self.generate_args
-                ):
-                    if response.choices[0].delta.content is None:
-                        return None
-                    else:
-                        text = response.choices[0].delta.content
-                        yield text
-            except OpenAIError:
-                count += 1
-                error_message = str(traceback.format_exc())
-                print(f"The error: {error_message}")
-                print(f"The messages: {messages}")
-                time.sleep(2)
+                    )
+                    with stream:
+                        for response in stream:
+                            if not response.choices:
+                                continue
+                            choice = response.choices[0]
+                            if choice.delta.content:
+                                received += choice.delta.content
+                                if len(received) > len(emitted):
+                                    if not received.startswith(emitted):
+                                        raise _StreamBroken("The new attempt does not reproduce the text already sent.")
+                                    text = received[len(emitted):]
+                                    emitted = received
+                                    if stats["ttft"] is None:
+                                        stats["ttft"] = time.perf_counter() - start
+                                    yield text
+                                    if stop_when is not None and stop_when(emitted):
+                                        stats["time_to_answer"] = time.perf_counter() - start
+                                        stats["stopped_early"] = True
+                                        # Leaving the block closes the connection, the rest of the answer is never read.
+                                        return
+                            if choice.finish_reason is not None:
+                                stats["finish_reason"] = choice.finish_reason
+                                return
+                    raise _StreamBroken("The stream ended without a finish reason.")
+                except (OpenAIError, httpx.HTTPError, _StreamBroken) as error:
+                    count += 1
+                    error_message = str(traceback.format_exc())
+                    print(f"The error: {error_message}")
+                    print(f"The messages: {messages}")
+                    if emitted and not resumable:
+                        raise StreamIncomplete(f"The stream broke after {len(emitted)} characters and cannot be "
+                                               f"resumed: the generation is not reproducible.", stats) from error
+                    if count >= 10:
+                        raise StreamIncomplete(f"The stream failed after {count} attempts.", stats) from error
+                    print(f"We will try again in 2 seconds, resuming after {len(emitted)} characters.")
+                    time.sleep(2)
+                finally:
+                    stats["total_time"] = time.perf_counter() - start
+        finally:
+            telemetry = get_telemetry()
+            if telemetry is not None:
+                error = None if stats["finish_reason"] or stats["stopped_early"] else "StreamBroken"
+                telemetry.record("openai", model=self.generate_args.get("model"), latency=stats["total_time"],
+                                 attempts=stats["attempts"], finish_reason=stats["finish_reason"], error=error,
+                                 stream=True, ttft=stats["ttft"], time_to_answer=stats["time_to_answer"],
+                                 stopped_early=stats["stopped_early"], base_url=self.base_url)
+
+    @property
+    def last_stream_stats(self) -> dict:
+        """
+        The timings of the last `stream_run` of the current thread: "ttft" (time to the first token), "time_to_answer"
+        (time until `stop_when` returned True), "total_time", "attempts", "stopped_early" and "finish_reason". The
+        times are in seconds, None if not reached.
+
+        The statistics are kept per thread, so they must be read in the thread which consumed the stream: when the
+        stream is consumed with `asyncio.to_thread` (e.g. by `mathSolve.aflowing`), read them in the function run in
+        the thread, the event loop thread does not see them.
+        """
+
+        return getattr(self._local, "last_stream_stats", {})
+
+
+def _deterministic(generate_args: dict) -> bool:
+    """
+    Whether identical requests with these generate arguments must get identical responses.
+    """
+
+    return not generate_args.get("stream") and generate_args.get("temperature", 1.0) == 0
+
+
+class StreamIncomplete(Exception):
+    """
+    A stream could not be completed: it kept breaking, or it broke after yielding text while the generation is not
+    reproducible (a non-zero temperature without a seed), so it could not be resumed. `stats` are the statistics of
+    the stream (see `last_stream_stats`).
+    """
+    stats: dict
+
+    def __init__(self, message: str, stats: dict) -> None:
+        super().__init__(message)
+        self.stats = stats
+
+
+class _StreamBroken(Exception):
+    """
+    A stream was cut before its finish reason, or a retried stream does not start with the text already yielded to the
+    consumer.
+    """
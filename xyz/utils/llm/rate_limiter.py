@@ -0,0 +1,520 @@
+"""
+===========
+RateLimiter
+===========
+@file_name: rate_limiter.py
+@description:
+This module implements a shared rate limiter for the LLM clients. One `RateLimiter` wraps every request sent to a
+provider and decides when it may be sent and whether (and when) it should be retried.
+
+## Components
+1. `TokenBucket`: A classic token bucket. The limiter keeps one bucket for requests per minute and one for tokens per
+    minute.
+2. `AIMDConcurrency`: A semaphore whose limit follows additive-increase / multiplicative-decrease. The limit grows by one
+    after a window of successful requests and is cut when the provider answers with 429 or 5xx.
+3. `Backoff`: Exponential backoff with full jitter.
+4. `RateLimiter`: Combines the three. Its `call()` method runs a request function with admission control and retries,
+    and honors the `Retry-After` header by pausing all callers until the provider is ready again. `acall()` does the
+    same for coroutine functions without blocking the event loop; sync and async callers can share one limiter.
+
+## Usage
+```python
+limiter = RateLimiter(requests_per_minute=500, tokens_per_minute=300000, concurrency=8)
+client = OpenAIClient(rate_limiter=limiter, model="gpt-4-turbo")
+```
+The same limiter can be shared by every client talking to the same provider.
+
+## Motivation
+A fixed sleep after every error either floods the provider or leaves it idle. Adapting the request rate to the feedback
+of the provider keeps the throughput close to the allowed maximum.
+"""
+
+import asyncio
+import collections
+import json
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable
+
+__all__ = ["TokenBucket", "AIMDConcurrency", "Backoff", "RateLimiter", "RateLimitExceeded", "error_info",
+           "estimate_tokens"]
+
+
+class RateLimitExceeded(Exception):
+    """
+    Raised when a request still fails after the maximum number of retries.
+    """
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket refilled at a constant rate.
+    """
+    rate: float
+    capacity: float
+
+    def __init__(self, per_minute: float, capacity: float = None) -> None:
+        """
+        Parameters
+        ----------
+        per_minute: float
+            The number of tokens added per minute.
+        capacity: float, optional
+            The maximum number of tokens in the bucket, by default one minute worth of tokens.
+        """
+
+        self.rate = per_minute / 60.
+        self.capacity = capacity if capacity is not None else per_minute
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, amount: float = 1.) -> float:
+        """
+        Take `amount` tokens from the bucket, allowing the balance to go negative.
+
+        Returns
+        -------
+        float
+            The time in seconds the caller has to wait before the reserved tokens are actually available.
+        """
+
+        amount = min(amount, self.capacity)
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens -= amount
+            if self._tokens >= 0:
+                return 0.
+            return -self._tokens / self.rate
+
+    def acquire(self, amount: float = 1.) -> None:
+        """
+        Block until `amount` tokens are available.
+        """
+
+        wait = self.reserve(amount)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def aacquire(self, amount: float = 1.) -> None:
+        """
+        Wait without blocking the event loop until `amount` tokens are available.
+        """
+
+        wait = self.reserve(amount)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def adjust(self, amount: float) -> None:
+        """
+        Give back (positive) or take (negative) tokens once the real cost of a request is known.
+        """
+
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self.capacity, self._tokens + amount)
+
+
+class AIMDConcurrency:
+    """
+    A semaphore with an adaptive limit (additive increase, multiplicative decrease).
+    """
+    limit: float
+    minimum: int
+    maximum: int
+
+    def __init__(self, initial: int = 8, minimum: int = 1, maximum: int = 64, decrease: float = 0.5,
+                 cooldown: float = 1.) -> None:
+        """
+        Parameters
+        ----------
+        initial: int, optional
+            The initial limit, by default 8.
+        minimum: int, optional
+            The lower bound of the limit, by default 1.
+        maximum: int, optional
+            The upper bound of the limit, by default 64.
+        decrease: float, optional
+            The factor applied to the limit on overload, by default 0.5.
+        cooldown: float, optional
+            The minimum time in seconds between two decreases, by default 1. Concurrent requests failing because of
+            the same overload only cut the limit once.
+        """
+
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self._in_flight = 0
+        self._last_decrease = 0.
+        self._condition = threading.Condition()
+        # The futures of the coroutines waiting for a slot, woken from any thread
+        self._async_waiters = collections.deque()
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def acquire(self) -> None:
+        with self._condition:
+            while self._in_flight >= int(self.limit):
+                self._condition.wait()
+            self._in_flight += 1
+
+    async def aacquire(self) -> None:
+        """
+        Wait for a slot without blocking the event loop.
+        """
+
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._condition:
+                if self._in_flight < int(self.limit):
+                    self._in_flight += 1
+                    return
+                future = loop.create_future()
+                self._async_waiters.append((loop, future))
+            try:
+                await future
+            except asyncio.CancelledError:
+                with self._condition:
+                    try:
+                        self._async_waiters.remove((loop, future))
+                    except ValueError:
+                        # The wake-up was already sent to this waiter: pass it on.
+                        self._wake()
+                raise
+
+    def release(self) -> None:
+        with self._condition:
+            self._in_flight -= 1
+            self._wake()
+
+    def _wake(self) -> None:
+        """
+        Wake one waiting thread and one waiting coroutine. Must be called with the condition held.
+        """
+
+        self._condition.notify()
+        while self._async_waiters:
+            loop, future = self._async_waiters.popleft()
+            try:
+                loop.call_soon_threadsafe(_resolve, future)
+                return
+            except RuntimeError:
+                # The loop of this waiter is closed.
+                continue
+
+    def on_success(self) -> None:
+        """
+        Additive increase: about +1 after `limit` successful requests.
+        """
+
+        with self._condition:
+            before = int(self.limit)
+            self.limit = min(self.maximum, self.limit + 1. / self.limit)
+            if int(self.limit) > before:
+                self._wake()
+
+    def on_overload(self) -> None:
+        """
+        Multiplicative decrease, at most once per cooldown window.
+        """
+
+        with self._condition:
+            now = time.monotonic()
+            if now - self._last_decrease >= self.cooldown:
+                self.limit = max(self.minimum, self.limit * self.decrease)
+                self._last_decrease = now
+
+
+def _resolve(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class Backoff:
+    """
+    Exponential backoff with full jitter.
+    """
+
+    def __init__(self, base: float = 1., maximum: float = 60.) -> None:
+        """
+        Parameters
+        ----------
+        base: float, optional
+            The delay of the first retry in seconds, by default 1.
+        maximum: float, optional
+            The upper bound of a delay in seconds, by default 60.
+        """
+
+        self.base = base
+        self.maximum = maximum
+
+    def delay(self, attempt: int) -> float:
+        """
+        The delay before the retry number `attempt` (starting from 0).
+        """
+
+        return random.uniform(0, min(self.maximum, self.base * 2 ** attempt))
+
+
+# The network errors of `openai`, `httpx` and `requests`, matched by name so none of them has to be imported.
+_TRANSIENT_ERRORS = {"APIConnectionError", "APITimeoutError", "TransportError", "TimeoutException", "ConnectionError",
+                     "Timeout"}
+
+
+def _parse_retry_after(value: str | None) -> float | None:
+    if value is None:
+        return None
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0., parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def error_info(error: BaseException) -> tuple[bool, int | None, float | None]:
+    """
+    Classify an error raised by a request.
+
+    Works with the errors of the `openai` package and of `requests`, as both expose the HTTP response on the exception.
+
+    Parameters
+    ----------
+    error: BaseException
+        The raised error.
+
+    Returns
+    -------
+    tuple
+        Whether the request should be retried, the HTTP status code (None for network errors) and the value of the
+        `Retry-After` header in seconds (None if absent).
+    """
+
+    response = getattr(error, "response", None)
+    status = getattr(error, "status_code", None)
+    if status is None and response is not None:
+        status = getattr(response, "status_code", None)
+
+    retry_after = None
+    headers = getattr(response, "headers", None)
+    if headers is not None:
+        retry_after = _parse_retry_after(headers.get("retry-after"))
+        if retry_after is None and headers.get("retry-after-ms") is not None:
+            retry_after = _parse_retry_after(headers.get("retry-after-ms"))
+            retry_after = retry_after / 1000. if retry_after is not None else None
+
+    if status is None:
+        # Only network errors and timeouts are worth a retry, anything else is a bug on our side.
+        names = {cls.__name__ for cls in type(error).__mro__}
+        transient = isinstance(error, OSError) or bool(names & _TRANSIENT_ERRORS)
+        return transient, None, retry_after
+    return status in (408, 409, 429) or status >= 500, status, retry_after
+
+
+def estimate_tokens(messages: Any, max_tokens: int = 1024) -> int:
+    """
+    A cheap upper estimate of the tokens used by a request: about 4 characters per prompt token plus the completion
+    budget.
+    """
+
+    return len(json.dumps(messages, ensure_ascii=False, default=str)) // 4 + max_tokens
+
+
+class RateLimiter:
+    """
+    Admission control and retries shared by the LLM clients.
+    """
+    requests_bucket: TokenBucket | None
+    tokens_bucket: TokenBucket | None
+    concurrency: AIMDConcurrency
+    backoff: Backoff
+    max_retries: int
+
+    def __init__(self, requests_per_minute: float = None, tokens_per_minute: float = None, concurrency: int = 8,
+                 max_concurrency: int = 64, backoff: Backoff = None, max_retries: int = 10) -> None:
+        """
+        Parameters
+        ----------
+        requests_per_minute: float, optional
+            The request budget, by default None (unlimited).
+        tokens_per_minute: float, optional
+            The token budget, by default None (unlimited).
+        concurrency: int, optional
+            The initial number of concurrent requests, by default 8.
+        max_concurrency: int, optional
+            The upper bound of the adaptive concurrency, by default 64.
+        backoff: Backoff, optional
+            The retry delays, by default `Backoff()`.
+        max_retries: int, optional
+            The maximum number of retries of one request, by default 10.
+        """
+
+        self.requests_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.concurrency = AIMDConcurrency(initial=concurrency, maximum=max(concurrency, max_concurrency))
+        self.backoff = backoff or Backoff()
+        self.max_retries = max_retries
+
+        self._paused_until = 0.
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "retries": 0, "throttled": 0, "failures": 0}
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.stats[name] += 1
+
+    def _pause(self, seconds: float) -> None:
+        """
+        Hold back every caller for `seconds`, e.g. because of a `Retry-After` header.
+        """
+
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def _admit(self, estimated_tokens: int) -> None:
+        """
+        Wait for the pause, the buckets and a concurrency slot.
+        """
+
+        wait = self._paused_until - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        if self.requests_bucket is not None:
+            self.requests_bucket.acquire(1)
+        if self.tokens_bucket is not None and estimated_tokens:
+            self.tokens_bucket.acquire(estimated_tokens)
+        self.concurrency.acquire()
+
+    async def _aadmit(self, estimated_tokens: int) -> None:
+        """
+        Wait for the pause, the buckets and a concurrency slot without blocking the event loop.
+        """
+
+        wait = self._paused_until - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        if self.requests_bucket is not None:
+            await self.requests_bucket.aacquire(1)
+        if self.tokens_bucket is not None and estimated_tokens:
+            await self.tokens_bucket.aacquire(estimated_tokens)
+        await self.concurrency.aacquire()
+
+    def _retry_delay(self, error: Exception, attempt: int) -> float:
+        """
+        Account for a failed attempt and return the delay before the next one. The concurrency slot must already be
+        released.
+
+        Raises
+        ------
+        RateLimitExceeded
+            This was the last attempt.
+        Exception
+            The error itself if it is not retryable.
+        """
+
+        retryable, status, retry_after = error_info(error)
+        if not retryable:
+            self._count("failures")
+            raise error
+        if status is not None and (status == 429 or status >= 500):
+            self._count("throttled")
+            self.concurrency.on_overload()
+        if attempt == self.max_retries:
+            self._count("failures")
+            raise RateLimitExceeded(f"The request failed after {self.max_retries} retries.") from error
+        delay = self.backoff.delay(attempt)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+            self._pause(retry_after)
+        self._count("retries")
+        print(f"Request failed (status={status}): {error}. Retrying in {delay:.1f} seconds.")
+        return delay
+
+    def _settle(self, result: Any, estimated_tokens: int, count_tokens: Callable[[Any], int] | None) -> None:
+        """
+        Account for a successful attempt. The concurrency slot must already be released.
+        """
+
+        self.concurrency.on_success()
+        if count_tokens is not None and self.tokens_bucket is not None:
+            try:
+                self.tokens_bucket.adjust(estimated_tokens - count_tokens(result))
+            except (AttributeError, TypeError):
+                pass
+
+    def call(self, function: Callable[..., Any], *args, estimated_tokens: int = 0,
+             count_tokens: Callable[[Any], int] = None, **kwargs) -> Any:
+        """
+        Call `function(*args, **kwargs)` under the limits, retrying the retryable errors.
+
+        Parameters
+        ----------
+        function: Callable
+            The function which sends one request.
+        estimated_tokens: int, optional
+            The tokens charged to the token bucket before the request is sent, by default 0.
+        count_tokens: Callable, optional
+            Extract the real number of tokens from the result. The difference with the estimate is settled with the
+            token bucket.
+
+        Returns
+        -------
+        Any
+            The result of the function.
+
+        Raises
+        ------
+        RateLimitExceeded
+            The request still fails after `max_retries` retries. The last error is chained.
+        Exception
+            A non-retryable error (e.g. 400 or 401) raised by the function.
+        """
+
+        for attempt in range(self.max_retries + 1):
+            self._admit(estimated_tokens)
+            try:
+                self._count("requests")
+                result = function(*args, **kwargs)
+            except Exception as error:
+                self.concurrency.release()
+                time.sleep(self._retry_delay(error, attempt))
+            else:
+                self.concurrency.release()
+                self._settle(result, estimated_tokens, count_tokens)
+                return result
+
+    async def acall(self, function: Callable[..., Any], *args, estimated_tokens: int = 0,
+                    count_tokens: Callable[[Any], int] = None, **kwargs) -> Any:
+        """
+        The async counterpart of `call`: await the coroutine function `function(*args, **kwargs)` under the limits,
+        retrying the retryable errors. See `call`.
+        """
+
+        for attempt in range(self.max_retries + 1):
+            await self._aadmit(estimated_tokens)
+            try:
+                self._count("requests")
+                result = await function(*args, **kwargs)
+            except Exception as error:
+                self.concurrency.release()
+                await asyncio.sleep(self._retry_delay(error, attempt))
+            except BaseException:
+                # Cancelled: give the slot back and stop.
+                self.concurrency.release()
+                raise
+            else:
+                self.concurrency.release()
+                self._settle(result, estimated_tokens, count_tokens)
+                return result
@@ -0,0 +1,151 @@
+"""
+============
+SingleFlight
+============
+@file_name: singleflight.py
+@description:
+This module coalesces identical LLM requests which are in flight at the same time: the first caller (the leader) sends
+the request, the others wait for it and receive the same result.
+
+## Features of the SingleFlight include:
+1. Sync and Async: `do()` coalesces the calls of several threads, `ado()` the calls of several coroutines of one event
+    loop.
+2. Errors Shared: If the leader fails, every waiting caller receives the same error; the next call starts a new flight.
+3. Statistics: `stats()` reports the number of calls, of upstream calls (leaders) and of calls which shared the result
+    of another one.
+
+## Usage
+```python
+flight = SingleFlight()
+client = OpenAIClient(singleflight=flight, model="gpt-4-turbo", temperature=0.)
+...
+print(flight.stats())
+```
+Only deterministic (temperature-0, non-streaming) requests are coalesced by `OpenAIClient`, with the same key as the
+response cache. A generation sweep asks every question once, so the single-flight pays off where the same request is
+sent concurrently: `evaluate_response.py --dedup` shares one among the judging tasks of several prediction files
+judged at once (see `judge_files`) and reports the calls saved.
+
+## Motivation
+The response cache only helps once a response has arrived. Sweeps which judge several prediction files at once send
+identical judge requests concurrently (e.g. two models answering "1" to the same problem), and each of them paid a call.
+"""
+
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable
+
+__all__ = ["SingleFlight"]
+
+
+class _Flight:
+    """
+    A request in flight and its waiting callers.
+    """
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesce the concurrent calls sharing a key.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._tasks = {}
+        self._stats = {"calls": 0, "leaders": 0, "shared": 0}
+
+    def do(self, key: str, function: Callable[[], Any]) -> tuple[Any, bool]:
+        """
+        Call `function()`, unless a call with the same key is already in flight, in which case wait for its result.
+
+        Parameters
+        ----------
+        key: str
+            The key of the request.
+        function: Callable
+            The function sending the request.
+
+        Returns
+        -------
+        tuple
+            The result and whether it was shared from another call.
+
+        Raises
+        ------
+        Exception
+            The error raised by the leader.
+        """
+
+        with self._lock:
+            self._stats["calls"] += 1
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self._stats["leaders"] += 1
+            else:
+                self._stats["shared"] += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+
+        try:
+            flight.result = function()
+            return flight.result, False
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    async def ado(self, key: str, function: Callable[[], Awaitable[Any]]) -> tuple[Any, bool]:
+        """
+        The async counterpart of `do`: await `function()`, unless a call with the same key is already in flight on the
+        running event loop. A waiting caller which is cancelled does not cancel the leader.
+        """
+
+        loop_key = (id(asyncio.get_running_loop()), key)
+        with self._lock:
+            self._stats["calls"] += 1
+            task = self._tasks.get(loop_key)
+            leader = task is None
+            if leader:
+                task = self._tasks[loop_key] = asyncio.ensure_future(function())
+                task.add_done_callback(lambda _: self._forget(loop_key, task))
+                self._stats["leaders"] += 1
+            else:
+                self._stats["shared"] += 1
+
+        return await asyncio.shield(task), not leader
+
+    def _forget(self, loop_key: tuple, task: asyncio.Future) -> None:
+        with self._lock:
+            if self._tasks.get(loop_key) is task:
+                del self._tasks[loop_key]
+
+    def stats(self) -> dict:
+        """
+        The deduplication statistics.
+
+        Returns
+        -------
+        dict
+            "calls", "leaders" (the upstream calls), "shared" (the calls served by another one) and "dedup_rate"
+            (shared / calls).
+        """
+
+        with self._lock:
+            stats = dict(self._stats)
+        stats["dedup_rate"] = stats["shared"] / stats["calls"] if stats["calls"] else 0.
+        return stats
@@ -0,0 +1,364 @@
+"""
+=========
+Telemetry
+=========
+@file_name: telemetry.py
+@description:
+This module records one structured record per LLM call and aggregates them, so a long benchmark sweep tells where it
+spent its time and money.
+
+## Features of the Telemetry include:
+1. Per-Call Records: `OpenAIClient` and `Llama3APIClient` report the latency, the number of attempts, the prompt and
+    completion tokens, the finish reason and the cost of every call. `LLMAgent.request` only adds its own latency
+    (template included), without tokens, attempts or cost, so they are not counted twice. The records are appended to a
+    JSONL file as they arrive.
+2. Tags: The records carry the tags of the current context (`problem_id`, `label`, `level`, ...). The `AsyncRunner`
+    tags every problem, other code can use `telemetry_tags()`.
+3. Aggregates: `summary()` groups the records (by source, model, label and level by default) with the p50/p95/p99 latencies,
+    the tokens per second, the error rate and the cost. `write_prometheus()` exports the same aggregates in the
+    Prometheus text format.
+4. Cost: The cost of a call is computed from `PRICES` (USD per million prompt / completion tokens, matched by model
+    name prefix) and stored in the client's `last_time_price`.
+
+## Usage
+```python
+from xyz.utils.llm.telemetry import configure_telemetry, get_telemetry
+
+configure_telemetry(path="telemetry/calls.jsonl", prometheus_path="telemetry/metrics.prom")
+...  # run the sweep
+get_telemetry().close()  # flush the JSONL file and write the Prometheus file
+```
+
+## Motivation
+The clients only printed their errors, so the latency, the retries and the token usage of a sweep were unknown. The
+telemetry is disabled unless it is configured, and then costs a dict and a file write per call.
+"""
+
+import contextlib
+import contextvars
+import json
+import math
+import os
+import threading
+import time
+from typing import Any, Iterator
+
+__all__ = ["Telemetry", "PRICES", "configure_telemetry", "get_telemetry", "telemetry_tags", "set_tags",
+           "current_tags", "price_of", "percentile"]
+
+# USD per million tokens: (prompt, completion). The longest matching prefix of the model name wins.
+PRICES = {
+    "gpt-4-turbo": (10., 30.),
+    "gpt-4o-mini": (0.15, 0.6),
+    "gpt-4o": (2.5, 10.),
+    "gpt-4": (30., 60.),
+    "gpt-3.5-turbo": (0.5, 1.5),
+    "o1-mini": (3., 12.),
+    "o1-preview": (15., 60.),
+    "o1": (15., 60.),
+}
+
+_tags = contextvars.ContextVar("telemetry_tags", default={})
+
+
+def price_of(model: str | None, prompt_tokens: int | None, completion_tokens: int | None,
+             prices: dict = None) -> float | None:
+    """
+    The cost in USD of a call, None if the model has no known price or the token counts are unknown.
+    """
+
+    if model is None or prompt_tokens is None or completion_tokens is None:
+        return None
+    prices = PRICES if prices is None else prices
+    matches = [name for name in prices if model.startswith(name)]
+    if not matches:
+        return None
+    prompt_price, completion_price = prices[max(matches, key=len)]
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1e6
+
+
+def set_tags(**tags) -> contextvars.Token:
+    """
+    Add `tags` to the tags of the current context, until the returned token is reset or the context is discarded.
+    """
+
+    return _tags.set({**_tags.get(), **tags})
+
+
+def current_tags() -> dict:
+    """
+    The tags of the current context.
+    """
+
+    return _tags.get()
+
+
+@contextlib.contextmanager
+def telemetry_tags(**tags) -> Iterator[None]:
+    """
+    Attach `tags` (e.g. problem_id, label, level) to the records of the calls made in this context.
+    """
+
+    token = set_tags(**tags)
+    try:
+        yield
+    finally:
+        _tags.reset(token)
+
+
+def percentile(values: list, q: float) -> float | None:
+    """
+    The nearest-rank percentile `q` (0 to 100) of sorted values, None if there are none.
+    """
+
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, math.ceil(q / 100. * len(values)) - 1))]
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Telemetry:
+    """
+    The collector of the per-call records.
+    """
+    path: str | None
+    prometheus_path: str | None
+    prices: dict
+
+    def __init__(self, path: str = None, prometheus_path: str = None, prices: dict = None) -> None:
+        """
+        Parameters
+        ----------
+        path: str, optional
+            The JSONL file the records are appended to, by default None (records are only aggregated).
+        prometheus_path: str, optional
+            The file written by `write_prometheus()` and `close()`, by default None.
+        prices: dict, optional
+            The price table, by default `PRICES`.
+        """
+
+        self.path = path
+        self.prometheus_path = prometheus_path
+        self.prices = PRICES if prices is None else prices
+
+        self._lock = threading.Lock()
+        self._records = []
+        self._file = None
+        if path is not None:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._file = open(path, "a")
+
+    def price(self, model: str | None, prompt_tokens: int | None, completion_tokens: int | None) -> float | None:
+        return price_of(model, prompt_tokens, completion_tokens, self.prices)
+
+    def record(self, source: str, model: str = None, latency: float = None, attempts: int = 1,
+               prompt_tokens: int = None, completion_tokens: int = None, finish_reason: str = None,
+               cost: float = None, error: str = None, **fields) -> dict:
+        """
+        Store the record of one call.
+
+        Parameters
+        ----------
+        source: str
+            What made the call, e.g. "openai", "llama" or "llm_agent".
+        model: str, optional
+            The model name.
+        latency: float, optional
+            The wall-clock time of the call in seconds, retries included.
+        attempts: int, optional
+            The number of requests sent, by default 1.
+        prompt_tokens, completion_tokens: int, optional
+            The token usage reported by the provider.
+        finish_reason: str, optional
+            The finish reason of the first choice.
+        cost: float, optional
+            The cost in USD, by default computed from the price table.
+        error: str, optional
+            The error type if the call failed.
+        fields
+            Any other field, e.g. "cached" or "ttft". The tags of the current context are added too.
+
+        Returns
+        -------
+        dict
+            The record.
+        """
+
+        if cost is None:
+            cost = self.price(model, prompt_tokens, completion_tokens)
+        record = {
+            "time": time.time(),
+            "source": source,
+            "model": model,
+            "latency": latency,
+            "attempts": attempts,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "finish_reason": finish_reason,
+            "cost": cost,
+            "error": error,
+            **fields,
+            **_tags.get(),
+        }
+
+        with self._lock:
+            self._records.append(record)
+            if self._file is not None:
+                self._file.write(json.dumps(record, default=str) + "\n")
+                self._file.flush()
+        return record
+
+    @property
+    def records(self) -> list:
+        with self._lock:
+            return list(self._records)
+
+    def summary(self, by: tuple = ("source", "model", "label", "level")) -> list:
+        """
+        Aggregate the records.
+
+        Parameters
+        ----------
+        by: tuple, optional
+            The fields to group by, by default source, model, label and level.
+
+        Returns
+        -------
+        list
+            One dict per group with the group fields and "calls", "errors", "attempts", "latency_p50",
+            "latency_p95", "latency_p99", "latency_mean", "prompt_tokens", "completion_tokens", "tokens_per_second"
+            (completion tokens per second of latency) and "cost".
+        """
+
+        groups = {}
+        for record in self.records:
+            key = tuple(record.get(field) for field in by)
+            groups.setdefault(key, []).append(record)
+
+        rows = []
+        for key, records in sorted(groups.items(), key=lambda item: tuple(str(value) for value in item[0])):
+            latencies = sorted(r["latency"] for r in records if r["latency"] is not None)
+            completion = sum(r["completion_tokens"] or 0 for r in records)
+            busy = sum(r["latency"] for r in records if r["latency"] is not None and r["completion_tokens"])
+            rows.append({
+                **dict(zip(by, key)),
+                "calls": len(records),
+                "errors": sum(1 for r in records if r["error"] is not None),
+                "attempts": sum(r["attempts"] or 0 for r in records),
+                "latency_p50": percentile(latencies, 50),
+                "latency_p95": percentile(latencies, 95),
+                "latency_p99": percentile(latencies, 99),
+                "latency_mean": sum(latencies) / len(latencies) if latencies else None,
+                "prompt_tokens": sum(r["prompt_tokens"] or 0 for r in records),
+                "completion_tokens": completion,
+                "tokens_per_second": completion / busy if busy else None,
+                "cost": sum(r["cost"] or 0. for r in records),
+            })
+        return rows
+
+    def report(self, by: tuple = ("source", "model")) -> str:
+        """
+        A short text table of `summary(by)`.
+        """
+
+        def fmt(value: float | None, digits: int = 2) -> str:
+            return "-" if value is None else f"{value:.{digits}f}"
+
+        lines = []
+        for row in self.summary(by):
+            group = " ".join(f"{field}={row[field]}" for field in by)
+            lines.append(f"{group}: {row['calls']} calls, {row['errors']} errors, {row['attempts']} attempts, "
+                         f"latency p50/p95/p99 {fmt(row['latency_p50'])}/{fmt(row['latency_p95'])}/"
+                         f"{fmt(row['latency_p99'])} s, {fmt(row['tokens_per_second'], 1)} tokens/s, "
+                         f"${fmt(row['cost'], 4)}")
+        return "\n".join(lines)
+
+    def prometheus(self, by: tuple = ("source", "model", "label", "level")) -> str:
+        """
+        The aggregates in the Prometheus text exposition format.
+        """
+
+        metrics = [
+            ("llm_calls_total", "counter", "The number of LLM calls.", "calls"),
+            ("llm_errors_total", "counter", "The number of failed LLM calls.", "errors"),
+            ("llm_attempts_total", "counter", "The number of requests sent, retries included.", "attempts"),
+            ("llm_prompt_tokens_total", "counter", "The prompt tokens.", "prompt_tokens"),
+            ("llm_completion_tokens_total", "counter", "The completion tokens.", "completion_tokens"),
+            ("llm_cost_usd_total", "counter", "The cost in USD.", "cost"),
+            ("llm_completion_tokens_per_second", "gauge", "The completion tokens per second of latency.",
+             "tokens_per_second"),
+        ]
+        rows = self.summary(by)
+        lines = []
+
+        def labels(row: dict, **extra) -> str:
+            pairs = [(field, row[field]) for field in by if row[field] is not None] + list(extra.items())
+            return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}" if pairs else ""
+
+        for name, kind, help_text, field in metrics:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for row in rows:
+                if row[field] is not None:
+                    lines.append(f"{name}{labels(row)} {row[field]}")
+
+        lines.append("# HELP llm_latency_seconds The latency of the LLM calls, retries included.")
+        lines.append("# TYPE llm_latency_seconds summary")
+        for row in rows:
+            for quantile in ("50", "95", "99"):
+                value = row[f"latency_p{quantile}"]
+                if value is not None:
+                    lines.append(f"llm_latency_seconds{labels(row, quantile=f'0.{quantile}')} {value}")
+            if row["latency_mean"] is not None:
+                lines.append(f"llm_latency_seconds_sum{labels(row)} {row['latency_mean'] * row['calls']}")
+            lines.append(f"llm_latency_seconds_count{labels(row)} {row['calls']}")
+
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str = None) -> None:
+        """
+        Write the Prometheus text file (by default to `prometheus_path`), atomically.
+        """
+
+        path = path or self.prometheus_path
+        if path is None:
+            return
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path + ".tmp", "w") as file:
+            file.write(self.prometheus())
+        os.replace(path + ".tmp", path)
+
+    def close(self) -> None:
+        """
+        Close the JSONL file and write the Prometheus file.
+        """
+
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        self.write_prometheus()
+
+
+_telemetry: Telemetry | None = None
+
+
+def get_telemetry() -> Telemetry | None:
+    """
+    The process-wide telemetry, None when it is disabled (the default).
+    """
+
+    return _telemetry
+
+
+def configure_telemetry(path: str = None, prometheus_path: str = None, prices: dict = None) -> Telemetry:
+    """
+    Enable the process-wide telemetry (see `Telemetry`) and return it.
+    """
+
+    global _telemetry
+    _telemetry = Telemetry(path=path, prometheus_path=prometheus_path, prices=prices)
+    return _telemetry
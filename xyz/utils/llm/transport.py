@@ -0,0 +1,292 @@
+"""
+========
+HTTPPool
+========
+@file_name: transport.py
+@description:
+This module implements a process-wide pool of HTTP connections shared by every LLM client. Clients register against the
+pool with the base URL of their provider and receive a shared, keep-alive HTTP client for that origin.
+
+## Features of the HTTPPool include:
+1. One Client per Origin: All clients talking to the same origin (scheme, host and port) share a single `httpx.Client`
+    (for the `openai` SDK) or `requests.Session` (for plain JSON endpoints), so TCP and TLS handshakes are paid once per
+    connection instead of once per request. The async clients (`httpx.AsyncClient`, for `AsyncOpenAI`) are shared per
+    origin and per event loop, since their connections belong to the loop which opened them.
+2. Keep-Alive and HTTP/2: The connection limits and the keep-alive expiry are configurable. HTTP/2 is enabled when the
+    optional `h2` package is installed.
+3. Statistics: `stats()` reports, per origin, the number of requests, the requests currently waiting for a response, the
+    peak of concurrent requests and the number of open and idle connections.
+
+## Usage
+```python
+from xyz.utils.llm.transport import configure_pool, get_pool
+
+configure_pool(max_connections=64)  # optional, before the first client is created
+http_client = get_pool().httpx_client("https://api.openai.com/v1")
+print(get_pool().stats())
+```
+
+## Motivation
+Each agent used to build its own `OpenAI()` and the Llama client called bare `requests.post`, so every problem and every
+retry paid a new handshake. Sharing the connections cuts the per-request latency of long benchmark sweeps.
+"""
+
+import asyncio
+import importlib.util
+import threading
+import weakref
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+__all__ = ["HTTPPool", "get_pool", "configure_pool"]
+
+
+class _Counter:
+    """
+    The request counters of one origin.
+    """
+
+    def __init__(self) -> None:
+        self.requests = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._lock = threading.Lock()
+
+    def enter(self) -> None:
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def exit(self) -> None:
+        with self._lock:
+            self.in_flight -= 1
+
+
+class _CountingTransport(httpx.HTTPTransport):
+    """
+    An httpx transport which counts the requests waiting for their response headers.
+    """
+
+    def __init__(self, counter: _Counter, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.counter = counter
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        self.counter.enter()
+        try:
+            return super().handle_request(request)
+        finally:
+            self.counter.exit()
+
+
+class _AsyncCountingTransport(httpx.AsyncHTTPTransport):
+    """
+    An async httpx transport which counts the requests waiting for their response headers.
+    """
+
+    def __init__(self, counter: _Counter, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.counter = counter
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.counter.enter()
+        try:
+            return await super().handle_async_request(request)
+        finally:
+            self.counter.exit()
+
+
+class _CountingAdapter(HTTPAdapter):
+    """
+    A requests adapter which counts the requests waiting for their response.
+    """
+
+    def __init__(self, counter: _Counter, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.counter = counter
+
+    def send(self, request, **kwargs):
+        self.counter.enter()
+        try:
+            return super().send(request, **kwargs)
+        finally:
+            self.counter.exit()
+
+
+def _origin(base_url: str) -> str:
+    """
+    Normalize a base URL to its origin, e.g. "https://api.openai.com:443".
+    """
+
+    parts = urlsplit(base_url)
+    scheme = parts.scheme or "https"
+    port = parts.port or (443 if scheme == "https" else 80)
+    return f"{scheme}://{parts.hostname}:{port}"
+
+
+class HTTPPool:
+    """
+    Shared keep-alive HTTP clients, one per origin.
+    """
+    max_connections: int
+    max_keepalive_connections: int
+    keepalive_expiry: float
+    http2: bool
+
+    def __init__(self, max_connections: int = 100, max_keepalive_connections: int = 100,
+                 keepalive_expiry: float = 60., http2: bool = None) -> None:
+        """
+        Parameters
+        ----------
+        max_connections: int, optional
+            The maximum number of connections per origin, by default 100.
+        max_keepalive_connections: int, optional
+            The maximum number of idle connections kept alive per origin, by default 100.
+        keepalive_expiry: float, optional
+            The time in seconds an idle connection is kept alive, by default 60.
+        http2: bool, optional
+            Whether to negotiate HTTP/2, by default when the `h2` package is installed.
+        """
+
+        if http2 is None:
+            http2 = importlib.util.find_spec("h2") is not None
+
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.http2 = http2
+
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._httpx_clients = {}
+        self._async_httpx_clients = weakref.WeakKeyDictionary()
+        self._sessions = {}
+
+    def _counter(self, origin: str) -> _Counter:
+        if origin not in self._counters:
+            self._counters[origin] = _Counter()
+        return self._counters[origin]
+
+    def httpx_client(self, base_url: str) -> httpx.Client:
+        """
+        The shared `httpx.Client` of the origin of `base_url`. It can be passed to the `openai` SDK as `http_client`.
+        """
+
+        origin = _origin(base_url)
+        with self._lock:
+            if origin not in self._httpx_clients:
+                transport = _CountingTransport(self._counter(origin), limits=self._limits(), http2=self.http2)
+                self._httpx_clients[origin] = httpx.Client(transport=transport, timeout=httpx.Timeout(600., connect=10.),
+                                                           follow_redirects=True)
+            return self._httpx_clients[origin]
+
+    def _limits(self) -> httpx.Limits:
+        return httpx.Limits(max_connections=self.max_connections,
+                            max_keepalive_connections=self.max_keepalive_connections,
+                            keepalive_expiry=self.keepalive_expiry)
+
+    def async_httpx_client(self, base_url: str) -> httpx.AsyncClient:
+        """
+        The shared `httpx.AsyncClient` of the origin of `base_url` for the running event loop. It can be passed to
+        `openai.AsyncOpenAI` as `http_client`. Must be called from a coroutine.
+        """
+
+        loop = asyncio.get_running_loop()
+        origin = _origin(base_url)
+        with self._lock:
+            clients = self._async_httpx_clients.setdefault(loop, {})
+            if origin not in clients:
+                transport = _AsyncCountingTransport(self._counter(origin), limits=self._limits(), http2=self.http2)
+                clients[origin] = httpx.AsyncClient(transport=transport, timeout=httpx.Timeout(600., connect=10.),
+                                                    follow_redirects=True)
+            return clients[origin]
+
+    def requests_session(self, base_url: str) -> requests.Session:
+        """
+        The shared `requests.Session` of the origin of `base_url`.
+        """
+
+        origin = _origin(base_url)
+        with self._lock:
+            if origin not in self._sessions:
+                session = requests.Session()
+                adapter = _CountingAdapter(self._counter(origin), pool_connections=1, pool_maxsize=self.max_connections)
+                session.mount(origin.split(":")[0] + "://", adapter)
+                self._sessions[origin] = session
+            return self._sessions[origin]
+
+    def stats(self) -> dict:
+        """
+        The utilization of the pool.
+
+        Returns
+        -------
+        dict
+            For each origin: "requests", "in_flight", "peak_in_flight", and for the httpx clients "connections" and
+            "idle_connections".
+        """
+
+        with self._lock:
+            stats = {}
+            for origin, counter in self._counters.items():
+                stats[origin] = {
+                    "requests": counter.requests,
+                    "in_flight": counter.in_flight,
+                    "peak_in_flight": counter.peak_in_flight,
+                }
+                if origin in self._httpx_clients:
+                    try:
+                        # noinspection PyProtectedMember
+                        connections = self._httpx_clients[origin]._transport._pool.connections
+                        stats[origin]["connections"] = len(connections)
+                        stats[origin]["idle_connections"] = sum(1 for c in connections if c.is_idle())
+                    except AttributeError:
+                        pass
+            return stats
+
+    def close(self) -> None:
+        """
+        Close every connection of the pool. The async clients are only dropped: their connections are closed with their
+        event loop.
+        """
+
+        with self._lock:
+            for client in self._httpx_clients.values():
+                client.close()
+            for session in self._sessions.values():
+                session.close()
+            self._httpx_clients.clear()
+            self._async_httpx_clients.clear()
+            self._sessions.clear()
+
+
+_pool: HTTPPool | None = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> HTTPPool:
+    """
+    The process-wide pool, created with the default settings on first use.
+    """
+
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = HTTPPool()
+        return _pool
+
+
+def configure_pool(**kwargs) -> HTTPPool:
+    """
+    Replace the process-wide pool with one built from `kwargs` (see `HTTPPool`). The clients created before keep using
+    the previous pool.
+    """
+
+    global _pool
+    with _pool_lock:
+        _pool = HTTPPool(**kwargs)
+        return _pool
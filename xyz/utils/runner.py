@@ -0,0 +1,335 @@
+"""
+===========
+AsyncRunner
+===========
+@file_name: runner.py
+@description:
+This module provides an asyncio based runner which drives a solver over a JSONL dataset with a bounded number of
+requests in flight. The dataset follows the `final-odyssey-math-with-levels.jsonl` layout: every line is a JSON object
+`{problem_id: {"question": ..., "answer": ..., "label": ..., "level": ...}}`.
+
+## Features of the AsyncRunner include:
+1. Backend Agnostic: The solver is any callable receiving the problem dict. Plain functions (e.g. an Agent, an OpenAI
+    client call) are offloaded to a thread pool, coroutine functions are awaited directly.
+2. Bounded Concurrency: At most `concurrency` problems are in flight. Problems are read lazily from the input file, so
+    the memory footprint does not depend on the size of the dataset.
+3. Incremental Output: Each result is written as a `{problem_id: response}` JSON line as soon as it is available. With
+    `ordered=True` (the default) a small reorder buffer keeps the output in input order, so the file stays line-aligned
+    with the dataset.
+4. Telemetry Tags: Every call is made with the `problem_id`, `label` and `level` of its problem as telemetry tags (see
+    `xyz.utils.llm.telemetry`), so the LLM calls can be broken down by problem class.
+5. Resume: With `resume=True` the problems already present in the output file are skipped and the new results are
+    appended with periodic `fsync` (see `xyz.utils.checkpoint`).
+6. Filters: `run(..., label=..., level=...)` only solves the matching problems, selected from the index of the
+    dataset (see `xyz.utils.data.dataset`) instead of parsing every line.
+7. Sharding: `run(..., shard=(k, N))` only solves the problems of shard k of N and writes them to a part file, so a
+    sweep can be spread over processes and hosts and merged afterwards (see `xyz.utils.sharding`).
+8. Scheduling: With a `scheduler` (and `ordered=False`), the problems are dispatched longest-expected-first from the
+    durations of past runs instead of in input order, which shortens the tail of the sweep (see
+    `xyz.utils.scheduler`).
+9. Retry Queue: A problem failing with a transient error (an endpoint whose circuit breaker is open, or a request
+    which exhausted its retries) is parked instead of failed, and the parked problems are retried after the others,
+    in up to `retries` rounds. Each round starts with a single problem, so an endpoint which is still down costs one
+    request rather than one per parked problem (see `xyz.utils.llm.circuit_breaker`).
+
+## Motivation
+Solving the problems one at a time spends nearly all the wall-clock time waiting on the network. Keeping N requests in
+flight reduces a full sweep from hours to minutes without changing the output format.
+"""
+
+import asyncio
+import contextvars
+import inspect
+import json
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterator
+
+from xyz.utils.checkpoint import CheckpointWriter
+from xyz.utils.data.dataset import JsonlStore
+from xyz.utils.llm.circuit_breaker import CircuitOpenError
+from xyz.utils.llm.rate_limiter import RateLimitExceeded, error_info
+from xyz.utils.llm.telemetry import set_tags, telemetry_tags
+from xyz.utils.sharding import part_path, shard_of
+
+__all__ = ["AsyncRunner", "iter_problems"]
+
+
+def iter_problems(input_file: str, **filters) -> Iterator[tuple[str, dict]]:
+    """
+    Lazily read the problems from a JSONL dataset.
+
+    Parameters
+    ----------
+    input_file: str
+        The path of the dataset.
+    filters
+        Only read the problems whose fields equal these values, e.g. `label="Geometry"` or
+        `level=["high school math", "college math"]` (see `JsonlStore.ids`). None values are ignored.
+
+    Yields
+    ------
+    tuple
+        The problem id and the problem dict.
+    """
+
+    filters = {field: value for field, value in filters.items() if value is not None}
+    if filters:
+        with JsonlStore(input_file) as store:
+            yield from store.iter(**filters)
+        return
+
+    with open(input_file, 'r') as infile:
+        for line in infile:
+            if not line.strip():
+                continue
+            problem = json.loads(line)
+            for key, value in problem.items():
+                yield key, value
+
+
+class AsyncRunner:
+    """
+    Run a solver over every problem in a dataset with a bounded number of concurrent requests.
+    """
+    solve: Callable[[dict], Any]
+    concurrency: int
+    ordered: bool
+    scheduler: Any
+    retries: int
+    retry_delay: float
+    failed: list
+
+    def __init__(self, solve: Callable[[dict], Any], concurrency: int = 8, ordered: bool = True,
+                 scheduler: Any = None, retries: int = 2, retry_delay: float = 30.) -> None:
+        """
+        Initialize the runner.
+
+        Parameters
+        ----------
+        solve: Callable
+            The solver. It receives the problem dict and returns the response which will be stored in the output file.
+            It can be either a normal function or a coroutine function.
+        concurrency: int, optional
+            The maximum number of problems in flight, by default 8.
+        ordered: bool, optional
+            Whether to write the results in input order, by default True. If False, results are written in completion
+            order. A parked problem does not hold back the results after it: if it is solved by a retry, its result is
+            appended after the others.
+        scheduler: LongestFirstScheduler, optional
+            The scheduler choosing the next problem to solve, by default None (input order). It receives the duration
+            of every solved problem. The results are then written in completion order, so `ordered` must be False.
+        retries: int, optional
+            The number of rounds in which the problems failing with a transient error are retried once the other
+            problems are done, by default 2.
+        retry_delay: float, optional
+            The seconds to wait before retrying the parked problems, by default 30 (or until the first open circuit
+            breaker can be probed, if later).
+        """
+
+        assert concurrency >= 1, "The concurrency must be a positive integer."
+        assert scheduler is None or not ordered, "A scheduled run writes the results in completion order."
+
+        self.solve = solve
+        self.concurrency = concurrency
+        self.ordered = ordered
+        self.scheduler = scheduler
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.failed = []
+
+    def run(self, input_file: str, output_file: str, resume: bool = False, shard: tuple[int, int] = None,
+            **filters) -> int:
+        """
+        Solve all problems in the input file and write the responses to the output file.
+
+        Parameters
+        ----------
+        input_file: str
+            The path of the dataset.
+        output_file: str
+            The path of the output JSONL file.
+        resume: bool, optional
+            Whether to skip the problems already completed in the output file and append to it, by default False.
+        shard: tuple, optional
+            (k, N): only solve the problems of shard k of N and write them to the part file of the shard instead of
+            the output file (see `xyz.utils.sharding`), by default None.
+        filters
+            Only solve the problems whose fields equal these values, e.g. `level="college math"` (see
+            `iter_problems`).
+
+        Returns
+        -------
+        int
+            The number of results written.
+        """
+
+        return asyncio.run(self.arun(input_file, output_file, resume=resume, shard=shard, **filters))
+
+    async def arun(self, input_file: str, output_file: str, resume: bool = False, shard: tuple[int, int] = None,
+                   **filters) -> int:
+        """
+        The async version of `run`.
+        """
+
+        if shard is not None:
+            output_file = part_path(output_file, *shard)
+        with CheckpointWriter(output_file, resume=resume) as writer:
+            if writer.completed:
+                print(f"Resuming: {len(writer.completed)} problems are already completed in {output_file}.")
+            problems = ((key, value) for key, value in iter_problems(input_file, **filters)
+                        if key not in writer.completed and (shard is None or shard_of(key, shard[1]) == shard[0]))
+            return await self.arun_problems(problems, writer.write)
+
+    async def arun_problems(self, problems: Iterator[tuple[str, dict]], write: Callable[[str], Any]) -> int:
+        """
+        Solve the given problems and pass every result line to `write`.
+
+        Parameters
+        ----------
+        problems: Iterator
+            The iterator of (problem_id, problem) pairs.
+        write: Callable
+            The function used to store one JSON line.
+
+        Returns
+        -------
+        int
+            The number of results written.
+        """
+
+        self.failed = []
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        # For ordered output: the finished results waiting for their predecessors.
+        pending = {}
+        state = {"next": 0, "written": 0}
+        # The problems which failed with a transient error, to retry after the others
+        parked = []
+        state["round"] = 0
+
+        def emit(index: int | None, key: str, response: Any, ok: bool) -> None:
+            # The problems without an index (scheduled or retried) are written as soon as they are done.
+            if not self.ordered or index is None:
+                if ok:
+                    write(json.dumps({key: response}) + '\n')
+                    state["written"] += 1
+                return
+            pending[index] = (key, response, ok)
+            while state["next"] in pending:
+                key, response, ok = pending.pop(state["next"])
+                if ok:
+                    write(json.dumps({key: response}) + '\n')
+                    state["written"] += 1
+                state["next"] += 1
+
+        async def worker(next_item: Callable) -> None:
+            while True:
+                item = await next_item()
+                if item is None:
+                    return
+                index, key, problem = item
+                start = time.perf_counter()
+                try:
+                    response = await self._call(executor, key, problem)
+                    emit(index, key, response, True)
+                except Exception as error:
+                    if _transient(error) and state["round"] < self.retries:
+                        print(f"Parked {key} for a later retry: {type(error).__name__}: {error}")
+                        parked.append(((None, key, problem), error))
+                        # Move the output cursor past the problem, so the results after it are still written.
+                        emit(index, key, None, False)
+                        continue
+                    print(f"Failed to solve {key}: {traceback.format_exc()}")
+                    self.failed.append(key)
+                    emit(index, key, None, False)
+                if self.scheduler is not None:
+                    self.scheduler.observe(key, problem, time.perf_counter() - start)
+
+        async def run_pass(items: Iterator[tuple] | None) -> None:
+            """
+            Solve the items with `concurrency` workers, or the problems of the scheduler if items is None.
+            """
+
+            queue = asyncio.Queue(maxsize=self.concurrency)
+
+            async def next_item() -> tuple | None:
+                if items is not None:
+                    return await queue.get()
+                # The choice is made when a worker is free, so it uses the durations observed so far.
+                item = self.scheduler.pop()
+                return None if item is None else (None, *item)
+
+            workers = [asyncio.create_task(worker(next_item)) for _ in range(self.concurrency)]
+            try:
+                if items is not None:
+                    for item in items:
+                        await queue.put(item)
+                    for _ in workers:
+                        await queue.put(None)
+                await asyncio.gather(*workers)
+            finally:
+                for task in workers:
+                    task.cancel()
+
+        try:
+            if self.scheduler is not None:
+                self.scheduler.plan(problems)
+                await run_pass(None)
+            else:
+                await run_pass((index, key, problem) for index, (key, problem) in enumerate(problems))
+            while parked:
+                state["round"] += 1
+                delay = self._parked_delay([error for _, error in parked])
+                print(f"Retrying {len(parked)} parked problems in {delay:.0f} seconds (round {state['round']} of "
+                      f"{self.retries}).")
+                await asyncio.sleep(delay)
+                items = [item for item, _ in parked]
+                parked.clear()
+                # The first problem probes the endpoints: if it is parked again, they are still down.
+                await run_pass(iter(items[:1]))
+                if parked:
+                    parked.extend((item, parked[0][1]) for item in items[1:])
+                    continue
+                await run_pass(iter(items[1:]))
+        finally:
+            executor.shutdown(wait=False)
+
+        return state["written"]
+
+    def _parked_delay(self, errors: list) -> float:
+        """
+        The delay before retrying the parked problems: `retry_delay`, or longer if every endpoint is still open.
+        """
+
+        circuits = [error.retry_at for error in errors if isinstance(error, CircuitOpenError)]
+        return max(self.retry_delay, max(circuits) - time.monotonic()) if circuits else self.retry_delay
+
+    async def _call(self, executor: ThreadPoolExecutor, key: str, problem: dict) -> Any:
+        """
+        Call the solver with the telemetry tags of the problem. Sync solvers run in the executor with the current
+        context copied, so context variables set by the caller are visible inside the solver.
+        """
+
+        tags = {"problem_id": key, "label": problem.get("label"), "level": problem.get("level")}
+        if inspect.iscoroutinefunction(self.solve) or inspect.iscoroutinefunction(getattr(self.solve, "__call__", None)):
+            with telemetry_tags(**tags):
+                return await self.solve(problem)
+
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        # The copied context is discarded with the call, so the tags never need to be reset.
+        context.run(set_tags, **tags)
+        return await loop.run_in_executor(executor, context.run, self.solve, problem)
+
+
+def _transient(error: Exception) -> bool:
+    """
+    Whether a failed problem is worth another try later: its endpoint is down or overloaded, not the request wrong.
+    An incomplete stream (`StreamIncomplete`) is not: the client already spent its retries on it, or its generation
+    cannot be resumed. The problem fails, and is solved again by a run with `resume`.
+    """
+
+    if isinstance(error, (CircuitOpenError, RateLimitExceeded)):
+        return True
+    return error_info(error)[0]
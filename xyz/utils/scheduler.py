@@ -0,0 +1,221 @@
+"""
+=====================
+LongestFirstScheduler
+=====================
+@file_name: scheduler.py
+@description:
+This module provides a scheduler which dispatches the problems of a sweep longest-expected-first, so the slow problems
+start early instead of running alone at the end of the sweep.
+
+## Features of the LongestFirstScheduler include:
+1. Duration Priors: The expected duration of a problem is its total LLM latency in past runs (the `calls.jsonl` of the
+    telemetry, see `xyz.utils.llm.telemetry`) or, for the problems without one, the length of its past solutions (the
+    output files of previous runs) converted to seconds with the rate of the problems which have both. The problems
+    without any history get the mean of their (level, label) class. A past run of the same model is the best guide:
+    the solution lengths of two models are only weakly correlated problem by problem.
+2. Online Updates: Every finished problem updates a duration factor of its class (observed seconds over expected), so
+    a class which runs slower than its history is moved ahead of the others during the sweep. The factor is shrunk
+    towards the factor of all the classes until the class has enough observations.
+3. Cheap Dispatch: The problems are kept in one heap per class, so choosing the next problem costs a comparison per
+    class whatever the size of the dataset.
+
+## Usage
+```python
+scheduler = LongestFirstScheduler.from_history(output_files=["jsonl/deepseek-v3-Instruct-solution.jsonl"],
+                                               telemetry_files=["telemetry/calls.jsonl"])
+runner = AsyncRunner(solve, concurrency=16, ordered=False, scheduler=scheduler)
+```
+
+## Motivation
+The solution lengths vary by an order of magnitude between problems (and models), and the competition and college
+problems are the verbose ones. In input order, the longest problems are often the last to start, and the sweep ends
+with a few requests running alone while the other workers are idle.
+"""
+
+import heapq
+import json
+import math
+from typing import Iterable
+
+from xyz.utils.data.dataset import JsonlStore
+
+__all__ = ["LongestFirstScheduler", "telemetry_durations", "output_lengths"]
+
+
+def telemetry_durations(paths: Iterable[str]) -> dict:
+    """
+    The LLM time of every problem in past runs: the mean over the runs of the sum of the latencies of its calls.
+    Cached calls are ignored, they say nothing about the time of a real call.
+    """
+
+    runs = {}
+    for run, path in enumerate(paths):
+        with open(path, "r") as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                key = record.get("problem_id")
+                if key is None or record.get("latency") is None or record.get("cached"):
+                    continue
+                runs.setdefault(key, {}).setdefault(run, 0.)
+                runs[key][run] += record["latency"]
+    return {key: sum(values.values()) / len(values) for key, values in runs.items()}
+
+
+def output_lengths(paths: Iterable[str]) -> dict:
+    """
+    The mean length (in characters) of the past solutions of every problem.
+    """
+
+    lengths = {}
+    for path in paths:
+        with JsonlStore(path) as store:
+            for key, response in store.iter():
+                text = response if isinstance(response, str) else json.dumps(response)
+                lengths.setdefault(key, []).append(len(text))
+    return {key: sum(values) / len(values) for key, values in lengths.items()}
+
+
+class LongestFirstScheduler:
+    """
+    Dispatch the problems by decreasing expected duration, with the estimates corrected as the results arrive.
+    """
+    durations: dict
+    lengths: dict
+    prior_weight: float
+    stats: dict
+
+    def __init__(self, durations: dict = None, lengths: dict = None, prior_weight: float = 3.) -> None:
+        """
+        Parameters
+        ----------
+        durations: dict, optional
+            {problem_id: seconds} from past runs, e.g. from `telemetry_durations`.
+        lengths: dict, optional
+            {problem_id: characters} of past solutions, e.g. from `output_lengths`.
+        prior_weight: float, optional
+            The number of (average) problems the factor of all classes counts for in the factor of a class, by
+            default 3. The larger, the slower a class factor follows its own observations.
+        """
+
+        self.durations = durations or {}
+        self.lengths = lengths or {}
+        self.prior_weight = prior_weight
+
+        # Seconds per character, from the problems with both a duration and a length
+        both = [key for key in self.lengths if key in self.durations and self.lengths[key] > 0]
+        self._rate = sum(self.durations[key] for key in both) / sum(self.lengths[key] for key in both) if both else \
+            None
+
+        self._heaps = {}
+        self._expected = {}
+        self._observed = {}
+        self._total = [0., 0.]
+        self._mean = 1.
+        self._order = 0
+        self.stats = {"planned": 0, "with_history": 0, "observed": 0}
+
+    @classmethod
+    def from_history(cls, output_files: Iterable[str] = (), telemetry_files: Iterable[str] = (),
+                     **kwargs) -> "LongestFirstScheduler":
+        """
+        Build a scheduler from the output files and the telemetry of past runs.
+        """
+
+        return cls(durations=telemetry_durations(telemetry_files), lengths=output_lengths(output_files), **kwargs)
+
+    def __len__(self) -> int:
+        return sum(len(heap) for heap in self._heaps.values())
+
+    def _prior(self, key: str) -> float | None:
+        if key in self.durations:
+            return self.durations[key]
+        if key in self.lengths:
+            # Without any duration, the lengths are the unit: only the order matters.
+            return self.lengths[key] * (self._rate if self._rate is not None else 1.)
+        return None
+
+    def plan(self, problems: Iterable[tuple[str, dict]]) -> None:
+        """
+        Add the problems to schedule.
+
+        Parameters
+        ----------
+        problems: Iterable
+            The (problem_id, problem) pairs, the problem dicts having the "level" and "label" fields of the dataset.
+        """
+
+        problems = list(problems)
+        priors = {key: self._prior(key) for key, _ in problems}
+        known = [prior for prior in priors.values() if prior is not None]
+        self._mean = sum(known) / len(known) if known else 1.
+        by_class = {}
+        for key, problem in problems:
+            if priors[key] is not None:
+                by_class.setdefault(_class_of(problem), []).append(priors[key])
+
+        for key, problem in problems:
+            name = _class_of(problem)
+            expected = priors[key]
+            if expected is None:
+                expected = sum(by_class[name]) / len(by_class[name]) if name in by_class else self._mean
+            else:
+                self.stats["with_history"] += 1
+            self._expected[key] = expected
+            # The order breaks the ties by input order, so the problem dicts are never compared.
+            heapq.heappush(self._heaps.setdefault(name, []), (-expected, self._order, key, problem))
+            self._order += 1
+            self.stats["planned"] += 1
+
+    def factor(self, name: tuple) -> float:
+        """
+        The observed duration over the expected duration of a class, shrunk towards the factor of all the classes.
+        """
+
+        overall = self._total[0] / self._total[1] if self._total[1] > 0 else 1.
+        observed, expected = self._observed.get(name, (0., 0.))
+        weight = self.prior_weight * self._mean
+        return (observed + overall * weight) / (expected + weight) if expected + weight > 0 else overall
+
+    def estimate(self, key: str, problem: dict) -> float:
+        """
+        The current expected duration of a planned problem.
+        """
+
+        return self._expected[key] * self.factor(_class_of(problem))
+
+    def pop(self) -> tuple[str, dict] | None:
+        """
+        The problem with the longest expected duration, None once all the planned problems are dispatched.
+        """
+
+        best, best_value = None, -math.inf
+        for name, heap in self._heaps.items():
+            if heap:
+                value = -heap[0][0] * self.factor(name)
+                if value > best_value:
+                    best, best_value = name, value
+        if best is None:
+            return None
+        _, _, key, problem = heapq.heappop(self._heaps[best])
+        return key, problem
+
+    def observe(self, key: str, problem: dict, seconds: float) -> None:
+        """
+        Record the duration of a finished problem and update the factor of its class.
+        """
+
+        expected = self._expected.get(key)
+        if expected is None or expected <= 0:
+            return
+        name = _class_of(problem)
+        observed, total = self._observed.get(name, (0., 0.))
+        self._observed[name] = (observed + seconds, total + expected)
+        self._total[0] += seconds
+        self._total[1] += expected
+        self.stats["observed"] += 1
+
+
+def _class_of(problem: dict) -> tuple:
+    return problem.get("level"), problem.get("label")
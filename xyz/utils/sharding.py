@@ -0,0 +1,155 @@
+"""
+========
+Sharding
+========
+@file_name: sharding.py
+@description:
+This module splits a sweep over several workers and merges their outputs back into one file. A worker is any process,
+on this host or on another one sharing the output directory, which runs a generation or evaluation script with
+`--shard k/N`.
+
+## Features of the Sharding include:
+1. Stable Assignment: A problem belongs to shard `shard_of(problem_id, N)`, computed from a hash of its id (not of its
+    position in the dataset), so every worker agrees on the split without any coordination, and a re-run or a filtered
+    run keeps each problem in the same shard.
+2. Part Files: Shard k of N writes `<output>.part-<k>-of-<N><ext>` (see `part_path`). Each part file is an ordinary
+    checkpointed output, so a worker can be resumed on its own.
+3. Deterministic Merge: `merge_parts` checks that every part file exists and that every record sits in the right part,
+    then writes the canonical file ordered by problem id (in natural order: `Problem_2` before `Problem_10`). The same
+    parts always merge into the same bytes, however the work was split.
+
+## Usage
+```
+python generate_response.py --shard 0/4 &   # on host A, with one API key
+python generate_response.py --shard 1/4 &   # on host B, with another one
+...
+python generate_response.py --merge 4       # once all shards are done
+```
+
+## Motivation
+One process driving one API key is the ceiling of a sweep. Sharding by problem id lets a sweep be spread over API keys
+and machines, and the merge makes the result independent of how it was spread.
+"""
+
+import hashlib
+import json
+import os
+import re
+
+__all__ = ["shard_of", "parse_shard", "part_path", "merge_parts", "problem_order"]
+
+
+def shard_of(problem_id: str, num_shards: int) -> int:
+    """
+    The shard of a problem, in [0, num_shards). It only depends on the id and the number of shards.
+    """
+
+    digest = hashlib.sha1(problem_id.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % num_shards
+
+
+def parse_shard(text: str) -> tuple[int, int]:
+    """
+    Parse a shard specification "k/N" (k counts from 0) into (k, N).
+
+    Raises
+    ------
+    ValueError
+        If the specification is malformed or k is not in [0, N).
+    """
+
+    match = re.fullmatch(r"\s*(\d+)\s*/\s*(\d+)\s*", text)
+    if not match:
+        raise ValueError(f"Invalid shard {text!r}, expected k/N, e.g. 0/4.")
+    index, count = int(match.group(1)), int(match.group(2))
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Invalid shard {text!r}, k must be in [0, N).")
+    return index, count
+
+
+def part_path(output_file: str, index: int, count: int) -> str:
+    """
+    The part file written by shard `index` of `count` for `output_file`.
+    """
+
+    root, ext = os.path.splitext(output_file)
+    width = max(3, len(str(count - 1)))
+    return f"{root}.part-{index:0{width}d}-of-{count:0{width}d}{ext}"
+
+
+def problem_order(problem_id: str) -> tuple:
+    """
+    The sort key of a problem id in natural order, i.e. the numbers in the id are compared as numbers.
+    """
+
+    return tuple((0, int(part), "") if part.isdigit() else (1, 0, part)
+                 for part in re.split(r"(\d+)", problem_id) if part)
+
+
+def merge_parts(output_file: str, count: int, expected: list = None) -> dict:
+    """
+    Merge the part files of `count` shards into `output_file`, ordered by problem id.
+
+    Within a part file a later line replaces an earlier one with the same id (this is how a resumed evaluation
+    completes its pending rows). An incomplete last line, left by a killed worker, is ignored. The output file is
+    replaced atomically.
+
+    Parameters
+    ----------
+    output_file: str
+        The merged file, also the name the part files derive from (see `part_path`).
+    count: int
+        The number of shards.
+    expected: list, optional
+        The ids which should be present, e.g. the ids of the dataset. Those absent from every part are reported.
+
+    Returns
+    -------
+    dict
+        "records" (the number of merged records), "missing" (the expected ids absent from the parts) and "parts"
+        (the number of records of every part).
+
+    Raises
+    ------
+    FileNotFoundError
+        If a part file is missing.
+    ValueError
+        If a record is in the part of another shard, e.g. because the parts were written with a different N.
+    """
+
+    paths = [part_path(output_file, index, count) for index in range(count)]
+    absent = [path for path in paths if not os.path.exists(path)]
+    if absent:
+        raise FileNotFoundError(f"{len(absent)} of {count} part files are missing: {', '.join(absent)}")
+
+    lines = {}
+    parts = []
+    for index, path in enumerate(paths):
+        records = set()
+        with open(path, "rb") as file:
+            for line in file:
+                if not line.endswith(b"\n") or not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    print(f"Skipping a corrupt line of {path}.")
+                    continue
+                for problem_id, value in record.items():
+                    if shard_of(problem_id, count) != index:
+                        raise ValueError(f"{problem_id} belongs to shard {shard_of(problem_id, count)} of {count} "
+                                         f"but was found in {path}.")
+                    lines[problem_id] = json.dumps({problem_id: value}) + "\n"
+                    records.add(problem_id)
+        parts.append(len(records))
+
+    os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+    with open(output_file + ".tmp", "w") as file:
+        for problem_id in sorted(lines, key=problem_order):
+            file.write(lines[problem_id])
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(output_file + ".tmp", output_file)
+
+    missing = [problem_id for problem_id in expected if problem_id not in lines] if expected is not None else []
+    return {"records": len(lines), "missing": missing, "parts": parts}
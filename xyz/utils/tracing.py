@@ -0,0 +1,300 @@
+"""
+======
+Tracer
+======
+@file_name: tracing.py
+@description:
+This module records the nested calls of the agents as spans and exports them in the Chrome trace-event format, which
+`chrome://tracing` and Perfetto (https://ui.perfetto.dev) display as a timeline.
+
+## Features of the Tracer include:
+1. Nested Spans: Every `agent(...)` and `await agent.acall(...)` opens a span, and so does every `LLMAgent.request`.
+    The parent of a span is the span open in the current context, so the nesting survives `asyncio.gather`, the worker
+    threads of `asyncio.to_thread` and the executor of the `AsyncRunner`.
+2. Call Details: An agent span records the agent class and the size of its keyword arguments (in characters). A
+    request span also records the latency of the client, its attempts and retries, the prompt and completion tokens
+    and whether the response came from the cache; the root spans carry the telemetry tags of the problem (`problem_id`,
+    `label`, `level`).
+3. Concurrency: The concurrent spans are laid out on separate lanes (the "threads" of the trace), so overlapping calls
+    of the same pipeline are displayed side by side, each lane properly nested.
+4. Near-Zero Overhead When Disabled: Tracing is off unless `configure_tracing()` is called; until then, an agent call
+    only pays for one function call and a `None` check. When it is on, a span costs a few microseconds.
+5. Summary: `summary()` aggregates the spans by name (calls, total and self time, p50/p95/max duration), to find the
+    slow sub-agent without opening the trace.
+
+## Usage
+```python
+from xyz.utils.tracing import configure_tracing
+
+tracer = configure_tracing("traces/solve.json")
+...  # run the pipeline
+tracer.close()  # write the trace
+print(tracer.report())
+```
+`generate_response.py` and `evaluate_response.py` enable it with `--trace <path>`.
+
+## Motivation
+`Agent._structure` shows which sub-agents a pipeline is made of, but not which of them is slow, and the per-call
+telemetry does not say which agent made a call. Under concurrency the interleaved prints are no help either.
+"""
+
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+from typing import Any, Iterator
+
+from xyz.utils.llm.telemetry import current_tags, percentile
+
+__all__ = ["Tracer", "Span", "configure_tracing", "get_tracer", "annotate", "kwargs_size"]
+
+_current = contextvars.ContextVar("tracing_span", default=None)
+
+
+def kwargs_size(kwargs: dict) -> int:
+    """
+    The size of the arguments of a call in characters: the length of the strings, the length of the repr of the rest.
+    """
+
+    size = 0
+    for value in kwargs.values():
+        if value is None:
+            continue
+        size += len(value) if isinstance(value, str) else len(repr(value))
+    return size
+
+
+class Span:
+    """
+    One timed call. `args` is displayed with the span in the trace viewer.
+    """
+    __slots__ = ("name", "category", "start", "args", "parent", "lane", "own_lane", "children", "child_time")
+
+    def __init__(self, name: str, category: str, args: dict, parent: "Span | None") -> None:
+        self.name = name
+        self.category = category
+        self.args = args
+        self.parent = parent
+        self.start = 0
+        self.lane = 0
+        self.own_lane = False
+        self.children = 0
+        self.child_time = 0
+
+
+class Tracer:
+    """
+    The collector of the spans.
+    """
+    path: str | None
+    max_events: int
+
+    def __init__(self, path: str = None, max_events: int = 1_000_000) -> None:
+        """
+        Parameters
+        ----------
+        path: str, optional
+            The JSON file written by `close()`, by default None (call `export(path)`).
+        max_events: int, optional
+            The maximum number of spans kept, by default 1,000,000. The spans beyond are counted but dropped.
+        """
+
+        self.path = path
+        self.max_events = max_events
+
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter_ns()
+        self._events = []
+        self._self_times = []
+        self._dropped = 0
+        self._free_lanes = []
+        self._lanes = 0
+
+    def _lane(self, parent: Span | None) -> tuple[int, bool]:
+        """
+        The lane of a new span: the lane of its parent if it is the only open child, else a free lane.
+        """
+
+        with self._lock:
+            if parent is not None:
+                parent.children += 1
+                if parent.children == 1:
+                    return parent.lane, False
+            if self._free_lanes:
+                lane = min(self._free_lanes)
+                self._free_lanes.remove(lane)
+                return lane, True
+            self._lanes += 1
+            return self._lanes, True
+
+    def start(self, name: str, category: str = "agent", **args) -> tuple[Span, contextvars.Token]:
+        """
+        Open a span in the current context. It must be closed with `finish` in the same context.
+        """
+
+        parent = _current.get()
+        if parent is None:
+            args.update((key, value) for key, value in current_tags().items() if value is not None)
+        span = Span(name, category, args, parent)
+        span.lane, span.own_lane = self._lane(parent)
+        span.start = time.perf_counter_ns()
+        return span, _current.set(span)
+
+    def finish(self, span: Span, token: contextvars.Token, error: BaseException = None) -> None:
+        """
+        Close a span opened by `start`.
+        """
+
+        end = time.perf_counter_ns()
+        _current.reset(token)
+        duration = end - span.start
+        if error is not None:
+            span.args["error"] = type(error).__name__
+        event = {"name": span.name, "cat": span.category, "ph": "X", "pid": os.getpid(), "tid": span.lane,
+                 "ts": (span.start - self._origin) / 1000., "dur": duration / 1000., "args": span.args}
+
+        with self._lock:
+            if span.parent is not None:
+                span.parent.children -= 1
+                span.parent.child_time += duration
+            if span.own_lane:
+                self._free_lanes.append(span.lane)
+            if len(self._events) < self.max_events:
+                self._events.append(event)
+                self._self_times.append(max(0, duration - span.child_time) / 1e9)
+            else:
+                self._dropped += 1
+
+    @contextlib.contextmanager
+    def span(self, name: str, category: str = "agent", **args) -> Iterator[Span]:
+        """
+        A span around a block of code.
+        """
+
+        span, token = self.start(name, category, **args)
+        try:
+            yield span
+        except BaseException as error:
+            self.finish(span, token, error)
+            raise
+        self.finish(span, token)
+
+    @property
+    def events(self) -> list:
+        with self._lock:
+            return list(self._events)
+
+    def trace(self) -> dict:
+        """
+        The spans in the Chrome trace-event format (the JSON object format), with the names of the lanes.
+        """
+
+        events = self.events
+        pid = os.getpid()
+        lanes = sorted({event["tid"] for event in events})
+        metadata = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": "odyssey-math"}}]
+        metadata += [{"name": "thread_name", "ph": "M", "pid": pid, "tid": lane, "args": {"name": f"lane {lane}"}}
+                     for lane in lanes]
+        return {"traceEvents": metadata + events, "displayTimeUnit": "ms",
+                "otherData": {"dropped_spans": self._dropped}}
+
+    def export(self, path: str = None) -> None:
+        """
+        Write the trace (by default to `path`), atomically.
+        """
+
+        path = path or self.path
+        if path is None:
+            return
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path + ".tmp", "w") as file:
+            json.dump(self.trace(), file, default=str)
+        os.replace(path + ".tmp", path)
+
+    def summary(self) -> list:
+        """
+        Aggregate the spans by name.
+
+        Returns
+        -------
+        list
+            One dict per span name, the slowest in total first, with "name", "calls", "errors", "total" and "self"
+            (the time not spent in child spans, which overlap under concurrency) in seconds, and "p50", "p95" and
+            "max" durations in seconds.
+        """
+
+        with self._lock:
+            events = list(zip(self._events, self._self_times))
+        groups = {}
+        for event, self_time in events:
+            groups.setdefault(event["name"], []).append((event, self_time))
+
+        rows = []
+        for name, items in groups.items():
+            durations = sorted(event["dur"] / 1e6 for event, _ in items)
+            rows.append({
+                "name": name,
+                "calls": len(items),
+                "errors": sum(1 for event, _ in items if "error" in event["args"]),
+                "total": sum(durations),
+                "self": sum(self_time for _, self_time in items),
+                "p50": percentile(durations, 50),
+                "p95": percentile(durations, 95),
+                "max": durations[-1],
+            })
+        return sorted(rows, key=lambda row: -row["total"])
+
+    def report(self) -> str:
+        """
+        A short text table of `summary()`.
+        """
+
+        lines = [f"{row['name']}: {row['calls']} calls, {row['errors']} errors, total {row['total']:.2f} s "
+                 f"(self {row['self']:.2f} s), p50/p95/max {row['p50']:.3f}/{row['p95']:.3f}/{row['max']:.3f} s"
+                 for row in self.summary()]
+        if self._dropped:
+            lines.append(f"{self._dropped} spans dropped beyond max_events={self.max_events}.")
+        return "\n".join(lines)
+
+    def close(self) -> None:
+        """
+        Write the trace to `path`.
+        """
+
+        self.export()
+
+
+def annotate(**args: Any) -> None:
+    """
+    Add `args` to the span open in the current context, if tracing is enabled and there is one. The clients use it
+    to attach their latency, attempts and token counts to the span of the request.
+    """
+
+    if _tracer is None:
+        return
+    span = _current.get()
+    if span is not None:
+        span.args.update(args)
+
+
+_tracer: Tracer | None = None
+
+
+def get_tracer() -> Tracer | None:
+    """
+    The process-wide tracer, None when tracing is disabled (the default).
+    """
+
+    return _tracer
+
+
+def configure_tracing(path: str = None, max_events: int = 1_000_000) -> Tracer:
+    """
+    Enable the process-wide tracing (see `Tracer`) and return the tracer.
+    """
+
+    global _tracer
+    _tracer = Tracer(path=path, max_events=max_events)
+    return _tracer